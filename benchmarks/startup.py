@@ -0,0 +1,81 @@
+"""Measures the cold start of the vm-trainer cli.
+
+Each scenario runs in a fresh interpreter with an audit hook counting the
+subprocesses it starts. The run fails when a scenario starts a subprocess or
+its median wall time is over the budget.
+
+    python3 benchmarks/startup.py --runs 10 --budget-ms 300
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = (
+    ("help", ["--help"]),
+    ("machine-list", ["machine-list"]),
+)
+SUBPROCESS_EVENTS = ("subprocess.Popen", "os.system", "os.fork", "os.exec", "os.posix_spawn")
+
+
+def run_child(args):
+    started = time.perf_counter()
+    spawned = []
+    sys.addaudithook(lambda event, event_args: spawned.append(event) if event in SUBPROCESS_EVENTS else None)
+
+    from vm_trainer.management.clickgroup import cli
+    try:
+        cli.main(args=args, prog_name="vm-trainer", standalone_mode=False)
+    except SystemExit:
+        pass
+    modules = sorted(name for name in sys.modules if name.startswith("vm_trainer.management."))
+    result = {"wall_ms": (time.perf_counter() - started) * 1000, "subprocesses": len(spawned), "modules": modules}
+    sys.__stderr__.write(json.dumps(result) + "\n")
+
+
+def run_scenario(args, home):
+    env = dict(os.environ, HOME=home, PYTHONPATH=REPO_DIR)
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"] + args, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    total_ms = (time.perf_counter() - started) * 1000
+    if process.returncode:
+        raise SystemExit(f"vm-trainer {' '.join(args)} failed:\n{process.stderr}")
+    result = json.loads(process.stderr.strip().splitlines()[-1])
+    result["total_ms"] = total_ms
+    return result
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        run_child(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the vm-trainer cli")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="Budget for the median process wall time")
+    options = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as home:
+        for name, args in SCENARIOS:
+            results = [run_scenario(args, home) for _ in range(options.runs)]
+            median = statistics.median(result["total_ms"] for result in results)
+            in_process = statistics.median(result["wall_ms"] for result in results)
+            subprocesses = max(result["subprocesses"] for result in results)
+            print(f"{name:<16} process {median:8.1f} ms  cli {in_process:8.1f} ms  subprocesses {subprocesses}  "
+                  f"modules {', '.join(module.rsplit('.', 1)[-1] for module in results[0]['modules'])}")
+            if subprocesses:
+                failures.append(f"{name} started {subprocesses} subprocesses")
+            if median > options.budget_ms:
+                failures.append(f"{name} took {median:.1f} ms, the budget is {options.budget_ms:.1f} ms")
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
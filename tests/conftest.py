@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def home_dir(tmp_path, monkeypatch):
+    # the settings, the machines and the run directory live under ~/.vmtrainer
+    home = tmp_path.joinpath("home")
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
+    return home
@@ -0,0 +1,33 @@
+import pytest
+
+from vm_trainer.components.catalog import MachineFilter
+from vm_trainer.exceptions import CommandError
+
+SUMMARY = {
+    "name": "trainer",
+    "cpus": 16,
+    "memory": 65536,
+    "tpm": False,
+    "gpus": ["0000:01:00.0", "0000:01:00.1"],
+    "disks": ["/srv/disks/trainer.qcow2"],
+    "usb-device": "",
+    "nic-model": "virtio",
+    "mac-address": "52:54:00:12:34:56",
+}
+
+
+@pytest.mark.parametrize("expression", ["gpu=0000:01:00.0", "gpus=0000:01:00.1", "disk=/srv/disks/trainer.qcow2",
+                                        "cpus>=16", "memory<=65536", "nic-model=VIRTIO"])
+def test_filter_matches(expression):
+    assert MachineFilter(expression).matches(SUMMARY)
+
+
+@pytest.mark.parametrize("expression", ["gpu=0000:02:00.0", "cpus>=17", "tpm=true"])
+def test_filter_does_not_match(expression):
+    assert not MachineFilter(expression).matches(SUMMARY)
+
+
+@pytest.mark.parametrize("expression", ["gpu-count=1", "cpus>=many", "name>=3", "cpus"])
+def test_invalid_filter_is_refused_before_any_machine_is_read(expression):
+    with pytest.raises(CommandError):
+        MachineFilter(expression)
@@ -0,0 +1,192 @@
+import json
+
+from vm_trainer.components.firewall import (IpTablesFirewall, NatRules,
+                                            NftablesFirewall,
+                                            parse_iptables_save)
+
+# iptables-save of a host running docker, before the first launch
+IPTABLES_FRESH = """# Generated by iptables-save v1.8.7 on Sat Oct 17 09:12:01 2026
+*filter
+:INPUT ACCEPT [1823:402114]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [1710:233891]
+:DOCKER - [0:0]
+-A FORWARD -o docker0 -j DOCKER
+-A FORWARD -i docker0 ! -o docker0 -j ACCEPT
+COMMIT
+# Completed on Sat Oct 17 09:12:01 2026
+# Generated by iptables-save v1.8.7 on Sat Oct 17 09:12:01 2026
+*nat
+:PREROUTING ACCEPT [12:1440]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [85:6120]
+:POSTROUTING ACCEPT [85:6120]
+:DOCKER - [0:0]
+-A POSTROUTING -s 172.17.0.0/16 ! -o docker0 -j MASQUERADE
+COMMIT
+# Completed on Sat Oct 17 09:12:01 2026
+"""
+
+# the same host once the nat of vmtrainerbr0 is installed
+IPTABLES_INSTALLED = """# Generated by iptables-save v1.8.7 on Sat Oct 17 09:15:44 2026
+*filter
+:INPUT ACCEPT [2410:512387]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [2289:301552]
+:DOCKER - [0:0]
+:VMT-FWD-vmtrainerbr0 - [0:0]
+-A FORWARD -o docker0 -j DOCKER
+-A FORWARD -i docker0 ! -o docker0 -j ACCEPT
+-A FORWARD -i vmtrainerbr0 -j VMT-FWD-vmtrainerbr0
+-A FORWARD -o vmtrainerbr0 -j VMT-FWD-vmtrainerbr0
+-A VMT-FWD-vmtrainerbr0 -i vmtrainerbr0 -o eth0 -j ACCEPT
+-A VMT-FWD-vmtrainerbr0 -i eth0 -o vmtrainerbr0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
+COMMIT
+# Completed on Sat Oct 17 09:15:44 2026
+# Generated by iptables-save v1.8.7 on Sat Oct 17 09:15:44 2026
+*nat
+:PREROUTING ACCEPT [14:1680]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [97:7004]
+:POSTROUTING ACCEPT [97:7004]
+:DOCKER - [0:0]
+:VMT-NAT-vmtrainerbr0 - [0:0]
+-A POSTROUTING -s 172.17.0.0/16 ! -o docker0 -j MASQUERADE
+-A POSTROUTING -s 192.168.100.0/24 -j VMT-NAT-vmtrainerbr0
+-A VMT-NAT-vmtrainerbr0 -o eth0 -j MASQUERADE
+COMMIT
+# Completed on Sat Oct 17 09:15:44 2026
+"""
+
+# nft -j list table ip vmtrainer once the nat of vmtrainerbr0 is installed
+NFT_INSTALLED = {"nftables": [
+    {"metainfo": {"version": "1.0.6", "release_name": "Lester Gooch #5", "json_schema_version": 1}},
+    {"table": {"family": "ip", "name": "vmtrainer", "handle": 7}},
+    {"chain": {"family": "ip", "table": "vmtrainer", "name": "forward-vmtrainerbr0", "handle": 1,
+               "type": "filter", "hook": "forward", "prio": 0, "policy": "accept"}},
+    {"chain": {"family": "ip", "table": "vmtrainer", "name": "postrouting-vmtrainerbr0", "handle": 2,
+               "type": "nat", "hook": "postrouting", "prio": 100, "policy": "accept"}},
+    {"rule": {"family": "ip", "table": "vmtrainer", "chain": "forward-vmtrainerbr0", "handle": 3,
+              "comment": "vm-trainer 7bd43266483d", "expr": [
+                  {"match": {"op": "==", "left": {"meta": {"key": "iifname"}}, "right": "vmtrainerbr0"}},
+                  {"match": {"op": "==", "left": {"meta": {"key": "oifname"}}, "right": "eth0"}},
+                  {"accept": None}]}},
+    {"rule": {"family": "ip", "table": "vmtrainer", "chain": "forward-vmtrainerbr0", "handle": 4,
+              "comment": "vm-trainer 7bd43266483d", "expr": [
+                  {"match": {"op": "==", "left": {"meta": {"key": "iifname"}}, "right": "eth0"}},
+                  {"match": {"op": "==", "left": {"meta": {"key": "oifname"}}, "right": "vmtrainerbr0"}},
+                  {"match": {"op": "in", "left": {"ct": {"key": "state"}}, "right": ["established", "related"]}},
+                  {"accept": None}]}},
+    {"rule": {"family": "ip", "table": "vmtrainer", "chain": "postrouting-vmtrainerbr0", "handle": 5,
+              "comment": "vm-trainer 1110ec546e03", "expr": [
+                  {"match": {"op": "==", "left": {"payload": {"protocol": "ip", "field": "saddr"}},
+                             "right": {"prefix": {"addr": "192.168.100.0", "len": 24}}}},
+                  {"match": {"op": "==", "left": {"meta": {"key": "oifname"}}, "right": "eth0"}},
+                  {"masquerade": None}]}},
+]}
+
+
+def nat_rules(subnet="192.168.100.0/24"):
+    return NatRules("vmtrainerbr0", "eth0", subnet)
+
+
+def fake_command(tmp_path, name, output):
+    # prints the recorded output and keeps what it was fed on stdin
+    output_path = tmp_path.joinpath(f"{name}.out")
+    output_path.write_text(output)
+    script = tmp_path.joinpath(name)
+    script.write_text(f'#!/bin/sh\ncat > "{tmp_path}/{name}.in"\ncat "{output_path}"\n')
+    return ["sh", str(script)]
+
+
+def test_fresh_install_adds_the_chains_and_the_jumps():
+    delta = IpTablesFirewall.install_delta(parse_iptables_save(IPTABLES_FRESH), nat_rules())
+    assert delta == "\n".join([
+        "*filter",
+        ":VMT-FWD-vmtrainerbr0 - [0:0]",
+        "-A VMT-FWD-vmtrainerbr0 -i vmtrainerbr0 -o eth0 -j ACCEPT",
+        "-A VMT-FWD-vmtrainerbr0 -i eth0 -o vmtrainerbr0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+        "-A FORWARD -i vmtrainerbr0 -j VMT-FWD-vmtrainerbr0",
+        "-A FORWARD -o vmtrainerbr0 -j VMT-FWD-vmtrainerbr0",
+        "COMMIT",
+        "*nat",
+        ":VMT-NAT-vmtrainerbr0 - [0:0]",
+        "-A VMT-NAT-vmtrainerbr0 -o eth0 -j MASQUERADE",
+        "-A POSTROUTING -s 192.168.100.0/24 -j VMT-NAT-vmtrainerbr0",
+        "COMMIT",
+    ]) + "\n"
+
+
+def test_installed_rules_are_left_alone():
+    assert IpTablesFirewall.install_delta(parse_iptables_save(IPTABLES_INSTALLED), nat_rules()) == ""
+
+
+def test_subnet_change_only_moves_the_nat_jump():
+    delta = IpTablesFirewall.install_delta(parse_iptables_save(IPTABLES_INSTALLED), nat_rules("10.20.0.0/24"))
+    assert delta == "\n".join([
+        "*nat",
+        "-D POSTROUTING -s 192.168.100.0/24 -j VMT-NAT-vmtrainerbr0",
+        "-A POSTROUTING -s 10.20.0.0/24 -j VMT-NAT-vmtrainerbr0",
+        "COMMIT",
+    ]) + "\n"
+
+
+def test_removal_drops_the_jumps_and_the_chains():
+    delta = IpTablesFirewall.remove_delta(parse_iptables_save(IPTABLES_INSTALLED), "vmtrainerbr0")
+    assert delta == "\n".join([
+        "*filter",
+        "-D FORWARD -i vmtrainerbr0 -j VMT-FWD-vmtrainerbr0",
+        "-D FORWARD -o vmtrainerbr0 -j VMT-FWD-vmtrainerbr0",
+        "-F VMT-FWD-vmtrainerbr0",
+        "-X VMT-FWD-vmtrainerbr0",
+        "COMMIT",
+        "*nat",
+        "-D POSTROUTING -s 192.168.100.0/24 -j VMT-NAT-vmtrainerbr0",
+        "-F VMT-NAT-vmtrainerbr0",
+        "-X VMT-NAT-vmtrainerbr0",
+        "COMMIT",
+    ]) + "\n"
+    assert IpTablesFirewall.remove_delta(parse_iptables_save(IPTABLES_FRESH), "vmtrainerbr0") == ""
+
+
+def test_iptables_install_restores_only_the_delta(tmp_path):
+    firewall = IpTablesFirewall(fake_command(tmp_path, "iptables-save", IPTABLES_INSTALLED),
+                                fake_command(tmp_path, "iptables-restore", ""))
+    assert not firewall.install(nat_rules())
+    assert not tmp_path.joinpath("iptables-restore.in").exists()
+    assert firewall.install(nat_rules("10.20.0.0/24"))
+    assert tmp_path.joinpath("iptables-restore.in").read_text().startswith("*nat\n")
+
+
+def test_nft_install_script_for_a_new_table():
+    script = NftablesFirewall().install_script({}, nat_rules())
+    assert script.splitlines() == [
+        "add table ip vmtrainer",
+        "add chain ip vmtrainer forward-vmtrainerbr0 { type filter hook forward priority filter; policy accept; }",
+        "flush chain ip vmtrainer forward-vmtrainerbr0",
+        'add rule ip vmtrainer forward-vmtrainerbr0 iifname "vmtrainerbr0" oifname "eth0" accept comment "vm-trainer 7bd43266483d"',
+        'add rule ip vmtrainer forward-vmtrainerbr0 iifname "eth0" oifname "vmtrainerbr0" ct state related,established accept'
+        ' comment "vm-trainer 7bd43266483d"',
+        "add chain ip vmtrainer postrouting-vmtrainerbr0 { type nat hook postrouting priority srcnat; policy accept; }",
+        "flush chain ip vmtrainer postrouting-vmtrainerbr0",
+        'add rule ip vmtrainer postrouting-vmtrainerbr0 ip saddr 192.168.100.0/24 oifname "eth0" masquerade'
+        ' comment "vm-trainer 1110ec546e03"',
+    ]
+
+
+def test_nft_recorded_table_is_parsed_and_left_alone(tmp_path):
+    firewall = NftablesFirewall(fake_command(tmp_path, "nft", json.dumps(NFT_INSTALLED)))
+    current = firewall.current()
+    assert current == {
+        "forward-vmtrainerbr0": ["vm-trainer 7bd43266483d", "vm-trainer 7bd43266483d"],
+        "postrouting-vmtrainerbr0": ["vm-trainer 1110ec546e03"],
+    }
+    assert firewall.install_script(current, nat_rules()) == ""
+
+
+def test_nft_subnet_change_rewrites_only_the_postrouting_chain(tmp_path):
+    firewall = NftablesFirewall(fake_command(tmp_path, "nft", json.dumps(NFT_INSTALLED)))
+    script = firewall.install_script(firewall.current(), nat_rules("10.20.0.0/24"))
+    assert "forward-vmtrainerbr0" not in script
+    assert "flush chain ip vmtrainer postrouting-vmtrainerbr0" in script
+    assert "ip saddr 10.20.0.0/24" in script
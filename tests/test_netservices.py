@@ -0,0 +1,131 @@
+import asyncio
+import socket
+import struct
+
+from vm_trainer.components.dhcp import (BOOTP_HEADER, BOOTREQUEST, DHCPACK,
+                                        DHCPDISCOVER, DHCPOFFER, DHCPREQUEST,
+                                        MAGIC_COOKIE, OPTION_MESSAGE_TYPE,
+                                        OPTION_REQUESTED_ADDRESS,
+                                        OPTION_SERVER_ID, DhcpPacket,
+                                        format_options)
+from vm_trainer.components.netservices import run_services
+
+MAC = "52:54:00:12:34:56"
+GUEST_IP = "127.0.0.10"
+
+
+def free_port():
+    # the dns server listens on udp and tcp with the same port
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+            tcp.bind(("127.0.0.1", 0))
+            port = tcp.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+                try:
+                    udp.bind(("127.0.0.1", port))
+                except OSError:
+                    continue
+        return port
+
+
+def dhcp_request(message_type, xid, options=()):
+    header = BOOTP_HEADER.pack(BOOTREQUEST, 1, 6, 0, xid, 0, 0, b"\0" * 4, b"\0" * 4, b"\0" * 4, b"\0" * 4,
+                               bytes.fromhex(MAC.replace(":", "")), b"", b"")
+    return header + MAGIC_COOKIE + format_options([(OPTION_MESSAGE_TYPE, bytes([message_type]))] + list(options))
+
+
+def dns_query(query_id):
+    question = b"\x07example\x03com\x00" + struct.pack("!HH", 1, 1)
+    return struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + question
+
+
+def dns_answer(query):
+    header = struct.pack("!HHHHHH", struct.unpack_from("!H", query)[0], 0x8180, 1, 1, 0, 0)
+    record = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + socket.inet_aton("93.184.216.34")
+    return header + query[12:] + record
+
+
+class FakeUpstream(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries.append(data)
+        self.transport.sendto(dns_answer(data), addr)
+
+
+class Client(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.replies.put_nowait(data)
+
+
+async def exchange(transport, client, data, addr):
+    transport.sendto(data, addr)
+    return await asyncio.wait_for(client.replies.get(), 5)
+
+
+async def drive_services():
+    loop = asyncio.get_running_loop()
+    upstream = FakeUpstream()
+    upstream_transport, _ = await loop.create_datagram_endpoint(lambda: upstream, local_addr=("127.0.0.1", 0))
+    dhcp_client = Client()
+    dhcp_transport, _ = await loop.create_datagram_endpoint(lambda: dhcp_client, local_addr=("127.0.0.1", 0))
+    dns_client = Client()
+    dns_transport, _ = await loop.create_datagram_endpoint(lambda: dns_client, local_addr=("127.0.0.1", 0))
+    config = {
+        "interface": None,
+        "network": "127.0.0.0/24",
+        "server-ip": "127.0.0.1",
+        "leases": {MAC: GUEST_IP},
+        "hostnames": {MAC: "trainer"},
+        "domain": "vm",
+        "upstreams": ["127.0.0.1"],
+        "upstream-port": upstream_transport.get_extra_info("sockname")[1],
+        "dhcp-address": "127.0.0.1",
+        "dhcp-port": free_port(),
+        "dhcp-client-port": dhcp_transport.get_extra_info("sockname")[1],
+        "dhcp-reply-address": "127.0.0.1",
+        "dns-address": "127.0.0.1",
+        "dns-port": free_port(),
+    }
+    ready = asyncio.Event()
+    services = asyncio.ensure_future(run_services(config, ready))
+    try:
+        await asyncio.wait_for(ready.wait(), 5)
+        dhcp_addr = ("127.0.0.1", config["dhcp-port"])
+        offer = DhcpPacket.parse(await exchange(dhcp_transport, dhcp_client, dhcp_request(DHCPDISCOVER, 1), dhcp_addr))
+        request = dhcp_request(DHCPREQUEST, 2, [
+            (OPTION_SERVER_ID, socket.inet_aton("127.0.0.1")),
+            (OPTION_REQUESTED_ADDRESS, socket.inet_aton(GUEST_IP)),
+        ])
+        ack = DhcpPacket.parse(await exchange(dhcp_transport, dhcp_client, request, dhcp_addr))
+        dns_addr = ("127.0.0.1", config["dns-port"])
+        first = await exchange(dns_transport, dns_client, dns_query(0x1111), dns_addr)
+        second = await exchange(dns_transport, dns_client, dns_query(0x2222), dns_addr)
+        return offer, ack, first, second, upstream.queries
+    finally:
+        services.cancel()
+        await asyncio.gather(services, return_exceptions=True)
+        for transport in (upstream_transport, dhcp_transport, dns_transport):
+            transport.close()
+
+
+def test_run_services_answers_dhcp_and_caches_dns():
+    offer, ack, first, second, upstream_queries = asyncio.run(drive_services())
+    assert offer.message_type == DHCPOFFER
+    assert offer.xid == 1
+    assert offer.yiaddr == GUEST_IP
+    assert ack.message_type == DHCPACK
+    assert ack.xid == 2
+    assert ack.yiaddr == GUEST_IP
+    assert struct.unpack_from("!H", first)[0] == 0x1111
+    assert struct.unpack_from("!H", second)[0] == 0x2222
+    # the second lookup is answered from the cache
+    assert len(upstream_queries) == 1
+    assert second[2:].endswith(socket.inet_aton("93.184.216.34"))
@@ -0,0 +1,56 @@
+import os
+
+from vm_trainer.components.netstate import IpTransaction, NetworkState
+from vm_trainer.components.network import TapNetwork
+
+
+def add_interface(root, name, flags="0x1003", tun_flags=None, master=None):
+    device_dir = root.joinpath("devices", "virtual", "net", name)
+    device_dir.mkdir(parents=True)
+    device_dir.joinpath("flags").write_text(flags + "\n")
+    if tun_flags:
+        device_dir.joinpath("tun_flags").write_text(tun_flags + "\n")
+    if master:
+        os.symlink(f"../{master}", device_dir.joinpath("master"))
+    class_dir = root.joinpath("class", "net")
+    class_dir.mkdir(parents=True, exist_ok=True)
+    os.symlink(f"../../devices/virtual/net/{name}", class_dir.joinpath(name))
+
+
+def tap_transaction(root, multi_queue):
+    transaction = IpTransaction()
+    TapNetwork.tap_commands(NetworkState(root), transaction, "vmtrainertap0", "vmtrainerbr0", multi_queue)
+    return transaction
+
+
+def test_multi_queue_tap_is_recreated_for_a_single_queue_launch(tmp_path):
+    add_interface(tmp_path, "vmtrainerbr0")
+    add_interface(tmp_path, "vmtrainertap0", tun_flags="0x1102", master="vmtrainerbr0")
+    transaction = tap_transaction(tmp_path, False)
+    assert transaction.commands() == [
+        "tuntap del dev vmtrainertap0 mode tap multi_queue",
+        "tuntap add dev vmtrainertap0 mode tap",
+        "link set vmtrainertap0 master vmtrainerbr0",
+        "link set vmtrainertap0 up",
+    ]
+    # a rollback brings back the multiqueue tap attached to the bridge
+    assert transaction.undo_commands(len(transaction.commands()))[-3:] == [
+        "tuntap add dev vmtrainertap0 mode tap multi_queue",
+        "link set vmtrainertap0 master vmtrainerbr0",
+        "link set vmtrainertap0 up",
+    ]
+
+
+def test_single_queue_tap_is_recreated_for_a_multi_queue_launch(tmp_path):
+    add_interface(tmp_path, "vmtrainerbr0")
+    add_interface(tmp_path, "vmtrainertap0", tun_flags="0x1002", master="vmtrainerbr0")
+    assert tap_transaction(tmp_path, True).commands()[:2] == [
+        "tuntap del dev vmtrainertap0 mode tap",
+        "tuntap add dev vmtrainertap0 mode tap multi_queue",
+    ]
+
+
+def test_matching_tap_is_kept(tmp_path):
+    add_interface(tmp_path, "vmtrainerbr0")
+    add_interface(tmp_path, "vmtrainertap0", tun_flags="0x1102", master="vmtrainerbr0")
+    assert tap_transaction(tmp_path, True).commands() == []
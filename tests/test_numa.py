@@ -0,0 +1,77 @@
+import pytest
+
+from vm_trainer.components.cpu_topology import CpuPinningPlanner, HostTopology
+from vm_trainer.components.numa import NumaPlacement
+from vm_trainer.exceptions import CommandError
+
+
+def two_node_host(root, cores_per_node=4):
+    # cpu n and cpu n + cores are the two threads of a core, the first half of the cores is on node 0
+    cores = cores_per_node * 2
+    cpu_dir = root.joinpath("devices", "system", "cpu")
+    cpu_dir.mkdir(parents=True)
+    cpu_dir.joinpath("online").write_text(f"0-{cores * 2 - 1}\n")
+    for cpu in range(cores * 2):
+        core = cpu % cores
+        topology_dir = cpu_dir.joinpath(f"cpu{cpu}", "topology")
+        topology_dir.mkdir(parents=True)
+        topology_dir.joinpath("thread_siblings_list").write_text(f"{core},{core + cores}\n")
+        topology_dir.joinpath("physical_package_id").write_text(f"{core // cores_per_node}\n")
+        # one l3 cache per node
+        first = core // cores_per_node * cores_per_node
+        cache_dir = cpu_dir.joinpath(f"cpu{cpu}", "cache", "index3")
+        cache_dir.mkdir(parents=True)
+        cache_dir.joinpath("level").write_text("3\n")
+        cache_dir.joinpath("shared_cpu_list").write_text(
+            f"{first}-{first + cores_per_node - 1},{first + cores}-{first + cores + cores_per_node - 1}\n")
+    for node in range(2):
+        node_dir = root.joinpath("devices", "system", "node", f"node{node}")
+        node_dir.mkdir(parents=True)
+        first, last = node * cores_per_node, (node + 1) * cores_per_node - 1
+        node_dir.joinpath("cpulist").write_text(f"{first}-{last},{first + cores}-{last + cores}\n")
+    return HostTopology(root)
+
+
+def gpu_placement(root, nodes):
+    addresses = []
+    for index, node in enumerate(nodes):
+        address = f"0000:0{index + 1}:00.0"
+        device_dir = root.joinpath("bus", "pci", "devices", address)
+        device_dir.mkdir(parents=True)
+        device_dir.joinpath("numa_node").write_text(f"{node}\n")
+        addresses.append(address)
+    return NumaPlacement(addresses, root)
+
+
+def node_cpus(topology, node):
+    return {cpu for core in topology.cores if core.node_id == node for cpu in core.cpus}
+
+
+def test_each_node_plan_stays_on_its_node(tmp_path):
+    topology = two_node_host(tmp_path)
+    plan = gpu_placement(tmp_path, [0, 1]).cpu_plan(14, topology)
+    assert plan.host_nodes == [0, 1]
+    assert set(plan.vcpu_pins[:7]) <= node_cpus(topology, 0)
+    assert set(plan.vcpu_pins[7:]) <= node_cpus(topology, 1)
+    assert len(set(plan.vcpu_pins)) == 14
+    assert plan.smp_parameter() == "14,sockets=2,dies=1,cores=4,threads=2"
+
+
+def test_emulator_and_iothreads_use_the_cores_left_by_all_nodes(tmp_path):
+    topology = two_node_host(tmp_path)
+    plan = gpu_placement(tmp_path, [0, 1]).cpu_plan(6, topology)
+    assert plan.vcpu_pins == [1, 2, 3, 4, 5, 6]
+    assert plan.emulator_cpus == [0, 8]
+    assert plan.iothread_cpus == [7, 15]
+
+
+def test_node_plan_is_refused_when_the_node_is_too_small(tmp_path):
+    topology = two_node_host(tmp_path)
+    with pytest.raises(CommandError):
+        CpuPinningPlanner(topology).plan(10, [0], strict=True)
+
+
+def test_later_node_plans_skip_the_pinned_cores(tmp_path):
+    topology = two_node_host(tmp_path)
+    plan = CpuPinningPlanner(topology).plan(2, [0], exclude=[0, 1, 2], strict=True)
+    assert plan.vcpu_pins == [3, 11]
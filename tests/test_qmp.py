@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+import pytest
+
+from vm_trainer.components.qmp import QMPClient
+from vm_trainer.exceptions import QMPError
+
+BIG_REPLY_SIZE = 256 * 1024
+
+
+class FakeQmpServer:
+    def __init__(self, socket_path):
+        self._socket_path = str(socket_path)
+        self._server = None
+        self._held = []
+        self.connections = 0
+        self.commands = []
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self.handle, self._socket_path)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @staticmethod
+    def send(writer, message):
+        writer.write(json.dumps(message).encode() + b"\n")
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.send(writer, {"QMP": {"version": {"qemu": {"major": 8, "minor": 2, "micro": 0}}, "capabilities": []}})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                command = message["execute"]
+                self.commands.append(command)
+                if command == "qmp_capabilities":
+                    self.send(writer, {"return": {}})
+                elif command == "hold":
+                    # answered after the next command, the client pairs the replies by id
+                    self._held.append(message["id"])
+                elif command == "release":
+                    self.send(writer, {"return": "released", "id": message["id"]})
+                    for held_id in self._held:
+                        self.send(writer, {"return": "held", "id": held_id})
+                    self._held = []
+                elif command == "stop":
+                    self.send(writer, {"event": "STOP", "data": {}, "timestamp": {"seconds": 0, "microseconds": 0}})
+                    self.send(writer, {"return": {}, "id": message["id"]})
+                elif command == "query-qmp-schema":
+                    self.send(writer, {"return": [{"name": "x" * BIG_REPLY_SIZE}], "id": message["id"]})
+                elif command == "drop":
+                    break
+                else:
+                    self.send(writer, {"error": {"class": "CommandNotFound", "desc": f"The command {command} has not been found"},
+                                       "id": message["id"]})
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def run_with_server(tmp_path, scenario, reconnect=False):
+    async def run():
+        server = FakeQmpServer(tmp_path.joinpath("qmp.sock"))
+        await server.start()
+        client = QMPClient(tmp_path.joinpath("qmp.sock"), reconnect=reconnect)
+        try:
+            await client.connect()
+            return await scenario(server, client)
+        finally:
+            await client.close()
+            await server.stop()
+    return asyncio.run(run())
+
+
+def test_greeting_and_capabilities(tmp_path):
+    async def scenario(server, client):
+        return client.greeting, list(server.commands)
+
+    greeting, commands = run_with_server(tmp_path, scenario)
+    assert greeting["QMP"]["version"]["qemu"]["major"] == 8
+    assert commands == ["qmp_capabilities"]
+
+
+def test_pipelined_replies_are_paired_by_id(tmp_path):
+    async def scenario(server, client):
+        return await client.execute_many(["hold", "release"])
+
+    assert run_with_server(tmp_path, scenario) == ["held", "released"]
+
+
+def test_events_reach_the_subscribers(tmp_path):
+    async def scenario(server, client):
+        stops = client.subscribe(["STOP"])
+        others = client.subscribe(["RESUME"])
+        await client.execute("stop")
+        return await client.wait_event(stops, 1), await client.wait_event(others, 0.1)
+
+    stop, other = run_with_server(tmp_path, scenario)
+    assert stop["event"] == "STOP"
+    assert other is None
+
+
+def test_error_reply_raises(tmp_path):
+    async def scenario(server, client):
+        with pytest.raises(QMPError, match="has not been found"):
+            await client.execute("no-such-command")
+        # the connection stays usable after an error
+        return await client.execute_many(["hold", "release"])
+
+    assert run_with_server(tmp_path, scenario) == ["held", "released"]
+
+
+def test_reply_larger_than_the_default_stream_limit(tmp_path):
+    async def scenario(server, client):
+        return await client.execute("query-qmp-schema")
+
+    assert len(run_with_server(tmp_path, scenario)[0]["name"]) == BIG_REPLY_SIZE
+
+
+def test_reconnect_after_the_connection_dropped(tmp_path):
+    async def scenario(server, client):
+        events = client.subscribe(["QMP_DISCONNECTED"])
+        pending = client.send("drop")
+        with pytest.raises(QMPError):
+            await asyncio.wait_for(pending, 1)
+        disconnected = await client.wait_event(events, 1)
+        result = await client.execute("stop", timeout=5)
+        return disconnected, result, server.connections
+
+    disconnected, result, connections = run_with_server(tmp_path, scenario, reconnect=True)
+    assert disconnected["event"] == "QMP_DISCONNECTED"
+    assert result == {}
+    assert connections == 2
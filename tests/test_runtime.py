@@ -0,0 +1,51 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from vm_trainer.components.runtime import RuntimeRegistry, process_command_line
+from vm_trainer.exceptions import CommandError
+
+
+@pytest.fixture
+def emulator():
+    # stands for a qemu whose launcher was killed
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)",
+                                "-name", "guest=trainer,debug-threads=on"])
+    deadline = time.monotonic() + 5
+    while not process_command_line(process.pid) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    yield process
+    process.kill()
+    process.wait()
+
+
+def orphan_entry(registry, pid):
+    registry.write_entry({
+        "name": "trainer",
+        "launcher-pid": None,
+        "emulator-pid": pid,
+        "started": 0,
+        "tap": "vmtrainertap0",
+        "resources": {"gpus": ["0000:01:00.0"]},
+    })
+
+
+def test_entry_of_a_running_emulator_is_kept(tmp_path, emulator):
+    registry = RuntimeRegistry(tmp_path)
+    orphan_entry(registry, emulator.pid)
+    assert registry.entry("trainer") is not None
+    with pytest.raises(CommandError):
+        registry.acquire("other", {"gpus": ["0000:01:00.0"]})
+    with pytest.raises(CommandError):
+        registry.acquire("trainer", {"gpus": ["0000:01:00.0"]})
+
+
+def test_entry_is_dropped_once_the_emulator_exited(tmp_path, emulator):
+    registry = RuntimeRegistry(tmp_path)
+    orphan_entry(registry, emulator.pid)
+    emulator.kill()
+    emulator.wait()
+    assert registry.entry("trainer") is None
+    assert not registry.entry_path("trainer").exists()
@@ -0,0 +1,105 @@
+import subprocess
+import sys
+import time
+
+from vm_trainer.components.runtime import process_command_line
+from vm_trainer.exceptions import CommandError
+from vm_trainer.scheduler.core import Inventory, Launcher, Scheduler
+from vm_trainer.scheduler.jobs import Job, JobQueue
+from vm_trainer.scheduler.launcher import LOST_EXIT_CODE, MachineLauncher
+
+
+class FakeInventory(Inventory):
+    def __init__(self, gpus):
+        # address -> NUMA node
+        self._gpus = gpus
+
+    def free_gpus(self, busy):
+        return {address: node for address, node in self._gpus.items() if address not in busy}
+
+    def total(self):
+        return len(self._gpus)
+
+
+class FakeLauncher(Launcher):
+    def __init__(self, failing=()):
+        self._failing = failing
+        self.started = []
+
+    def start(self, job, gpus):
+        if job.job_id in self._failing:
+            raise CommandError(f"Could not start the job {job.job_id}")
+        self.started.append((job.job_id, gpus))
+
+    def poll(self, job):
+        return None
+
+
+def scheduler(tmp_path, gpus, launcher=None, grace=100):
+    queue = JobQueue(tmp_path.joinpath("queue.json"))
+    return queue, Scheduler(queue, FakeInventory(gpus), launcher or FakeLauncher(), grace)
+
+
+def test_higher_priority_starts_first(tmp_path):
+    queue, sched = scheduler(tmp_path, {"a": 0})
+    low = queue.submit("tmpl", 1, "train", "alice", 0, now=0)
+    high = queue.submit("tmpl", 1, "train", "bob", 5, now=10)
+    assert sched.schedule(20) == [high]
+    assert low.state == "queued"
+
+
+def test_users_holding_fewer_gpus_go_first(tmp_path):
+    queue, sched = scheduler(tmp_path, {"a": 0, "b": 0})
+    queue.submit("tmpl", 1, "train", "alice", 0, now=0)
+    sched.schedule(1)
+    second = queue.submit("tmpl", 1, "train", "alice", 0, now=2)
+    other = queue.submit("tmpl", 1, "train", "bob", 0, now=3)
+    assert sched.schedule(4) == [other]
+    assert second.state == "queued"
+
+
+def test_small_jobs_backfill_until_the_grace_period(tmp_path):
+    queue, sched = scheduler(tmp_path, {"a": 0, "b": 0}, grace=100)
+    queue.submit("tmpl", 1, "train", "alice", 0, now=0)
+    sched.schedule(0)
+    queue.submit("tmpl", 2, "train", "bob", 0, now=10)
+    small = queue.submit("tmpl", 1, "train", "carol", 0, now=20)
+    assert sched.schedule(50) == [small]
+
+
+def test_blocked_job_keeps_the_gpus_after_the_grace_period(tmp_path):
+    queue, sched = scheduler(tmp_path, {"a": 0, "b": 0}, grace=100)
+    queue.submit("tmpl", 1, "train", "alice", 0, now=0)
+    sched.schedule(0)
+    big = queue.submit("tmpl", 2, "train", "bob", 0, now=10)
+    small = queue.submit("tmpl", 1, "train", "carol", 0, now=20)
+    # the big job waited past the grace period, the free gpu is kept for it
+    assert sched.schedule(200) == []
+    assert big.state == "queued" and small.state == "queued"
+
+
+def test_launch_failure_fails_the_job_and_frees_its_gpus(tmp_path):
+    queue, sched = scheduler(tmp_path, {"a": 0}, FakeLauncher(failing=(1,)))
+    broken = queue.submit("tmpl", 1, "train", "alice", 0, now=0)
+    next_job = queue.submit("tmpl", 1, "train", "bob", 0, now=1)
+    assert sched.schedule(2) == [next_job]
+    assert broken.state == "failed"
+    assert broken.message == "Could not start the job 1"
+    assert next_job.gpus == ["a"]
+
+
+def test_session_process_keeps_an_unregistered_job_running():
+    job = Job.new(1, "tmpl", 1, "train", "alice", 0, 0)
+    # stands for a machine-run started before a scheduler restart
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)", job.instance_name])
+    job.set_pid(process.pid)
+    deadline = time.monotonic() + 5
+    while not process_command_line(process.pid) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    launcher = MachineLauncher(None)
+    try:
+        assert launcher.poll(job) is None
+    finally:
+        process.kill()
+        process.wait()
+    assert launcher.poll(job) == LOST_EXIT_CODE
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from vm_trainer.components.tools import TeeTool
+from vm_trainer.components.vfio import VFIO_DRIVER, VfioBinder
+from vm_trainer.exceptions import CommandError
+
+GPU = "0000:01:00.0"
+GPU_AUDIO = "0000:01:00.1"
+NVME = "0000:02:00.0"
+ROOT_PORT = "0000:00:01.0"
+
+
+class FakeSysfsWriter(TeeTool):
+    # plays the pci core: driver_override, unbind and drivers_probe move the driver links
+    def __init__(self, root, failing=()):
+        self._root = root
+        self._failing = failing
+        self.writes = []
+
+    def link_driver(self, address, driver):
+        os.symlink(f"../../drivers/{driver}", self._root.joinpath("bus", "pci", "devices", address, "driver"))
+
+    def write(self, filepath, value):
+        filepath = str(filepath)
+        self.writes.append((os.path.relpath(filepath, self._root), value))
+        if filepath.endswith("/unbind"):
+            os.unlink(os.path.dirname(os.path.dirname(filepath)) + "/driver")
+        elif filepath.endswith("/drivers_probe"):
+            device_dir = self._root.joinpath("bus", "pci", "devices", value)
+            override = device_dir.joinpath("driver_override").read_text().strip().replace("(null)", "")
+            if device_dir.joinpath("driver").is_symlink():
+                return
+            if override == VFIO_DRIVER and value in self._failing:
+                raise CommandError(f"Could not write '{value}' to {filepath}")
+            driver = override or device_dir.joinpath("original_driver").read_text()
+            self.link_driver(value, driver)
+        elif filepath.endswith(("/remove", "/rescan")):
+            return
+        else:
+            with open(filepath, "w") as fp:
+                fp.write(value)
+
+
+def add_device(root, address, group, class_code, driver):
+    device_dir = root.joinpath("bus", "pci", "devices", address)
+    device_dir.mkdir(parents=True)
+    device_dir.joinpath("class").write_text(f"0x{class_code:06x}\n")
+    device_dir.joinpath("driver_override").write_text("(null)\n")
+    # the driver the fake pci core rebinds to without an override
+    device_dir.joinpath("original_driver").write_text(driver)
+    group_dir = root.joinpath("kernel", "iommu_groups", str(group))
+    group_dir.joinpath("devices").mkdir(parents=True, exist_ok=True)
+    group_dir.joinpath("devices", address).touch()
+    os.symlink(f"../../../../kernel/iommu_groups/{group}", device_dir.joinpath("iommu_group"))
+    os.symlink(f"../../drivers/{driver}", device_dir.joinpath("driver"))
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    root = tmp_path.joinpath("sys")
+    for driver in ("nvidia", "snd_hda_intel", "nvme", "pcieport", VFIO_DRIVER):
+        root.joinpath("bus", "pci", "drivers", driver).mkdir(parents=True)
+    add_device(root, GPU, 1, 0x030000, "nvidia")
+    add_device(root, GPU_AUDIO, 1, 0x040300, "snd_hda_intel")
+    add_device(root, ROOT_PORT, 1, 0x060400, "pcieport")
+    add_device(root, NVME, 2, 0x010802, "nvme")
+    return root
+
+
+def binder(tmp_path, sysfs, failing=()):
+    writer = FakeSysfsWriter(sysfs, failing)
+    return VfioBinder(sysfs, tmp_path.joinpath("vfio-bindings.json"), writer), writer
+
+
+def test_group_with_a_host_device_is_refused(tmp_path, sysfs):
+    vfio, writer = binder(tmp_path, sysfs)
+    with pytest.raises(CommandError, match=GPU_AUDIO):
+        vfio.bind([GPU], "trainer")
+    assert writer.writes == []
+
+
+def test_complete_group_is_bound_and_the_bridge_is_left_alone(tmp_path, sysfs):
+    vfio, _ = binder(tmp_path, sysfs)
+    assert vfio.bind([GPU, GPU_AUDIO], "trainer") == [GPU, GPU_AUDIO]
+    assert vfio.driver(GPU) == VFIO_DRIVER
+    assert vfio.driver(GPU_AUDIO) == VFIO_DRIVER
+    assert vfio.driver(ROOT_PORT) == "pcieport"
+    assert vfio.bound_by("trainer") == [GPU, GPU_AUDIO]
+
+
+def test_partial_failure_rolls_back_the_bound_functions(tmp_path, sysfs):
+    vfio, _ = binder(tmp_path, sysfs, failing=(GPU_AUDIO,))
+    with pytest.raises(CommandError):
+        vfio.bind([GPU, GPU_AUDIO], "trainer")
+    assert vfio.driver(GPU) == "nvidia"
+    assert vfio.driver(GPU_AUDIO) == "snd_hda_intel"
+    assert vfio.bound_by("trainer") == []
+
+
+def test_release_returns_the_devices_to_their_drivers(tmp_path, sysfs):
+    vfio, _ = binder(tmp_path, sysfs)
+    vfio.bind([GPU, GPU_AUDIO], "trainer")
+    vfio.release([GPU, GPU_AUDIO])
+    assert vfio.driver(GPU) == "nvidia"
+    assert vfio.driver(GPU_AUDIO) == "snd_hda_intel"
+    assert vfio.load_state() == {}
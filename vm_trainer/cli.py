@@ -3,7 +3,6 @@ import sys
 
 import click
 
-import vm_trainer.management  # noqa
 from vm_trainer.exceptions import CommandError
 from vm_trainer.management.clickgroup import cli
 
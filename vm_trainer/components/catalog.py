@@ -0,0 +1,111 @@
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from vm_trainer.components.machine import Machine
+from vm_trainer.exceptions import CommandError
+from vm_trainer.settings import Settings
+
+CATALOG_VERSION = 2
+FILTER_RE = re.compile(r"^([a-z0-9-]+)(>=|<=|=)(.*)$")
+SHARED_RESOURCES = ("gpus", "disks")
+# the fields of Machine.summary
+SUMMARY_FIELDS = ("name", "cpus", "memory", "tpm", "gpus", "disks", "usb-device", "nic-model", "mac-address")
+NUMERIC_FIELDS = ("cpus", "memory")
+FILTER_ALIASES = {"gpu": "gpus", "disk": "disks"}
+
+MachineSummary = Dict[str, Any]
+
+
+class MachineFilter:
+    def __init__(self, expression: str) -> None:
+        match = FILTER_RE.match(expression)
+        if not match:
+            raise CommandError(f"Invalid filter {expression}, expected key=value, key>=value or key<=value")
+        key, self._operator, self._value = match.groups()
+        self._key = FILTER_ALIASES.get(key, key)
+        if self._key not in SUMMARY_FIELDS:
+            raise CommandError(f"Unknown filter key {key}, expected one of: {', '.join(sorted(SUMMARY_FIELDS))}")
+        if self._operator != "=" and (self._key not in NUMERIC_FIELDS or not self._value.isdigit()):
+            raise CommandError(f"The filter {key}{self._operator} expects a number, it applies to {', '.join(NUMERIC_FIELDS)}")
+
+    def matches(self, summary: MachineSummary) -> bool:
+        field = summary[self._key]
+        if self._operator == "=":
+            if isinstance(field, list):
+                return self._value in [str(item) for item in field]
+            return str(field).lower() == self._value.lower()
+        if self._operator == ">=":
+            return field >= int(self._value)
+        return field <= int(self._value)
+
+
+class MachineCatalog:
+    def __init__(self, machines_dir: Optional[Path] = None, index_path: Optional[Path] = None) -> None:
+        settings = Settings()
+        self._machines_dir = machines_dir or settings.machines_dir()
+        self._index_path = index_path or settings.machine_index_path()
+        self._disk_directory = str(settings.disk_directory())
+        self._entries: Dict[str, Dict] = {}
+
+    def load_index(self) -> None:
+        try:
+            with open(self._index_path, "r") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            return
+        # the default disk paths depend on the disk directory, a new one invalidates every entry
+        if index.get("version") == CATALOG_VERSION and index.get("disk-directory") == self._disk_directory:
+            self._entries = index.get("machines", {})
+
+    def save_index(self) -> None:
+        temp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump({
+                "version": CATALOG_VERSION,
+                "disk-directory": self._disk_directory,
+                "machines": self._entries,
+            }, fp, separators=(",", ":"))
+        os.replace(temp_path, self._index_path)
+
+    def refresh(self) -> None:
+        self.load_index()
+        changed = False
+        seen = set()
+        with os.scandir(self._machines_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".yaml") or not entry.is_file():
+                    continue
+                name = entry.name[:-5]
+                seen.add(name)
+                stat = entry.stat()
+                cached = self._entries.get(name)
+                if cached and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                    continue
+                self._entries[name] = {
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "summary": Machine(name).summary(),
+                }
+                changed = True
+        for name in set(self._entries) - seen:
+            del self._entries[name]
+            changed = True
+        if changed:
+            self.save_index()
+
+    def machines(self, filters: Optional[List[str]] = None) -> List[MachineSummary]:
+        self.refresh()
+        machine_filters = [MachineFilter(expression) for expression in filters or []]
+        summaries = [self._entries[name]["summary"] for name in sorted(self._entries)]
+        return [summary for summary in summaries if all(item.matches(summary) for item in machine_filters)]
+
+    def conflicts(self) -> List[Tuple[str, str, List[str]]]:
+        owners: Dict[Tuple[str, str], List[str]] = {}
+        for summary in self.machines():
+            for kind in SHARED_RESOURCES:
+                for resource in summary[kind]:
+                    owners.setdefault((kind, str(resource)), []).append(summary["name"])
+        return [(kind, resource, names) for (kind, resource), names in sorted(owners.items()) if len(names) > 1]
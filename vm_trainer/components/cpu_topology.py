@@ -0,0 +1,309 @@
+import os
+import re
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from vm_trainer.components.tools import TasksetTool
+from vm_trainer.exceptions import CommandError
+from vm_trainer.utils import (format_cpu_list, list_process_threads,
+                              parse_cpu_list, read_text_file)
+
+VCPU_THREAD_RE = re.compile(r"CPU ([0-9]+)/KVM")
+IOTHREAD_THREAD_RE = re.compile(r"IO (iothread[0-9a-zA-Z_-]*)")
+
+
+class HostCore:
+    def __init__(self, cpus: List[int], package_id: int, node_id: int, cache_id: Tuple[int, ...]) -> None:
+        self._cpus = sorted(cpus)
+        self._package_id = package_id
+        self._node_id = node_id
+        self._cache_id = cache_id
+
+    @property
+    def cpus(self) -> List[int]:
+        return self._cpus
+
+    @property
+    def package_id(self) -> int:
+        return self._package_id
+
+    @property
+    def node_id(self) -> int:
+        return self._node_id
+
+    @property
+    def cache_id(self) -> Tuple[int, ...]:
+        return self._cache_id
+
+
+class HostTopology:
+    SYSFS_ROOT = "/sys"
+
+    def __init__(self, sysfs_root: Union[str, Path, None] = None) -> None:
+        self._root = Path(sysfs_root or self.SYSFS_ROOT)
+        self._cores: List[HostCore] = []
+        self.load()
+
+    @property
+    def cores(self) -> List[HostCore]:
+        return self._cores
+
+    def cpu_dir(self) -> Path:
+        return self._root.joinpath("devices", "system", "cpu")
+
+    def node_dir(self) -> Path:
+        return self._root.joinpath("devices", "system", "node")
+
+    def online_cpus(self) -> List[int]:
+        online = read_text_file(self.cpu_dir().joinpath("online"))
+        if online:
+            return parse_cpu_list(online)
+        return sorted(
+            int(name[3:]) for name in os.listdir(self.cpu_dir()) if re.fullmatch(r"cpu[0-9]+", name)
+        )
+
+    def cpu_nodes(self) -> Dict[int, int]:
+        nodes: Dict[int, int] = {}
+        if not self.node_dir().exists():
+            return nodes
+        for name in os.listdir(self.node_dir()):
+            if not re.fullmatch(r"node[0-9]+", name):
+                continue
+            for cpu in parse_cpu_list(read_text_file(self.node_dir().joinpath(name, "cpulist"))):
+                nodes[cpu] = int(name[4:])
+        return nodes
+
+    def cpu_cache_id(self, cpu: int) -> Tuple[int, ...]:
+        cache_dir = self.cpu_dir().joinpath(f"cpu{cpu}", "cache")
+        if cache_dir.exists():
+            for index in sorted(os.listdir(cache_dir)):
+                if not index.startswith("index"):
+                    continue
+                if read_text_file(cache_dir.joinpath(index, "level")) != "3":
+                    continue
+                shared = read_text_file(cache_dir.joinpath(index, "shared_cpu_list"))
+                if shared:
+                    return tuple(parse_cpu_list(shared))
+        return (cpu,)
+
+    def load(self) -> None:
+        nodes = self.cpu_nodes()
+        cores: Dict[Tuple[int, ...], HostCore] = {}
+        for cpu in self.online_cpus():
+            topology_dir = self.cpu_dir().joinpath(f"cpu{cpu}", "topology")
+            siblings = read_text_file(topology_dir.joinpath("thread_siblings_list"), str(cpu))
+            key = tuple(parse_cpu_list(siblings))
+            if key in cores:
+                continue
+            package_id = int(read_text_file(topology_dir.joinpath("physical_package_id"), "0"))
+            cores[key] = HostCore(list(key), package_id, nodes.get(cpu, 0), self.cpu_cache_id(cpu))
+        online = set(self.online_cpus())
+        self._cores = []
+        for core in sorted(cores.values(), key=lambda c: c.cpus[0]):
+            # offline siblings are reported in thread_siblings_list, keep only the usable ones
+            cpus = [cpu for cpu in core.cpus if cpu in online]
+            self._cores.append(HostCore(cpus, core.package_id, core.node_id, core.cache_id))
+
+    def cpu_count(self) -> int:
+        return sum(len(core.cpus) for core in self._cores)
+
+    def smt_width(self) -> int:
+        if not self._cores:
+            return 1
+        return min(len(core.cpus) for core in self._cores)
+
+    def node_ids(self) -> List[int]:
+        return sorted(set(core.node_id for core in self._cores))
+
+
+class CpuPlan:
+    def __init__(self, vcpu_pins: List[int], cores: int, threads: int, dies: int,
+                 emulator_cpus: List[int], iothread_cpus: List[int], sockets: int = 1,
+                 host_nodes: Optional[List[int]] = None) -> None:
+        self._vcpu_pins = vcpu_pins
+        self._cores = cores
+        self._threads = threads
+        self._dies = dies
+        self._sockets = sockets
+        self._emulator_cpus = emulator_cpus
+        self._iothread_cpus = iothread_cpus
+        self._host_nodes = host_nodes or []
+
+    @classmethod
+    def combine(cls, plans: List["CpuPlan"], host_nodes: List[int], emulator_cpus: List[int],
+                iothread_cpus: List[int]) -> "CpuPlan":
+        # one guest socket per host NUMA node, the socket shape is taken from the first node
+        first = plans[0]
+        vcpu_pins: List[int] = []
+        for plan in plans:
+            vcpu_pins += plan.vcpu_pins
+        return cls(vcpu_pins, first._cores, first._threads, first._dies, emulator_cpus,
+                   iothread_cpus, sockets=len(plans), host_nodes=host_nodes)
+
+    @property
+    def vcpu_count(self) -> int:
+        return len(self._vcpu_pins)
+
+    @property
+    def vcpu_pins(self) -> List[int]:
+        return self._vcpu_pins
+
+    @property
+    def emulator_cpus(self) -> List[int]:
+        return self._emulator_cpus
+
+    @property
+    def host_nodes(self) -> List[int]:
+        return self._host_nodes
+
+    def socket_vcpus(self, socket: int) -> List[int]:
+        per_socket = self.vcpu_count // self._sockets
+        return list(range(socket * per_socket, (socket + 1) * per_socket))
+
+    @property
+    def iothread_cpus(self) -> List[int]:
+        return self._iothread_cpus
+
+    def smp_parameter(self) -> str:
+        return f"{self.vcpu_count},sockets={self._sockets},dies={self._dies},cores={self._cores},threads={self._threads}"
+
+    def describe(self) -> List[str]:
+        lines = [f"vcpu {index} -> cpu {cpu}" for index, cpu in enumerate(self._vcpu_pins)]
+        lines.append(f"emulator -> cpus {format_cpu_list(self._emulator_cpus)}")
+        lines.append(f"iothreads -> cpus {format_cpu_list(self._iothread_cpus)}")
+        return lines
+
+
+class CpuPinningPlanner:
+    def __init__(self, topology: HostTopology) -> None:
+        self._topology = topology
+
+    def available_cores(self, exclude: Optional[List[int]] = None) -> List[HostCore]:
+        # a core is taken as soon as one of its threads is pinned
+        excluded = set(exclude or [])
+        return [core for core in self._topology.cores if not excluded.intersection(core.cpus)]
+
+    def candidate_cores(self, needed: int, nodes: Optional[List[int]], cores: List[HostCore],
+                        strict: bool = False) -> List[HostCore]:
+        if nodes:
+            node_cores = [core for core in cores if core.node_id in nodes]
+            if len(node_cores) >= needed or strict:
+                return node_cores
+            return cores
+        # stay on a single NUMA node whenever one of them is big enough
+        for node_id in self._topology.node_ids():
+            node_cores = [core for core in cores if core.node_id == node_id]
+            if len(node_cores) > needed:
+                return node_cores
+        return cores
+
+    @staticmethod
+    def group_by_cache(cores: List[HostCore]) -> List[List[HostCore]]:
+        groups: Dict[Tuple[int, ...], List[HostCore]] = {}
+        for core in cores:
+            groups.setdefault(core.cache_id, []).append(core)
+        return list(groups.values())
+
+    @staticmethod
+    def pick_cores(groups: List[List[HostCore]], needed: int) -> List[List[HostCore]]:
+        picked: List[List[HostCore]] = []
+        remaining = sorted(groups, key=lambda g: (-len(g), g[0].cpus[0]))
+        while needed > 0 and remaining:
+            fitting = [g for g in remaining if len(g) >= needed]
+            if fitting:
+                # best fit: the smallest cache domain that holds the rest of the vcpus
+                group = min(fitting, key=lambda g: (len(g), g[0].cpus[0]))
+                picked.append(group[:needed])
+                break
+            group = remaining.pop(0)
+            picked.append(group)
+            needed -= len(group)
+        return picked
+
+    def spare_cpus(self, vcpu_pins: List[int], preferred: List[HostCore]) -> Tuple[List[int], List[int]]:
+        used = set(vcpu_pins)
+        spare = [core for core in preferred if not used.intersection(core.cpus)]
+        spare += [core for core in self._topology.cores if not used.intersection(core.cpus) and core not in spare]
+        if not spare:
+            return sorted(vcpu_pins), sorted(vcpu_pins)
+        return spare[0].cpus, spare[1].cpus if len(spare) > 1 else spare[0].cpus
+
+    def plan(self, vcpus: int, nodes: Optional[List[int]] = None, exclude: Optional[List[int]] = None,
+             strict: bool = False) -> CpuPlan:
+        if vcpus < 1:
+            raise CommandError("Invalid cpu count")
+        available = self.available_cores(exclude)
+        cpu_count = sum(len(core.cpus) for core in available)
+        if vcpus > cpu_count:
+            raise CommandError(f"The host has only {cpu_count} free cpus, {vcpus} were requested")
+
+        smt = self._topology.smt_width()
+        threads = smt if vcpus % smt == 0 else 1
+        needed = vcpus // threads
+        # sharing the sibling threads is the only way to fit a strict plan on its nodes
+        if needed > len(self.candidate_cores(needed, nodes, available, strict)):
+            threads, needed = smt, -(-vcpus // smt)
+
+        candidates = self.candidate_cores(needed, nodes, available, strict)
+        if len(candidates) < needed:
+            raise CommandError(f"The NUMA nodes {nodes} have only {len(candidates)} free cores, {needed} are needed")
+        housekeeping = [core for core in candidates if core.cpus[0] == 0]
+        usable = candidates
+        if housekeeping and len(candidates) > needed:
+            # leave the core running cpu 0 to the host kernel and the emulator
+            usable = [core for core in candidates if core not in housekeeping]
+
+        picked = self.pick_cores(self.group_by_cache(usable), needed)
+        vcpu_cores = [core for group in picked for core in group]
+        if len(vcpu_cores) < needed:
+            raise CommandError("Unable to find enough host cores for the vcpus")
+
+        sizes = set(len(group) for group in picked)
+        dies = len(picked) if len(sizes) == 1 else 1
+
+        vcpu_pins: List[int] = []
+        for core in vcpu_cores:
+            vcpu_pins += core.cpus[:threads]
+        vcpu_pins = vcpu_pins[:vcpus]
+
+        emulator_cpus, iothread_cpus = self.spare_cpus(vcpu_pins, candidates)
+        host_nodes = sorted(set(core.node_id for core in vcpu_cores))
+        return CpuPlan(vcpu_pins, needed // dies, threads, dies, emulator_cpus, iothread_cpus, host_nodes=host_nodes)
+
+
+class CpuPinner:
+    WAIT_TIMEOUT = 30.0
+
+    def __init__(self, plan: CpuPlan) -> None:
+        self._plan = plan
+
+    def classify_threads(self, pid: int) -> Tuple[Dict[int, int], List[int]]:
+        vcpus: Dict[int, int] = {}
+        iothreads: List[int] = []
+        for tid, name in list_process_threads(pid):
+            vcpu_match = VCPU_THREAD_RE.match(name)
+            if vcpu_match:
+                vcpus[int(vcpu_match.group(1))] = tid
+            elif IOTHREAD_THREAD_RE.match(name):
+                iothreads.append(tid)
+        return vcpus, iothreads
+
+    def wait_threads(self, pid: int) -> Tuple[Dict[int, int], List[int]]:
+        deadline = time.monotonic() + self.WAIT_TIMEOUT
+        while True:
+            vcpus, iothreads = self.classify_threads(pid)
+            if len(vcpus) >= self._plan.vcpu_count:
+                return vcpus, iothreads
+            if time.monotonic() > deadline or not os.path.exists(f"/proc/{pid}"):
+                raise CommandError(f"The vcpu threads of the process {pid} were not found")
+            time.sleep(0.1)
+
+    def pin(self, pid: int) -> None:
+        vcpus, iothreads = self.wait_threads(pid)
+        taskset = TasksetTool()
+        taskset.set_affinity(pid, self._plan.emulator_cpus, all_threads=True)
+        for tid in iothreads:
+            taskset.set_affinity(tid, self._plan.iothread_cpus)
+        for index, tid in sorted(vcpus.items()):
+            taskset.set_affinity(tid, [self._plan.vcpu_pins[index]])
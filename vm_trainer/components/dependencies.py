@@ -1,13 +1,15 @@
 import os
 import platform
-import subprocess
 from typing import List, Tuple
 
-from vm_trainer.components.tools import EmulatorTool, IpTablesTool, IpTool
+from vm_trainer.components.probes import PROBE_CACHE
+from vm_trainer.components.tools import (EmulatorTool, IpTablesTool, IpTool,
+                                         ToolBase)
 from vm_trainer.exceptions import CommandError
+from vm_trainer.profiling import profile_phase
 
 StringList = List[str]
-ToolChecklist = List[Tuple[str, str, str]]
+ToolChecklist = List[Tuple[ToolBase, str]]
 PathChecklist = List[Tuple[str, str]]
 
 CURRENT_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -33,12 +35,13 @@ class DependencyManager:
 
     @staticmethod
     def is_processor_compatible() -> bool:
-        count = 0
         with open("/proc/cpuinfo", "r") as fp:
-            for line in fp.readlines():
-                if 'vmx' in line or 'svm' in line:
-                    count += 1
-        return count != 0
+            for line in fp:
+                # every processor reports the same flags, the first flags line is enough
+                if line.startswith("flags"):
+                    flags = line.split(":", 1)[-1].split()
+                    return "vmx" in flags or "svm" in flags
+        return False
 
     @staticmethod
     def has_kvm_device() -> bool:
@@ -46,20 +49,16 @@ class DependencyManager:
 
     @staticmethod
     def have_tool(tool_name: str, do_nothing_parameter: str) -> bool:
-        try:
-            subprocess.check_call([tool_name, do_nothing_parameter])
-            return True
-        except FileNotFoundError:
-            pass
-        return False
+        return PROBE_CACHE.probe(tool_name, {"version": [do_nothing_parameter]}) is not None
 
     @staticmethod
     def get_tool_list() -> ToolChecklist:
         not_found_msg = "is not present in your system."
+        emulator = EmulatorTool()
         return [
-            (DependencyManager.EMULATOR_TOOL, "-version", f"{DependencyManager.EMULATOR_TOOL} {not_found_msg}"),
-            (DependencyManager.IP_TOOL, "-V", f"The {DependencyManager.IP_TOOL} {not_found_msg}"),
-            (DependencyManager.IP_TABLES_TOOL, "--version", f"The {DependencyManager.IP_TABLES_TOOL} {not_found_msg}"),
+            (emulator, f"{emulator.TOOL_NAME} {not_found_msg}"),
+            (IpTool(), f"The {DependencyManager.IP_TOOL} {not_found_msg}"),
+            (IpTablesTool(), f"The {DependencyManager.IP_TABLES_TOOL} {not_found_msg}"),
         ]
 
     @staticmethod
@@ -72,14 +71,14 @@ class DependencyManager:
 
     @staticmethod
     def check_all_tools() -> StringList:
-        tool_errors = []
         tools = DependencyManager.get_tool_list()
-        with open(os.devnull, 'w') as nullfp:
-            for tool in tools:
-                try:
-                    subprocess.check_call([tool[0], tool[1]], stdout=nullfp)
-                except FileNotFoundError:
-                    tool_errors.append(tool[2])
+        # the emulator capabilities are probed together with the versions so the launch runs no probes
+        outputs = PROBE_CACHE.probe_many([(tool.TOOL_NAME, tool.probe_commands()) for tool, _ in tools])
+        tool_errors = [message for (_, message), output in zip(tools, outputs) if output is None]
+        emulator = EmulatorTool()
+        accelerators = emulator.accelerators() if emulator.probe() is not None else []
+        if accelerators and "kvm" not in accelerators:
+            tool_errors.append(f"{emulator.TOOL_NAME} was built without the kvm accelerator.")
         return tool_errors
 
     @staticmethod
@@ -93,14 +92,18 @@ class DependencyManager:
 
     @staticmethod
     def check_all() -> None:
-        if not DependencyManager.id_distro_compatible():
-            raise CommandError("vm_trainer does not support your linux distribution (try using ubuntu or arch-linux)")
-        if not DependencyManager.is_processor_compatible():
-            raise CommandError("Your pocessor does not have virtualization capabilities")
-        tool_errors = DependencyManager.check_all_tools()
+        with profile_phase("dependencies-distro"):
+            if not DependencyManager.id_distro_compatible():
+                raise CommandError("vm_trainer does not support your linux distribution (try using ubuntu or arch-linux)")
+        with profile_phase("dependencies-processor"):
+            if not DependencyManager.is_processor_compatible():
+                raise CommandError("Your pocessor does not have virtualization capabilities")
+        with profile_phase("dependencies-tools"):
+            tool_errors = DependencyManager.check_all_tools()
         if not DependencyManager.has_kvm_device():
             tool_errors = ["Your system does not have kvm device /dev/kvm please install qemu and kvm"] + tool_errors
-        path_errors = DependencyManager.check_all_paths()
+        with profile_phase("dependencies-paths"):
+            path_errors = DependencyManager.check_all_paths()
         error_message = ""
 
         if tool_errors:
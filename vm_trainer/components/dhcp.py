@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import ipaddress
+import socket
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+DHCP_SERVER_PORT = 67
+DHCP_CLIENT_PORT = 68
+MAGIC_COOKIE = b"\x63\x82\x53\x63"
+BOOTP_HEADER = struct.Struct("!BBBBIHH4s4s4s4s16s64s128s")
+BOOTREQUEST = 1
+BOOTREPLY = 2
+BROADCAST_FLAG = 0x8000
+
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+DHCPINFORM = 8
+
+OPTION_PAD = 0
+OPTION_SUBNET_MASK = 1
+OPTION_ROUTER = 3
+OPTION_DNS_SERVERS = 6
+OPTION_HOSTNAME = 12
+OPTION_DOMAIN_NAME = 15
+OPTION_REQUESTED_ADDRESS = 50
+OPTION_LEASE_TIME = 51
+OPTION_MESSAGE_TYPE = 53
+OPTION_SERVER_ID = 54
+OPTION_RENEWAL_TIME = 58
+OPTION_REBINDING_TIME = 59
+OPTION_END = 255
+
+STATIC_LEASE_TIME = 43200
+DYNAMIC_LEASE_TIME = 3600
+# an offered address is held for the client that much before it goes back to the pool
+OFFER_HOLD_TIME = 60
+
+DhcpOptions = Dict[int, bytes]
+
+
+def parse_options(data: bytes) -> DhcpOptions:
+    options: DhcpOptions = {}
+    index = 0
+    while index < len(data):
+        code = data[index]
+        if code == OPTION_END:
+            break
+        if code == OPTION_PAD:
+            index += 1
+            continue
+        if index + 1 >= len(data):
+            break
+        length = data[index + 1]
+        options[code] = data[index + 2:index + 2 + length]
+        index += 2 + length
+    return options
+
+
+def format_options(options: List[Tuple[int, bytes]]) -> bytes:
+    data = b""
+    for code, value in options:
+        data += bytes([code, len(value)]) + value
+    return data + bytes([OPTION_END])
+
+
+def format_mac(chaddr: bytes) -> str:
+    return ":".join(f"{byte:02x}" for byte in chaddr[:6])
+
+
+class DhcpPacket:
+    def __init__(self, fields: Tuple, options: DhcpOptions) -> None:
+        self._fields = fields
+        self._options = options
+
+    @staticmethod
+    def parse(data: bytes) -> Optional["DhcpPacket"]:
+        if len(data) < BOOTP_HEADER.size + len(MAGIC_COOKIE):
+            return None
+        if data[BOOTP_HEADER.size:BOOTP_HEADER.size + 4] != MAGIC_COOKIE:
+            return None
+        fields = BOOTP_HEADER.unpack_from(data)
+        return DhcpPacket(fields, parse_options(data[BOOTP_HEADER.size + 4:]))
+
+    @property
+    def op(self) -> int:
+        return self._fields[0]
+
+    @property
+    def xid(self) -> int:
+        return self._fields[4]
+
+    @property
+    def flags(self) -> int:
+        return self._fields[6]
+
+    @property
+    def ciaddr(self) -> str:
+        return socket.inet_ntoa(self._fields[7])
+
+    @property
+    def yiaddr(self) -> str:
+        return socket.inet_ntoa(self._fields[8])
+
+    @property
+    def giaddr(self) -> bytes:
+        return self._fields[10]
+
+    @property
+    def chaddr(self) -> bytes:
+        return self._fields[11]
+
+    @property
+    def mac(self) -> str:
+        return format_mac(self.chaddr)
+
+    @property
+    def message_type(self) -> Optional[int]:
+        value = self._options.get(OPTION_MESSAGE_TYPE)
+        return value[0] if value else None
+
+    def option_address(self, code: int) -> Optional[str]:
+        value = self._options.get(code)
+        return socket.inet_ntoa(value) if value and len(value) == 4 else None
+
+    def reply(self, message_type: int, yiaddr: str, server_ip: str, options: List[Tuple[int, bytes]]) -> bytes:
+        header = BOOTP_HEADER.pack(
+            BOOTREPLY, 1, 6, 0, self.xid, 0, self.flags,
+            self._fields[7] if message_type == DHCPACK else b"\0" * 4,
+            socket.inet_aton(yiaddr), socket.inet_aton(server_ip), self.giaddr, self.chaddr, b"", b"",
+        )
+        return header + MAGIC_COOKIE + format_options([(OPTION_MESSAGE_TYPE, bytes([message_type]))] + options)
+
+
+def assign_addresses(machines: Dict[str, str], network: str, server_ip: str,
+                     previous: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    # the address of a mac is derived from its hash so it stays the same when machines are added or removed
+    hosts = [str(host) for host in ipaddress.ip_network(network).hosts() if str(host) != server_ip]
+    previous = previous or {}
+    assigned: Dict[str, str] = {}
+    used = set()
+    macs = sorted(set(mac.lower() for mac in machines.values()))
+    for mac in macs:
+        if previous.get(mac) in hosts and previous[mac] not in used:
+            assigned[mac] = previous[mac]
+            used.add(previous[mac])
+    for mac in macs:
+        if mac in assigned:
+            continue
+        address = probe_address(mac, hosts, used)
+        if address:
+            assigned[mac] = address
+            used.add(address)
+    return assigned
+
+
+def probe_address(mac: str, hosts: List[str], used: set) -> Optional[str]:
+    if not hosts:
+        return None
+    start = int(hashlib.sha1(mac.encode()).hexdigest(), 16) % len(hosts)
+    for offset in range(len(hosts)):
+        address = hosts[(start + offset) % len(hosts)]
+        if address not in used:
+            return address
+    return None
+
+
+class DhcpServer:
+    def __init__(self, network: str, server_ip: str, static_leases: Dict[str, str],
+                 hostnames: Optional[Dict[str, str]] = None, dns_servers: Optional[List[str]] = None,
+                 domain: str = "") -> None:
+        self._network = ipaddress.ip_network(network)
+        self._server_ip = server_ip
+        self._static = {mac.lower(): address for mac, address in static_leases.items()}
+        self._hostnames = {mac.lower(): name for mac, name in (hostnames or {}).items()}
+        self._dns_servers = dns_servers if dns_servers is not None else [server_ip]
+        self._domain = domain
+        self._hosts = [str(host) for host in self._network.hosts() if str(host) != server_ip]
+        # mac -> (address, expiry) of the clients without a machine
+        self._dynamic: Dict[str, Tuple[str, float]] = {}
+
+    def lease_time(self, mac: str) -> int:
+        return STATIC_LEASE_TIME if mac in self._static else DYNAMIC_LEASE_TIME
+
+    def address_for(self, mac: str, now: float) -> Optional[str]:
+        if mac in self._static:
+            return self._static[mac]
+        lease = self._dynamic.get(mac)
+        if lease and lease[1] > now:
+            return lease[0]
+        used = set(self._static.values())
+        used |= {address for other, (address, expiry) in self._dynamic.items() if other != mac and expiry > now}
+        return probe_address(mac, self._hosts, used)
+
+    def reply_options(self, mac: str, with_lease: bool) -> List[Tuple[int, bytes]]:
+        options = [
+            (OPTION_SERVER_ID, socket.inet_aton(self._server_ip)),
+            (OPTION_SUBNET_MASK, self._network.netmask.packed),
+            (OPTION_ROUTER, socket.inet_aton(self._server_ip)),
+        ]
+        if self._dns_servers:
+            options.append((OPTION_DNS_SERVERS, b"".join(socket.inet_aton(server) for server in self._dns_servers)))
+        if self._domain:
+            options.append((OPTION_DOMAIN_NAME, self._domain.encode()))
+        if mac in self._hostnames:
+            options.append((OPTION_HOSTNAME, self._hostnames[mac].encode()))
+        if with_lease:
+            lease_time = self.lease_time(mac)
+            options += [
+                (OPTION_LEASE_TIME, struct.pack("!I", lease_time)),
+                (OPTION_RENEWAL_TIME, struct.pack("!I", lease_time // 2)),
+                (OPTION_REBINDING_TIME, struct.pack("!I", lease_time * 7 // 8)),
+            ]
+        return options
+
+    def handle(self, data: bytes, now: Optional[float] = None) -> Optional[bytes]:
+        now = time.time() if now is None else now
+        packet = DhcpPacket.parse(data)
+        if packet is None or packet.op != BOOTREQUEST:
+            return None
+        mac = packet.mac
+        message_type = packet.message_type
+        if message_type == DHCPDISCOVER:
+            address = self.address_for(mac, now)
+            if address is None:
+                return None
+            if mac not in self._static:
+                self._dynamic[mac] = (address, now + OFFER_HOLD_TIME)
+            return packet.reply(DHCPOFFER, address, self._server_ip, self.reply_options(mac, True))
+        if message_type == DHCPREQUEST:
+            server_id = packet.option_address(OPTION_SERVER_ID)
+            if server_id and server_id != self._server_ip:
+                # the client took the offer of another server
+                self._dynamic.pop(mac, None)
+                return None
+            requested = packet.option_address(OPTION_REQUESTED_ADDRESS) or packet.ciaddr
+            address = self.address_for(mac, now)
+            if address is None or requested != address:
+                return packet.reply(DHCPNAK, "0.0.0.0", self._server_ip, [(OPTION_SERVER_ID, socket.inet_aton(self._server_ip))])
+            if mac not in self._static:
+                self._dynamic[mac] = (address, now + DYNAMIC_LEASE_TIME)
+            return packet.reply(DHCPACK, address, self._server_ip, self.reply_options(mac, True))
+        if message_type in (DHCPRELEASE, DHCPDECLINE):
+            self._dynamic.pop(mac, None)
+            return None
+        if message_type == DHCPINFORM:
+            return packet.reply(DHCPACK, "0.0.0.0", self._server_ip, self.reply_options(mac, False))
+        return None
+
+    @staticmethod
+    def reply_destination(data: bytes, reply_address: str) -> str:
+        packet = DhcpPacket.parse(data)
+        # clients without an address can't answer arp, the reply is broadcast on the bridge
+        if packet and packet.ciaddr != "0.0.0.0" and not packet.flags & BROADCAST_FLAG:
+            return packet.ciaddr
+        return reply_address
+
+
+class DhcpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: DhcpServer, reply_address: str, client_port: int) -> None:
+        self._server = server
+        self._reply_address = reply_address
+        self._client_port = client_port
+        self._transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self._transport = transport  # type: ignore
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        reply = self._server.handle(data)
+        if reply is None or self._transport is None:
+            return
+        self._transport.sendto(reply, (DhcpServer.reply_destination(data, self._reply_address), self._client_port))
+
+
+def dhcp_socket(interface: Optional[str], address: str = "0.0.0.0", port: int = DHCP_SERVER_PORT) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if interface:
+        # only the requests arriving on the bridge are answered, the host lan keeps its own dhcp server
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+    sock.bind((address, port))
+    sock.setblocking(False)
+    return sock
+
+
+async def serve_dhcp(server: DhcpServer, interface: Optional[str], address: str = "0.0.0.0",
+                     port: int = DHCP_SERVER_PORT, reply_address: str = "255.255.255.255",
+                     client_port: int = DHCP_CLIENT_PORT) -> asyncio.DatagramTransport:
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DhcpProtocol(server, reply_address, client_port), sock=dhcp_socket(interface, address, port))
+    return transport  # type: ignore
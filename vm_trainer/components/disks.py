@@ -0,0 +1,348 @@
+import json
+import platform
+import re
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from vm_trainer.components.tools import EmulatorTool
+from vm_trainer.exceptions import CommandError
+
+DISK_BUSES = ("virtio-blk", "virtio-scsi", "ide")
+DISK_AIO_MODES = ("io_uring", "native", "threads")
+DISK_IOTHREAD_MODES = ("dedicated", "shared", "vq-mapping")
+
+DEFAULT_DISK_PROFILE = {
+    "bus": "virtio-blk",
+    "aio": "io_uring",
+    "cache-direct": True,
+    "queues": "auto",
+    "iothread": "dedicated",
+}
+# machines created before the disk profiles keep booting from the ide disk they were installed on
+LEGACY_MAIN_DISK_PROFILE = {
+    "bus": "ide",
+    "aio": "threads",
+    "cache-direct": False,
+    "queues": "auto",
+    "iothread": "shared",
+}
+LEGACY_RAW_DISK_PROFILE = {
+    "bus": "virtio-blk",
+    "aio": "threads",
+    "cache-direct": True,
+    "queues": "auto",
+    "iothread": "shared",
+}
+QCOW2_PREALLOCATION_MODES = ("off", "metadata", "falloc")
+QCOW2_PROFILES = {
+    # what qemu-img creates without options
+    "default": {
+        "preallocation": "off",
+        "cluster-size": "64k",
+        "lazy-refcounts": False,
+        "extended-l2": False,
+        "cache-clean-interval": 600,
+    },
+    # large read mostly disks: 2M clusters keep the l2 tables small, the 64k subclusters limit the copy on write
+    "dataset": {
+        "preallocation": "metadata",
+        "cluster-size": "2M",
+        "lazy-refcounts": True,
+        "extended-l2": True,
+        "cache-clean-interval": 900,
+    },
+    "preallocated": {
+        "preallocation": "falloc",
+        "cluster-size": "64k",
+        "lazy-refcounts": True,
+        "extended-l2": False,
+        "cache-clean-interval": 600,
+    },
+}
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_HEADER = struct.Struct(">4sIQIIQIIQQIIQ")
+QCOW2_V3_HEADER = struct.Struct(">QQQII")
+QCOW2_INCOMPAT_EXTENDED_L2 = 1 << 4
+QCOW2_COMPAT_LAZY_REFCOUNTS = 1 << 0
+# the smallest caches qemu accepts, in clusters
+MIN_L2_CACHE_CLUSTERS = 2
+MIN_REFCOUNT_CACHE_CLUSTERS = 4
+SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20}
+KERNEL_VERSION_RE = re.compile(r"([0-9]+)\.([0-9]+)")
+SHARED_IOTHREAD = "iothread0"
+MAX_DISK_QUEUES = 16
+MAX_VQ_MAPPING_IOTHREADS = 4
+
+
+class DiskProfile:
+    def __init__(self, config: Dict) -> None:
+        self._bus = config.get("bus", DEFAULT_DISK_PROFILE["bus"])
+        self._aio = config.get("aio", DEFAULT_DISK_PROFILE["aio"])
+        self._cache_direct = config.get("cache-direct", DEFAULT_DISK_PROFILE["cache-direct"])
+        self._queues = config.get("queues", DEFAULT_DISK_PROFILE["queues"])
+        self._iothread = config.get("iothread", DEFAULT_DISK_PROFILE["iothread"])
+
+    @property
+    def bus(self) -> str:
+        return self._bus
+
+    @property
+    def aio(self) -> str:
+        return self._aio
+
+    @property
+    def cache_direct(self) -> bool:
+        return self._cache_direct
+
+    def to_dict(self) -> Dict:
+        return {
+            "bus": self._bus,
+            "aio": self._aio,
+            "cache-direct": self._cache_direct,
+            "queues": self._queues,
+            "iothread": self._iothread,
+        }
+
+    def num_queues(self, vcpus: int) -> int:
+        if self._queues == "auto":
+            return max(min(vcpus, MAX_DISK_QUEUES), 1)
+        return int(self._queues)
+
+    def device_name(self) -> str:
+        return "virtio-scsi-pci" if self._bus == "virtio-scsi" else "virtio-blk-pci"
+
+    def check_options(self) -> None:
+        if self._bus not in DISK_BUSES:
+            raise CommandError(f"Invalid disk bus {self._bus}, expected one of: {', '.join(DISK_BUSES)}")
+        if self._aio not in DISK_AIO_MODES:
+            raise CommandError(f"Invalid aio mode {self._aio}, expected one of: {', '.join(DISK_AIO_MODES)}")
+        if self._iothread not in DISK_IOTHREAD_MODES:
+            raise CommandError(f"Invalid iothread mode {self._iothread}, expected one of: {', '.join(DISK_IOTHREAD_MODES)}")
+        if self._queues != "auto" and (not str(self._queues).isdigit() or int(self._queues) < 1):
+            raise CommandError(f"Invalid queue count {self._queues}, expected a positive number or auto")
+        if self._aio == "native" and not self._cache_direct:
+            raise CommandError("The native aio mode requires cache-direct")
+        if self._bus == "ide" and self._iothread == "vq-mapping":
+            raise CommandError("The ide bus does not support iothreads")
+
+    def validate(self, emulator: EmulatorTool) -> None:
+        self.check_options()
+        if self._aio == "io_uring":
+            kernel = KERNEL_VERSION_RE.match(platform.release())
+            if kernel and (int(kernel.group(1)), int(kernel.group(2))) < (5, 1):
+                raise CommandError(f"The aio mode io_uring requires linux 5.1 or newer (running {platform.release()})")
+            if emulator.version() < (5, 0, 0):
+                raise CommandError("The aio mode io_uring requires qemu 5.0 or newer")
+        if self._bus == "ide":
+            return
+        device = self.device_name()
+        if device not in emulator.supported_devices():
+            raise CommandError(f"The emulator {emulator.TOOL_NAME} does not support the device {device}")
+        properties = emulator.device_properties(device)
+        queues_property = "num_queues" if self._bus == "virtio-scsi" else "num-queues"
+        if queues_property not in properties:
+            raise CommandError(f"The device {device} does not support multiple queues in this qemu version")
+        if self._iothread == "vq-mapping" and "iothread-vq-mapping" not in properties:
+            raise CommandError(f"The device {device} does not support iothread-vq-mapping in this qemu version (qemu 9.0+)")
+
+    def iothreads(self, disk_id: str, vcpus: int) -> List[str]:
+        if self._bus == "ide" or self._iothread == "shared":
+            return []
+        if self._iothread == "vq-mapping":
+            count = min(self.num_queues(vcpus), MAX_VQ_MAPPING_IOTHREADS)
+            return [f"iothread-{disk_id}-{index}" for index in range(count)]
+        return [f"iothread-{disk_id}"]
+
+    def cache_options(self) -> Dict:
+        return {"direct": self._cache_direct, "no-flush": False}
+
+    def storage_options(self, options: Dict) -> str:
+        options = dict(options)
+        options["aio"] = self._aio
+        options["cache"] = self.cache_options()
+        return json.dumps(options)
+
+    def format_options(self, options: Dict) -> str:
+        options = dict(options)
+        options["cache"] = self.cache_options()
+        return json.dumps(options)
+
+    def device_parameters(self, disk_id: str, drive: str, bus: str, vcpus: int,
+                          bootindex: Union[int, None] = None) -> List[str]:
+        iothreads = self.iothreads(disk_id, vcpus)
+        params: List[str] = []
+        for iothread in iothreads:
+            params += ["-object", f"iothread,id={iothread}"]
+        iothread = iothreads[0] if iothreads else SHARED_IOTHREAD
+        boot = f",bootindex={bootindex}" if bootindex is not None else ""
+        queues = self.num_queues(vcpus)
+
+        if self._bus == "ide":
+            return params + ["-device", f"ide-hd,bus={bus},drive={drive},id={disk_id}{boot}"]
+
+        if self._bus == "virtio-scsi":
+            controller = f"scsi-{disk_id}"
+            return params + [
+                "-device", f"virtio-scsi-pci,id={controller},bus={bus},addr=0x0,num_queues={queues},iothread={iothread}",
+                "-device", f"scsi-hd,bus={controller}.0,channel=0,scsi-id=0,lun=0,drive={drive},id={disk_id}{boot}",
+            ]
+
+        if self._iothread == "vq-mapping":
+            device = {
+                "driver": "virtio-blk-pci",
+                "id": disk_id,
+                "bus": bus,
+                "addr": "0x0",
+                "drive": drive,
+                "num-queues": queues,
+                "write-cache": "on",
+                "iothread-vq-mapping": [{"iothread": name} for name in iothreads],
+            }
+            if bootindex is not None:
+                device["bootindex"] = bootindex
+            return params + ["-device", json.dumps(device)]
+
+        return params + [
+            "-device", f"virtio-blk-pci,bus={bus},addr=0x0,drive={drive},id={disk_id},num-queues={queues},write-cache=on,iothread={iothread}{boot}",
+        ]
+
+
+def parse_size(value: str) -> int:
+    match = re.match(r"^([0-9]+)([kKmM]?)$", str(value))
+    if not match:
+        raise CommandError(f"Invalid size {value}, expected a number of bytes with an optional k or M suffix")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+class Qcow2Profile:
+    def __init__(self, config: Dict) -> None:
+        defaults = QCOW2_PROFILES["default"]
+        self._preallocation = config.get("preallocation", defaults["preallocation"])
+        self._cluster_size = str(config.get("cluster-size", defaults["cluster-size"]))
+        self._lazy_refcounts = config.get("lazy-refcounts", defaults["lazy-refcounts"])
+        self._extended_l2 = config.get("extended-l2", defaults["extended-l2"])
+        self._cache_clean_interval = config.get("cache-clean-interval", defaults["cache-clean-interval"])
+
+    @property
+    def cache_clean_interval(self) -> int:
+        return self._cache_clean_interval
+
+    def to_dict(self) -> Dict:
+        return {
+            "preallocation": self._preallocation,
+            "cluster-size": self._cluster_size,
+            "lazy-refcounts": self._lazy_refcounts,
+            "extended-l2": self._extended_l2,
+            "cache-clean-interval": self._cache_clean_interval,
+        }
+
+    def check_options(self) -> None:
+        if self._preallocation not in QCOW2_PREALLOCATION_MODES:
+            raise CommandError(f"Invalid preallocation {self._preallocation}, expected one of: {', '.join(QCOW2_PREALLOCATION_MODES)}")
+        cluster_size = parse_size(self._cluster_size)
+        if cluster_size < 512 or cluster_size > 2 << 20 or cluster_size & (cluster_size - 1):
+            raise CommandError(f"Invalid cluster size {self._cluster_size}, expected a power of two between 512 and 2M")
+        if self._extended_l2 and cluster_size < 16 << 10:
+            raise CommandError("Extended l2 entries need a cluster size of 16k or more")
+        if int(self._cache_clean_interval) < 0:
+            raise CommandError("The cache clean interval can't be negative")
+
+    def validate(self, emulator: EmulatorTool) -> None:
+        self.check_options()
+        if self._extended_l2 and emulator.version() < (5, 2, 0):
+            raise CommandError("Extended l2 entries require qemu 5.2 or newer")
+
+    def create_options(self) -> str:
+        options = [f"cluster_size={parse_size(self._cluster_size)}", f"preallocation={self._preallocation}"]
+        if self._lazy_refcounts:
+            options.append("lazy_refcounts=on")
+        if self._extended_l2:
+            options.append("extended_l2=on")
+        return ",".join(options)
+
+
+class Qcow2Header:
+    def __init__(self, version: int, cluster_bits: int, virtual_size: int, backing_file: str,
+                 incompatible_features: int, compatible_features: int, refcount_order: int) -> None:
+        self._version = version
+        self._cluster_bits = cluster_bits
+        self._virtual_size = virtual_size
+        self._backing_file = backing_file
+        self._incompatible_features = incompatible_features
+        self._compatible_features = compatible_features
+        self._refcount_order = refcount_order
+
+    @staticmethod
+    def read(filepath: Union[str, Path]) -> "Qcow2Header":
+        # the header is enough to size the caches, qemu-img info would cost a process per launch
+        with open(filepath, "rb") as fp:
+            data = fp.read(QCOW2_HEADER.size + QCOW2_V3_HEADER.size)
+            fields = QCOW2_HEADER.unpack_from(data) if len(data) >= QCOW2_HEADER.size else None
+            if fields is None or fields[0] != QCOW2_MAGIC:
+                raise CommandError(f"The disk {filepath} is not a qcow2 image")
+            version, backing_offset, backing_size, cluster_bits, virtual_size = fields[1:6]
+            incompatible, compatible, refcount_order = 0, 0, 4
+            if version >= 3:
+                incompatible, compatible, _, refcount_order, _ = QCOW2_V3_HEADER.unpack_from(data, QCOW2_HEADER.size)
+            backing_file = ""
+            if backing_offset:
+                fp.seek(backing_offset)
+                backing_file = fp.read(backing_size).decode(errors="replace")
+        return Qcow2Header(version, cluster_bits, virtual_size, backing_file, incompatible, compatible, refcount_order)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def cluster_size(self) -> int:
+        return 1 << self._cluster_bits
+
+    @property
+    def virtual_size(self) -> int:
+        return self._virtual_size
+
+    @property
+    def backing_file(self) -> str:
+        return self._backing_file
+
+    @property
+    def extended_l2(self) -> bool:
+        return bool(self._incompatible_features & QCOW2_INCOMPAT_EXTENDED_L2)
+
+    @property
+    def lazy_refcounts(self) -> bool:
+        return bool(self._compatible_features & QCOW2_COMPAT_LAZY_REFCOUNTS)
+
+    @property
+    def refcount_bits(self) -> int:
+        return 1 << self._refcount_order
+
+    def round_to_clusters(self, size: int, minimum_clusters: int) -> int:
+        clusters = -(-size // self.cluster_size)
+        return max(clusters, minimum_clusters) * self.cluster_size
+
+    def l2_cache_size(self) -> int:
+        # one l2 entry per guest cluster, extended entries carry the subcluster bitmap as well
+        entries = -(-self._virtual_size // self.cluster_size)
+        return self.round_to_clusters(entries * (16 if self.extended_l2 else 8), MIN_L2_CACHE_CLUSTERS)
+
+    def refcount_cache_size(self) -> int:
+        # enough refcount blocks for a fully allocated image, the metadata clusters are left out
+        entries = -(-self._virtual_size // self.cluster_size)
+        return self.round_to_clusters(entries * self.refcount_bits // 8, MIN_REFCOUNT_CACHE_CLUSTERS)
+
+    def cache_options(self, profile: Qcow2Profile) -> Dict:
+        return {
+            "l2-cache-size": self.l2_cache_size(),
+            "refcount-cache-size": self.refcount_cache_size(),
+            "cache-clean-interval": int(profile.cache_clean_interval),
+        }
+
+
+def read_qcow2_header(filepath: Union[str, Path]) -> Optional[Qcow2Header]:
+    try:
+        return Qcow2Header.read(filepath)
+    except (OSError, CommandError):
+        return None
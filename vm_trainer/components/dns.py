@@ -0,0 +1,254 @@
+import asyncio
+import struct
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+DNS_PORT = 53
+DNS_HEADER = struct.Struct("!HHHHHH")
+TYPE_OPT = 41
+TYPE_SOA = 6
+RCODE_MASK = 0x000f
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+TRUNCATED_FLAG = 0x0200
+UPSTREAM_TIMEOUT = 2.0
+CACHE_SIZE = 4096
+# answers without records (NODATA) are kept this long when the authority section has no soa
+DEFAULT_NEGATIVE_TTL = 60
+MAX_CACHE_TTL = 86400
+
+CacheKey = Tuple[bytes, int, int]
+Address = Tuple[str, int]
+
+
+def skip_name(message: bytes, offset: int) -> int:
+    while True:
+        if offset >= len(message):
+            raise ValueError("name outside of the message")
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            # a compression pointer ends the name
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += 1 + length
+
+
+def question_key(message: bytes) -> Optional[CacheKey]:
+    if len(message) < DNS_HEADER.size:
+        return None
+    _, _, questions, _, _, _ = DNS_HEADER.unpack_from(message)
+    if questions != 1:
+        return None
+    try:
+        end = skip_name(message, DNS_HEADER.size)
+    except ValueError:
+        return None
+    if end + 4 > len(message):
+        return None
+    qtype, qclass = struct.unpack_from("!HH", message, end)
+    return message[DNS_HEADER.size:end].lower(), qtype, qclass
+
+
+def record_ttls(message: bytes) -> List[Tuple[int, int, int]]:
+    # (offset of the ttl field, ttl, type) of every answer, authority and additional record
+    _, _, questions, answers, authorities, additionals = DNS_HEADER.unpack_from(message)
+    offset = DNS_HEADER.size
+    for _ in range(questions):
+        offset = skip_name(message, offset) + 4
+    records = []
+    for _ in range(answers + authorities + additionals):
+        offset = skip_name(message, offset)
+        record_type, _, ttl, length = struct.unpack_from("!HHIH", message, offset)
+        records.append((offset + 4, ttl, record_type))
+        offset += 10 + length
+    return records
+
+
+def cache_ttl(message: bytes) -> Optional[int]:
+    _, flags, _, answers, _, _ = DNS_HEADER.unpack_from(message)
+    rcode = flags & RCODE_MASK
+    if flags & TRUNCATED_FLAG or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return None
+    records = [record for record in record_ttls(message) if record[2] != TYPE_OPT]
+    if answers and rcode == RCODE_NOERROR:
+        return min(min(ttl for _, ttl, _ in records), MAX_CACHE_TTL)
+    # negative answers are cached for the soa ttl of the authority section
+    soa_ttls = [ttl for _, ttl, record_type in records if record_type == TYPE_SOA]
+    return min(soa_ttls) if soa_ttls else DEFAULT_NEGATIVE_TTL
+
+
+class DnsCache:
+    def __init__(self, max_entries: int = CACHE_SIZE) -> None:
+        self._max_entries = max_entries
+        # key -> (response, stored at, expires at)
+        self._entries: "OrderedDict[CacheKey, Tuple[bytes, float, float]]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def store(self, key: CacheKey, response: bytes, now: float) -> None:
+        try:
+            ttl = cache_ttl(response)
+        except (ValueError, struct.error):
+            return
+        if not ttl:
+            return
+        self._entries[key] = (response, now, now + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, key: CacheKey, query_id: int, now: float) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None or entry[2] <= now:
+            if entry is not None:
+                del self._entries[key]
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        response, stored, _ = entry
+        elapsed = int(now - stored)
+        data = bytearray(response)
+        struct.pack_into("!H", data, 0, query_id)
+        # the client sees the time left, not the ttl the upstream answered with
+        for offset, ttl, record_type in record_ttls(response):
+            if record_type != TYPE_OPT:
+                struct.pack_into("!I", data, offset, max(ttl - elapsed, 0))
+        return bytes(data)
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, response: asyncio.Future) -> None:
+        self._response = response
+
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        if not self._response.done():
+            self._response.set_result(data)
+
+    def error_received(self, exc: Exception) -> None:
+        if not self._response.done():
+            self._response.set_exception(exc)
+
+
+class DnsForwarder:
+    def __init__(self, upstreams: List[Address], cache: Optional[DnsCache] = None, timeout: float = UPSTREAM_TIMEOUT) -> None:
+        self._upstreams = upstreams
+        self._cache = cache or DnsCache()
+        self._timeout = timeout
+
+    @property
+    def cache(self) -> DnsCache:
+        return self._cache
+
+    async def query_upstream(self, upstream: Address, query: bytes) -> Optional[bytes]:
+        loop = asyncio.get_running_loop()
+        response: asyncio.Future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: UpstreamProtocol(response), remote_addr=upstream)
+        try:
+            transport.sendto(query)
+            data = await asyncio.wait_for(response, self._timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            transport.close()
+        # a late answer to another query of the same socket is not a valid response
+        return data if data[:2] == query[:2] else None
+
+    async def resolve(self, query: bytes) -> Optional[bytes]:
+        key = question_key(query)
+        now = time.monotonic()
+        if key is not None:
+            cached = self._cache.lookup(key, struct.unpack_from("!H", query)[0], now)
+            if cached is not None:
+                return cached
+        for upstream in self._upstreams:
+            response = await self.query_upstream(upstream, query)
+            if response is None:
+                continue
+            if key is not None:
+                self._cache.store(key, response, time.monotonic())
+            return response
+        return None
+
+    async def proxy_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # truncated udp answers make the clients retry over tcp, those queries are passed through uncached
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                query = await reader.readexactly(length)
+                response = await self.query_upstream_tcp(query)
+                if response is None:
+                    break
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def query_upstream_tcp(self, query: bytes) -> Optional[bytes]:
+        for upstream in self._upstreams:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*upstream), self._timeout)
+            except (OSError, asyncio.TimeoutError):
+                continue
+            try:
+                writer.write(struct.pack("!H", len(query)) + query)
+                await writer.drain()
+                length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self._timeout))[0]
+                return await asyncio.wait_for(reader.readexactly(length), self._timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                continue
+            finally:
+                writer.close()
+        return None
+
+
+class DnsProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder: DnsForwarder) -> None:
+        self._forwarder = forwarder
+        self._transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self._transport = transport  # type: ignore
+
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        asyncio.ensure_future(self.answer(data, addr))
+
+    async def answer(self, data: bytes, addr: Address) -> None:
+        response = await self._forwarder.resolve(data)
+        if response is not None and self._transport is not None:
+            self._transport.sendto(response, addr)
+
+
+async def serve_dns(forwarder: DnsForwarder, address: str, port: int = DNS_PORT) -> Tuple[asyncio.DatagramTransport, asyncio.AbstractServer]:
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: DnsProtocol(forwarder), local_addr=(address, port))
+    server = await asyncio.start_server(forwarder.proxy_tcp, address, port)
+    return transport, server  # type: ignore
+
+
+def resolv_conf_nameservers(filepath: str = "/etc/resolv.conf") -> List[str]:
+    servers = []
+    try:
+        with open(filepath, "r") as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    servers.append(fields[1])
+    except OSError:
+        pass
+    return servers
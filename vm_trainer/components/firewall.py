@@ -0,0 +1,242 @@
+import hashlib
+import ipaddress
+import json
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+
+from vm_trainer.exceptions import CommandError
+from vm_trainer.profiling import PROFILER
+from vm_trainer.settings import Settings
+
+FIREWALL_BACKENDS = ("iptables", "nftables")
+NFT_TABLE = "vmtrainer"
+
+CommandArgs = List[str]
+# table -> chain -> rules in the iptables-save form
+ChainRules = Dict[str, Dict[str, List[str]]]
+
+
+def run_command(parameters: CommandArgs, input_text: Optional[str] = None) -> Tuple[int, str, str]:
+    start = time.perf_counter()
+    exit_status = None
+    try:
+        result = subprocess.run(parameters, input=input_text, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        exit_status = result.returncode
+        return result.returncode, result.stdout, result.stderr
+    except OSError as e:
+        return 1, "", str(e)
+    finally:
+        PROFILER.record_command(parameters, start, exit_status)
+
+
+def bridge_subnet(ip_address: str) -> str:
+    return str(ipaddress.ip_interface(ip_address).network)
+
+
+class NatRules:
+    def __init__(self, bridge_interface: str, target_interface: str, subnet: str) -> None:
+        self._bridge = bridge_interface
+        self._target = target_interface
+        self._subnet = subnet
+
+    @staticmethod
+    def forward_chain(bridge_interface: str) -> str:
+        return f"VMT-FWD-{bridge_interface}"
+
+    @staticmethod
+    def nat_chain(bridge_interface: str) -> str:
+        return f"VMT-NAT-{bridge_interface}"
+
+    def chains(self) -> ChainRules:
+        forward = self.forward_chain(self._bridge)
+        nat = self.nat_chain(self._bridge)
+        return {
+            "filter": {forward: [
+                f"-A {forward} -i {self._bridge} -o {self._target} -j ACCEPT",
+                f"-A {forward} -i {self._target} -o {self._bridge} -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+            ]},
+            "nat": {nat: [
+                f"-A {nat} -o {self._target} -j MASQUERADE",
+            ]},
+        }
+
+    def jumps(self) -> ChainRules:
+        forward = self.forward_chain(self._bridge)
+        return {
+            "filter": {"FORWARD": [
+                f"-A FORWARD -i {self._bridge} -j {forward}",
+                f"-A FORWARD -o {self._bridge} -j {forward}",
+            ]},
+            "nat": {"POSTROUTING": [
+                f"-A POSTROUTING -s {self._subnet} -j {self.nat_chain(self._bridge)}",
+            ]},
+        }
+
+    def nft_rules(self) -> Dict[str, List[str]]:
+        return {
+            f"forward-{self._bridge}": [
+                f'iifname "{self._bridge}" oifname "{self._target}" accept',
+                f'iifname "{self._target}" oifname "{self._bridge}" ct state related,established accept',
+            ],
+            f"postrouting-{self._bridge}": [
+                f'ip saddr {self._subnet} oifname "{self._target}" masquerade',
+            ],
+        }
+
+
+def parse_iptables_save(text: str) -> ChainRules:
+    tables: ChainRules = {}
+    table: Dict[str, List[str]] = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            table = tables.setdefault(line[1:], {})
+        elif line.startswith(":"):
+            table.setdefault(line[1:].split()[0], [])
+        elif line.startswith("-A "):
+            table.setdefault(line.split()[1], []).append(line)
+    return tables
+
+
+class Firewall:
+    def install(self, rules: NatRules) -> bool:
+        raise NotImplementedError()
+
+    def remove(self, bridge_interface: str) -> bool:
+        raise NotImplementedError()
+
+
+class IpTablesFirewall(Firewall):
+    def __init__(self, save_command: Optional[CommandArgs] = None, restore_command: Optional[CommandArgs] = None) -> None:
+        self._save_command = save_command or ["sudo", "iptables-save"]
+        self._restore_command = restore_command or ["sudo", "iptables-restore", "--noflush"]
+
+    def current(self) -> ChainRules:
+        return_code, stdout, stderr = run_command(self._save_command)
+        if return_code:
+            raise CommandError(f"Could not read the iptables rules: {stderr.strip()}")
+        return parse_iptables_save(stdout)
+
+    @staticmethod
+    def install_delta(current: ChainRules, rules: NatRules) -> str:
+        lines: List[str] = []
+        jumps = rules.jumps()
+        for table, chains in rules.chains().items():
+            existing = current.get(table, {})
+            table_lines = []
+            for chain, chain_rules in chains.items():
+                if existing.get(chain) != chain_rules:
+                    # with --noflush declaring an existing chain empties it before the rules are added again
+                    table_lines += [f":{chain} - [0:0]"] + chain_rules
+            for chain, jump_rules in jumps[table].items():
+                targets = tuple(f"-j {target}" for target in chains)
+                # jumps left from a previous subnet or target are dropped
+                table_lines += ["-D" + rule[2:] for rule in existing.get(chain, []) if rule.endswith(targets) and rule not in jump_rules]
+                table_lines += [rule for rule in jump_rules if rule not in existing.get(chain, [])]
+            if table_lines:
+                lines += [f"*{table}"] + table_lines + ["COMMIT"]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    @staticmethod
+    def remove_delta(current: ChainRules, bridge_interface: str) -> str:
+        lines: List[str] = []
+        owned = {"filter": NatRules.forward_chain(bridge_interface), "nat": NatRules.nat_chain(bridge_interface)}
+        for table, chain in owned.items():
+            existing = current.get(table, {})
+            table_lines = []
+            # the jumps are found by their target, the nat one also carries the subnet
+            for builtin in ("FORWARD", "POSTROUTING"):
+                table_lines += ["-D" + rule[2:] for rule in existing.get(builtin, []) if rule.endswith(f"-j {chain}")]
+            if chain in existing:
+                table_lines += [f"-F {chain}", f"-X {chain}"]
+            if table_lines:
+                lines += [f"*{table}"] + table_lines + ["COMMIT"]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def restore(self, delta: str) -> None:
+        return_code, _, stderr = run_command(self._restore_command, delta)
+        if return_code:
+            raise CommandError(f"Could not apply the iptables rules: {stderr.strip()}")
+
+    def install(self, rules: NatRules) -> bool:
+        delta = self.install_delta(self.current(), rules)
+        if delta:
+            self.restore(delta)
+        return bool(delta)
+
+    def remove(self, bridge_interface: str) -> bool:
+        delta = self.remove_delta(self.current(), bridge_interface)
+        if delta:
+            self.restore(delta)
+        return bool(delta)
+
+
+class NftablesFirewall(Firewall):
+    CHAIN_HOOKS = {
+        "forward": "type filter hook forward priority filter; policy accept;",
+        "postrouting": "type nat hook postrouting priority srcnat; policy accept;",
+    }
+
+    def __init__(self, nft_command: Optional[CommandArgs] = None) -> None:
+        self._nft_command = nft_command or ["sudo", "nft"]
+
+    def current(self) -> Dict[str, List[str]]:
+        return_code, stdout, _ = run_command(self._nft_command + ["-j", "list", "table", "ip", NFT_TABLE])
+        if return_code:
+            # the table is created by the first install
+            return {}
+        chains: Dict[str, List[str]] = {}
+        for item in json.loads(stdout).get("nftables", []):
+            if "chain" in item:
+                chains.setdefault(item["chain"]["name"], [])
+            elif "rule" in item:
+                chains.setdefault(item["rule"]["chain"], []).append(item["rule"].get("comment", ""))
+        return chains
+
+    @staticmethod
+    def rules_comment(rules: List[str]) -> str:
+        # nft lists rules in its own normalized syntax, the comment tells which rule set a chain holds
+        return "vm-trainer " + hashlib.sha1("\n".join(rules).encode()).hexdigest()[:12]
+
+    def install_script(self, current: Dict[str, List[str]], rules: NatRules) -> str:
+        lines: List[str] = []
+        for chain, chain_rules in rules.nft_rules().items():
+            comment = self.rules_comment(chain_rules)
+            if current.get(chain) == [comment] * len(chain_rules):
+                continue
+            hook = self.CHAIN_HOOKS[chain.split("-", 1)[0]]
+            lines += [
+                f"add chain ip {NFT_TABLE} {chain} {{ {hook} }}",
+                f"flush chain ip {NFT_TABLE} {chain}",
+            ] + [f'add rule ip {NFT_TABLE} {chain} {rule} comment "{comment}"' for rule in chain_rules]
+        if not lines:
+            return ""
+        return "\n".join([f"add table ip {NFT_TABLE}"] + lines) + "\n"
+
+    def apply(self, script: str) -> None:
+        # nft -f applies the whole file as one transaction
+        return_code, _, stderr = run_command(self._nft_command + ["-f", "-"], script)
+        if return_code:
+            raise CommandError(f"Could not apply the nftables rules: {stderr.strip()}")
+
+    def install(self, rules: NatRules) -> bool:
+        script = self.install_script(self.current(), rules)
+        if script:
+            self.apply(script)
+        return bool(script)
+
+    def remove(self, bridge_interface: str) -> bool:
+        current = self.current()
+        chains = [chain for chain in (f"forward-{bridge_interface}", f"postrouting-{bridge_interface}") if chain in current]
+        if chains:
+            self.apply("\n".join(f"delete chain ip {NFT_TABLE} {chain}" for chain in chains) + "\n")
+        return bool(chains)
+
+
+def firewall(backend: Optional[str] = None) -> Firewall:
+    backend = backend or Settings().firewall_backend()
+    if backend == "nftables":
+        return NftablesFirewall()
+    return IpTablesFirewall()
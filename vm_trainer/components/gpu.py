@@ -0,0 +1,83 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from vm_trainer.components.pci import PciDevice, PciScanner
+
+DISPLAY_CLASS_CODES = (0x0300, 0x0302)
+COMPANION_ROLES = {
+    0x0403: "audio",
+    0x0c03: "usb",
+    0x0c80: "ucsi",
+}
+
+
+def function_role(device: PciDevice) -> str:
+    class_id = device.class_code >> 8
+    if class_id in DISPLAY_CLASS_CODES:
+        return "video"
+    return COMPANION_ROLES.get(class_id, "other")
+
+
+class GPU:
+    def __init__(self, video: PciDevice, companions: List[PciDevice], description: str) -> None:
+        self._video = video
+        self._companions = companions
+        self._description = description
+
+    @property
+    def description(self) -> str:
+        return self._description
+
+    @property
+    def video_address(self) -> str:
+        return self._video.address
+
+    @property
+    def audio_address(self) -> str:
+        for device in self._companions:
+            if function_role(device) == "audio":
+                return device.address
+        return ""
+
+    @property
+    def numa_node(self) -> int:
+        return self._video.numa_node
+
+    def functions(self) -> List[PciDevice]:
+        return [self._video] + self._companions
+
+    def to_dict(self) -> Dict:
+        item: Dict = {
+            "video": {"address": self.video_address},
+            "functions": [{"address": device.address, "role": function_role(device)} for device in self.functions()],
+        }
+        if self.audio_address:
+            item["audio"] = {"address": self.audio_address}
+        return item
+
+
+def gpu_functions(gpu: Dict) -> List[Dict]:
+    if gpu.get("functions"):
+        return gpu["functions"]
+    # machines configured before the companion functions were tracked only have video and audio
+    functions = [{"address": gpu["video"]["address"], "role": "video"}]
+    if gpu.get("audio"):
+        functions.append({"address": gpu["audio"]["address"], "role": "audio"})
+    return functions
+
+
+def discover_gpus(sysfs_root: Union[str, Path, None] = None, scanner: Optional[PciScanner] = None) -> List[GPU]:
+    scanner = scanner or PciScanner(sysfs_root)
+    slots: Dict[str, List[PciDevice]] = {}
+    for device in scanner.iommu_devices():
+        # every function of a bus:slot belongs to the same physical card
+        slots.setdefault(device.address.rsplit(".", 1)[0], []).append(device)
+    gpus = []
+    for slot in sorted(slots):
+        functions = sorted(slots[slot], key=lambda device: device.address)
+        videos = [device for device in functions if function_role(device) == "video"]
+        if not videos:
+            continue
+        companions = [device for device in functions if device is not videos[0]]
+        gpus.append(GPU(videos[0], companions, videos[0].lspci_line(scanner.pci_ids)))
+    return gpus
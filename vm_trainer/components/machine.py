@@ -1,19 +1,47 @@
+import copy
 import os
 import random
+import time
+from getpass import getuser
 from pathlib import Path
-from typing import List, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 from uuid import uuid4
 
 import click
-import yaml
 
-from vm_trainer.components.network import TapNetwork
-from vm_trainer.components.tools import EmulatorTool
+from vm_trainer.components.cpu_topology import CpuPinner, CpuPlan, HostTopology
+from vm_trainer.components.disks import (DEFAULT_DISK_PROFILE,
+                                         LEGACY_MAIN_DISK_PROFILE,
+                                         LEGACY_RAW_DISK_PROFILE,
+                                         SHARED_IOTHREAD, DiskProfile,
+                                         Qcow2Profile, read_qcow2_header)
+from vm_trainer.components.gpu import discover_gpus, gpu_functions
+from vm_trainer.components.memory import (HUGE_PAGE_SIZES, MEMORY_BACKENDS,
+                                          MemoryBackend)
+from vm_trainer.components.network import (MACVTAP_INTERFACE_PREFIX,
+                                           MAX_NET_QUEUES, NETWORK_MODES,
+                                           NIC_MODELS, MacvtapNetwork,
+                                           SriovFunction, TapNetwork)
+from vm_trainer.components.numa import NumaPlacement
+from vm_trainer.components.pci import (OVMF_DEFAULT_MMIO64_MB, PciScanner,
+                                       host_physical_address_bits,
+                                       mmio64_window_mb)
+from vm_trainer.components.pci_slots import PciSlotAllocator
+from vm_trainer.components.runtime import (TAP_INTERFACE_PREFIX, MachineLease,
+                                           MachineResources, RuntimeEntry,
+                                           RuntimeRegistry)
+from vm_trainer.components.tools import EmulatorTool, IpTool, ToolBase
 from vm_trainer.components.user_input import UserInput
+from vm_trainer.components.vfio import VfioBinder
 from vm_trainer.exceptions import CommandError
-from vm_trainer.settings import Settings
-from vm_trainer.utils import create_qcow_disk, gpus_from_iommu_devices
+from vm_trainer.profiling import profile_phase
+from vm_trainer.settings import Settings, load_yaml_file, save_yaml_file
+from vm_trainer.utils import (create_qcow_disk, create_qcow_overlay,
+                              find_descendant_process)
 
+if TYPE_CHECKING:
+    from vm_trainer.components.qmp import MachineMonitor
+    from vm_trainer.components.telemetry import MachineSampler
 
 CURRENT_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 BIOS_FILE_PATH = os.path.join(CURRENT_MODULE_DIR, "..", "bios", "OVMF_CODE.fd")
@@ -42,6 +70,7 @@ class Machine(object):
 
     def __init__(self, name: str) -> None:
         self._name: str = name
+        self._lease: Optional[MachineLease] = None
         self._settings: dict
         self._settings = {
             "uuid": str(uuid4()),
@@ -53,7 +82,18 @@ class Machine(object):
             "memory": 512,
             "disk-size": 20000,
             "custom-disk": None,
-            "usb-device": ""
+            "usb-device": "",
+            "cpu-pinning": True,
+            "nic-model": "virtio",
+            "disk-profiles": {
+                "main": dict(DEFAULT_DISK_PROFILE),
+            },
+            "memory-backend": {
+                "backend": "default",
+                "page-size": "2M",
+                "fallback": True,
+                "share": False,
+            },
         }
         if self.exists():
             self.load_settings()
@@ -66,17 +106,16 @@ class Machine(object):
             raise CommandError(f"The Machine {self._name} does not exist")
 
     def load_settings(self) -> None:
-        if self.config_path().exists():
-            with open(self.config_path(), "r") as fp:
-                self._settings = yaml.load(fp, Loader=yaml.Loader)["machine"]
+        data = load_yaml_file(self.config_path())
+        if data is not None:
+            self._settings = data["machine"]
 
     def config_path(self) -> Path:
         settings = Settings()
         return settings.machines_dir().joinpath(f"{self._name}.yaml")
 
     def save(self) -> None:
-        with open(self.config_path(), "w") as fp:
-            yaml.dump({"machine": self._settings}, fp, Dumper=yaml.Dumper)
+        save_yaml_file(self.config_path(), {"machine": self._settings})
 
     def check_requirements(self) -> None:
         self.must_exists()
@@ -115,79 +154,170 @@ class Machine(object):
     def set_usb_device(self, address: str) -> None:
         self._settings["usb-device"] = address
 
-    def exec_parameters_pci_slots(self) -> List[str]:
-        return [
-            "-device", "pcie-root-port,port=0x10,chassis=1,id=pci.1,bus=pcie.0,multifunction=on,addr=0x2",
-            "-device", "pcie-root-port,port=0x11,chassis=2,id=pci.2,bus=pcie.0,addr=0x2.0x1",
-            "-device", "pcie-root-port,port=0x12,chassis=3,id=pci.3,bus=pcie.0,addr=0x2.0x2",
-            "-device", "pcie-root-port,port=0x13,chassis=4,id=pci.4,bus=pcie.0,addr=0x2.0x3",
-            "-device", "pcie-root-port,port=0x14,chassis=5,id=pci.5,bus=pcie.0,addr=0x2.0x4",
-            "-device", "pcie-root-port,port=0x15,chassis=6,id=pci.6,bus=pcie.0,addr=0x2.0x5",
-            "-device", "pcie-root-port,port=0x16,chassis=7,id=pci.7,bus=pcie.0,addr=0x2.0x6",
-            "-device", "pcie-root-port,port=0x17,chassis=8,id=pci.8,bus=pcie.0,addr=0x2.0x7",
-            "-device", "pcie-root-port,port=0x18,chassis=9,id=pci.9,bus=pcie.0,addr=0x3.0x1",
-            "-device", "pcie-root-port,port=0x19,chassis=10,id=pci.10,bus=pcie.0,addr=0x3.0x2",
-            "-device", "pcie-root-port,port=0x20,chassis=11,id=pci.12,bus=pcie.0,addr=0x3.0x3",
-            "-device", "pcie-root-port,port=0x21,chassis=12,id=pci.13,bus=pcie.0,addr=0x3.0x4",
-            "-device", "pcie-pci-bridge,id=pci.11,bus=pci.1,addr=0x0",
-        ]
+    def vcpu_count(self) -> int:
+        if self._settings["cpus"] > 0:
+            return self._settings["cpus"]
+        return HostTopology().cpu_count()
+
+    def gpu_addresses(self) -> List[str]:
+        return [gpu["video"]["address"] for gpu in self._settings.get("gpus") or []]
+
+    def gpu_function_addresses(self) -> List[str]:
+        return [item["address"] for gpu in self._settings.get("gpus") or [] for item in gpu_functions(gpu)]
 
-    def exec_parameters_inputs(self) -> List[str]:
+    def passthrough_addresses(self) -> List[str]:
+        addresses = self.gpu_function_addresses()
+        if self.network_mode() == "sriov":
+            addresses.append(self._settings["network-vf"])
+        return addresses
+
+    def bind_gpus(self, addresses: Optional[List[str]] = None) -> List[str]:
+        addresses = self.gpu_function_addresses() if addresses is None else addresses
+        if not addresses:
+            return []
+        return VfioBinder().bind(addresses, self._name)
+
+    def release_gpus(self, addresses: Optional[List[str]] = None) -> None:
+        VfioBinder().release(self.gpu_function_addresses() if addresses is None else addresses)
+
+    def numa_placement(self) -> NumaPlacement:
+        return NumaPlacement(self.gpu_addresses())
+
+    def cpu_plan(self) -> Optional[CpuPlan]:
+        if not self._settings.get("cpu-pinning"):
+            return None
+        return self.numa_placement().cpu_plan(self.vcpu_count(), HostTopology())
+
+    def exec_parameters_cpu(self, cpu_plan: Optional[CpuPlan]) -> List[str]:
+        if cpu_plan:
+            return ["-smp", cpu_plan.smp_parameter()]
+        cpus = self.vcpu_count()
+        threads = self._settings.get("cpus-threads", 1)
+        return ["-smp", f"{cpus * threads},sockets=1,dies=1,cores={cpus},threads={threads}"]
+
+    def pci_slots(self, memory: MemoryBackend) -> PciSlotAllocator:
+        guest_numa_nodes = {}
+        if len(memory.regions) > 1:
+            # each guest NUMA node gets a pcie expander bus so the gpus show up on the node of their memory
+            guest_numa_nodes = {region.host_nodes[0]: index for index, region in enumerate(memory.regions) if region.host_nodes}
+        return PciSlotAllocator(guest_numa_nodes)
+
+    def exec_parameters_inputs(self, slots: PciSlotAllocator) -> List[str]:
         params = []
         if self._settings.get("evdev-mouse"):
             params += [
                 "-object", f"input-linux,id=mouse1,evdev={self._settings['evdev-mouse']}",
-                "-device", "virtio-mouse-pci,id=input0,bus=pci.12,addr=0x4",
+                "-device", f"virtio-mouse-pci,id=input0,bus={slots.root_port('input0')},addr=0x0",
             ]
         if self._settings.get("evdev-keyboard"):
             params += [
                 "-object", f"input-linux,id=kbd1,evdev={self._settings['evdev-keyboard']},grab_all=on,repeat=on",
-                "-device", "virtio-keyboard-pci,id=input1,serial=virtio-keyboard",
+                "-device", f"virtio-keyboard-pci,id=input1,serial=virtio-keyboard,bus={slots.root_port('input1')},addr=0x0",
             ]
         return params
 
-    def exec_parameters_gpus(self) -> List[str]:
+    def exec_parameters_gpus(self, slots: PciSlotAllocator) -> List[str]:
         if not self._settings.get("gpus"):
             return [
                 # "-display", "-curses",
                 "-serial", "mon:stdio",
             ]
         params = []
-        pci_bus = {0: ("pci.4", "pci.5"), 1: ("pci.2", "pci.3")}
+        numa = self.numa_placement()
+        link_options = self.root_port_supports_link_options()
         gpu: dict
         for index, gpu in enumerate(self._settings["gpus"]):
-            if index > 1:
-                click.echo("Currently able to configure two gpus")
-                break
-            params += [
-                "-device", f"vfio-pci,host={gpu['video']['address']},id=hostdev0,bus={pci_bus[index][0]},addr=0x0",
-                "-device", f"vfio-pci,host={gpu['audio']['address']},id=hostdev1,bus={pci_bus[index][1]},addr=0x0",
-            ]
+            functions = gpu_functions(gpu)
+            options = ""
+            link = PciScanner().link(functions[0]["address"]) if link_options else None
+            if link:
+                # the guest driver sees the same link as the host instead of the root port default
+                options = link.root_port_options()
+            port = slots.root_port(f"hostdev{index}", numa.gpu_node(functions[0]["address"]), options)
+            # the companion functions share the root port of the card as functions of one multifunction device
+            for function, item in enumerate(functions):
+                multifunction = ",multifunction=on" if function == 0 and len(functions) > 1 else ""
+                params += [
+                    "-device", f"vfio-pci,host={item['address']},id=hostdev{index}-{function},bus={port},addr=0x0.0x{function:x}{multifunction}",
+                ]
         return params
 
-    def exec_parameters_disks(self) -> List[str]:
+    @staticmethod
+    def root_port_supports_link_options() -> bool:
+        properties = EmulatorTool().device_properties("pcie-root-port")
+        return "x-speed" in properties and "x-width" in properties
+
+    def disk_profile(self, disk: str) -> DiskProfile:
+        profiles = self._settings.get("disk-profiles", {})
+        if disk in profiles:
+            return DiskProfile(profiles[disk])
+        if disk == "main":
+            return DiskProfile(LEGACY_MAIN_DISK_PROFILE)
+        return DiskProfile(LEGACY_RAW_DISK_PROFILE)
+
+    def disk_names(self) -> List[str]:
+        return ["main"] + [f"raw-disk{number}" for number in range(1, 3) if f"raw-disk{number}" in self._settings]
+
+    def validate_disk_profiles(self) -> None:
+        emulator = EmulatorTool()
+        for disk in self.disk_names():
+            try:
+                self.disk_profile(disk).validate(emulator)
+            except CommandError as e:
+                raise CommandError(f"Invalid io profile for the disk {disk}: {e.args[0]}")
+
+    def qcow2_profile(self) -> Qcow2Profile:
+        return Qcow2Profile(self._settings.get("qcow2-profile", {}))
+
+    def set_qcow2_profile(self, profile: Qcow2Profile) -> None:
+        profile.validate(EmulatorTool())
+        self._settings["qcow2-profile"] = profile.to_dict()
+
+    def qcow2_format_options(self, disk_path: Union[str, Path]) -> dict:
+        options = {"node-name": "libvirt-3-format", "read-only": False, "driver": "qcow2", "file": "libvirt-3-storage"}
+        header = read_qcow2_header(disk_path)
+        if header is None:
+            options["backing"] = None
+            return options
+        # the l2 cache covers the whole disk so random reads never go back to the image for metadata
+        options.update(header.cache_options(self.qcow2_profile()))
+        if not header.backing_file:
+            options["backing"] = None
+        return options
+
+    def exec_parameters_disks(self, slots: PciSlotAllocator) -> List[str]:
         disk_path = self.get_disk_path()
+        vcpus = self.vcpu_count()
+        profile = self.disk_profile("main")
         params = [
-             '-object', 'iothread,id=iothread0',
-             "-blockdev", '{"driver":"file","filename":"%s","node-name":"libvirt-3-storage","auto-read-only":true,"discard":"unmap","aio":"threads"}' % disk_path,
-             "-blockdev", '{"node-name":"libvirt-3-format","read-only":false,"driver":"qcow2","file":"libvirt-3-storage","backing":null}',
-             "-device", "ide-hd,bus=ide.0,drive=libvirt-3-format,id=sata0-0-0,bootindex=1",
+             '-object', f'iothread,id={SHARED_IOTHREAD}',
+             "-blockdev", profile.storage_options({"driver": "file", "filename": str(disk_path), "node-name": "libvirt-3-storage", "auto-read-only": True, "discard": "unmap"}),
+             "-blockdev", profile.format_options(self.qcow2_format_options(disk_path)),
         ]
+        if profile.bus == "ide":
+            params += profile.device_parameters("sata0-0-0", "libvirt-3-format", "ide.0", vcpus, bootindex=1)
+        else:
+            params += profile.device_parameters("virtio-disk0", "libvirt-3-format", slots.root_port("virtio-disk0"), vcpus, bootindex=1)
         for disk_number in range(1, 3):
             name = f"raw-disk{disk_number}"
             if name in self._settings:
                 device_name = self._settings[name]
+                profile = self.disk_profile(name)
                 params += [
-                    "-blockdev", '{"driver":"host_device","filename":"%s","node-name":"libvirt-%s-storage","cache":{"direct":true,"no-flush":false},"auto-read-only":true,"discard":"unmap"}' % (
-                        device_name, disk_number
-                    ),
-                    "-blockdev", '{"node-name":"libvirt-%s-format","read-only":false,"cache":{"direct":true,"no-flush":false},"driver":"raw","file":"libvirt-%s-storage"}' % (
-                        disk_number, disk_number
-                    ),
-                    "-device", f"virtio-blk-pci,bus=pci.{6 + disk_number},addr=0x0,drive=libvirt-{disk_number}-format,id=virtio-disk{1 + disk_number},write-cache=on,iothread=iothread0",
+                    "-blockdev", profile.storage_options({"driver": "host_device", "filename": device_name, "node-name": f"libvirt-{disk_number}-storage", "auto-read-only": True, "discard": "unmap"}),
+                    "-blockdev", profile.format_options({"node-name": f"libvirt-{disk_number}-format", "read-only": False, "driver": "raw", "file": f"libvirt-{disk_number}-storage"}),
                 ]
+                disk_id = f"virtio-disk{1 + disk_number}"
+                params += profile.device_parameters(disk_id, f"libvirt-{disk_number}-format", slots.root_port(disk_id), vcpus)
         return params
 
+    def set_disk_profile(self, disk: str, profile: DiskProfile) -> None:
+        if disk not in self.disk_names():
+            raise CommandError(f"The machine has no disk named {disk}, expected one of: {', '.join(self.disk_names())}")
+        profile.validate(EmulatorTool())
+        profiles = self._settings.setdefault("disk-profiles", {})
+        profiles[disk] = profile.to_dict()
+
     def exec_parameters_tpm(self) -> List[str]:
         #-tpmdev passthrough,id=tpm0,path=/dev/tpm0 \
         #-device tpm-tis,tpmdev=tpm0 test.img
@@ -203,18 +333,141 @@ class Machine(object):
             '-device', 'tpm-tis,tpmdev=tpm0',
         ]
 
-    def exec_parameters_scream(self) -> List[str]:
+    def exec_parameters_scream(self, slots: PciSlotAllocator) -> List[str]:
         if os.path.exists("/dev/shm/scream-ivshmem"):
             return ["-object", "memory-backend-file,id=shmmem-shmem0,mem-path=/dev/shm/scream-ivshmem,size=2097152,share=yes",
-                    "-device", "ivshmem-plain,id=shmem0,memdev=shmmem-shmem0,bus=pci.11,addr=0x2"]
+                    "-device", f"ivshmem-plain,id=shmem0,memdev=shmmem-shmem0,{slots.bridge_slot()}"]
         return []
 
-    def exec_parameters_network(self) -> List[str]:
+    def nic_model(self) -> str:
+        return self._settings.get("nic-model", "e1000e")
+
+    def network_queues(self) -> int:
+        if self.nic_model() != "virtio":
+            return 1
+        return max(min(self.vcpu_count(), MAX_NET_QUEUES), 1)
+
+    def tap_interface(self) -> str:
+        if self._lease:
+            return self._lease.tap_interface
+        entry = self.running_entry()
+        return entry.tap_interface if entry else TapNetwork.TAP_INTERFACE_NAME
+
+    def network_mode(self) -> str:
+        return self._settings.get("network-mode", "nat")
+
+    def set_network_mode(self, mode: str, vf_address: Optional[str] = None) -> None:
+        if mode not in NETWORK_MODES:
+            raise CommandError(f"Invalid network mode {mode}, expected one of: {', '.join(NETWORK_MODES)}")
+        if mode == "sriov":
+            if not vf_address:
+                raise CommandError("The sriov network mode needs the pci address of a virtual function")
+            SriovFunction(vf_address).physical_function()
+            self._settings["network-vf"] = vf_address
+        else:
+            self._settings.pop("network-vf", None)
+        self._settings["network-mode"] = mode
+
+    def macvtap_interface(self) -> str:
+        return self.tap_interface().replace(TAP_INTERFACE_PREFIX, MACVTAP_INTERFACE_PREFIX, 1)
+
+    def host_network_interface(self) -> str:
+        if self.network_mode().startswith("macvtap"):
+            return self.macvtap_interface()
+        return self.tap_interface()
+
+    def network_fds(self) -> Dict[int, str]:
+        if not self.network_mode().startswith("macvtap"):
+            return {}
+        return MacvtapNetwork.queue_fds(self.macvtap_interface(), self.network_queues())
+
+    def add_network(self, settings: Settings) -> None:
+        mode = self.network_mode()
+        if mode == "sriov":
+            SriovFunction(self._settings["network-vf"]).set_mac_address(self._settings["mac-address"])
+        elif mode == "nat":
+            TapNetwork.add_tap_network(settings.network_interface(), settings.network_ip(), self.network_queues() > 1, self.tap_interface())
+        else:
+            MacvtapNetwork.add_macvtap(settings.network_interface(), self.macvtap_interface(), mode.split("-", 1)[1],
+                                       self._settings["mac-address"])
+
+    def remove_network(self) -> None:
+        mode = self.network_mode()
+        # the default tap is kept like before, the taps of concurrent machines are removed
+        if mode == "nat" and self.tap_interface() != TapNetwork.TAP_INTERFACE_NAME:
+            IpTool().remove_tap_interface(self.tap_interface())
+        elif mode.startswith("macvtap"):
+            MacvtapNetwork.remove_macvtap(self.macvtap_interface())
+
+    def exec_parameters_network(self, slots: PciSlotAllocator) -> List[str]:
+        port = slots.root_port("net0")
+        if self.network_mode() == "sriov":
+            # the virtual function is the guest nic, its mac address is set through the physical function
+            return ["-device", f"vfio-pci,host={self._settings['network-vf']},id=net0,bus={port},addr=0x0"]
+        fds = sorted(self.network_fds())
+        if len(fds) == 1:
+            netdev = f"tap,id=hostnet0,fd={fds[0]}"
+        elif fds:
+            netdev = f"tap,id=hostnet0,fds={':'.join(str(fd) for fd in fds)}"
+        else:
+            netdev = f"tap,id=hostnet0,ifname={self.tap_interface()},script=no,downscript=no"
+        if self.nic_model() != "virtio":
+            return [
+                "-netdev", netdev,
+                "-device", f"e1000e,netdev=hostnet0,id=net0,mac={self._settings['mac-address']},bus={port},addr=0x0",
+            ]
+        if TapNetwork.vhost_net_available():
+            netdev += ",vhost=on"
+        else:
+            click.echo("/dev/vhost-net not found, the network packets will be processed by qemu (modprobe vhost_net)")
+        device = f"virtio-net-pci,netdev=hostnet0,id=net0,mac={self._settings['mac-address']},bus={port},addr=0x0"
+        queues = self.network_queues()
+        if queues > 1:
+            if not fds:
+                # with descriptors qemu takes one queue per descriptor
+                netdev += f",queues={queues}"
+            # one rx and one tx vector per queue pair plus the config and control vectors
+            device += f",mq=on,vectors={2 * queues + 2}"
+        return ["-netdev", netdev, "-device", device]
+
+    def set_nic_model(self, model: str) -> None:
+        if model not in NIC_MODELS:
+            raise CommandError(f"Invalid network card model {model}, expected one of: {', '.join(NIC_MODELS)}")
+        self._settings["nic-model"] = model
+
+    def qmp_socket_path(self) -> Path:
+        return Settings().run_dir().joinpath(f"{self._name}.qmp")
+
+    def monitor(self) -> "MachineMonitor":
+        # asyncio is only imported by the commands talking to a running machine
+        from vm_trainer.components.qmp import MachineMonitor
+        return MachineMonitor(self.qmp_socket_path())
+
+    def sampler(self) -> "MachineSampler":
+        from vm_trainer.components.telemetry import MachineSampler
+        return MachineSampler(self._name, self.qmp_socket_path(), self.host_network_interface())
+
+    def exec_parameters_qmp(self) -> List[str]:
         return [
-            "-netdev", f"tap,id=hostnet0,ifname={TapNetwork.TAP_INTERFACE_NAME},script=no,downscript=no",  # tap,fd=32,id=hostnet0
-            "-device", f"e1000e,netdev=hostnet0,id=net0,mac={self._settings['mac-address']},bus=pci.6,addr=0x0",
+            "-chardev", f"socket,id=qmp,path={self.qmp_socket_path()},server=on,wait=off",
+            "-mon", "chardev=qmp,mode=control",
         ]
 
+    def prepare_qmp_socket(self) -> None:
+        socket_path = self.qmp_socket_path()
+        for _ in range(100):
+            if socket_path.exists():
+                break
+            time.sleep(0.1)
+        else:
+            click.echo(f"The qmp socket {socket_path} was not created")
+            return
+        # the emulator runs as root, hand the control socket over to the user running vm-trainer
+        try:
+            ToolBase.execute_application(["sudo", "chown", getuser(), str(socket_path)])
+        except CommandError:
+            click.echo(f"Could not change the owner of the qmp socket {socket_path}")
+
     def exec_parameters_iso_disk(self, iso_path: str) -> List[str]:
         if not iso_path:
             return []
@@ -257,25 +510,47 @@ class Machine(object):
             "-usb", "-device", f"usb-host,vendorid={device[0]},productid={device[1]}",
         ]
 
-    def execute(self, iso_path: Union[str, None] = None, dir_share_path: str=None) -> None:
-        self.check_requirements()
-
-        settings = Settings()
-        if not settings.network_interface():
-            raise CommandError("Target network not configured")
-
-        TapNetwork.add_tap_network(settings.network_interface(), settings.network_ip())
-
-        parameters = [
+    def memory_backend(self, cpu_plan: Optional[CpuPlan]) -> MemoryBackend:
+        config = self._settings.get("memory-backend", {})
+        alignment_mb = 2
+        if config.get("backend") == "hugepages":
+            alignment_mb = max(HUGE_PAGE_SIZES.get(config.get("page-size", "2M"), 2048) // 1024, 2)
+        regions = self.numa_placement().memory_regions(self._settings["memory"], cpu_plan, alignment_mb)
+        return MemoryBackend(config, regions)
+
+    def mmio64_window_mb(self) -> Optional[int]:
+        scanner = PciScanner()
+        bars = [scanner.bar_sizes(address) for address in self.gpu_function_addresses()]
+        window_mb = mmio64_window_mb(bars)
+        # the default ovmf window already fits the smaller bars, the guest cpu model is left alone
+        if window_mb <= OVMF_DEFAULT_MMIO64_MB:
+            return None
+        physical_bits = host_physical_address_bits()
+        # ovmf places the aperture above the guest memory, both have to fit in the physical address space
+        if physical_bits and (self._settings["memory"] + window_mb) << 20 > 1 << physical_bits:
+            click.echo(f"The gpus need a {window_mb} MB 64-bit mmio window but the host cpu only has {physical_bits} "
+                       "physical address bits, the guest may fall back to small bars")
+        return window_mb
+
+    def exec_parameters_machine(self, memory: MemoryBackend, mmio64_mb: Optional[int] = None) -> List[str]:
+        machine_options = 'q35,accel=kvm,vmport=off,dump-guest-core=off,kernel_irqchip=on,hpet=off'
+        if memory.needs_objects() and len(memory.regions) == 1:
+            machine_options += f",memory-backend={memory.regions[0].backend_id}"
+        cpu_options = "host,migratable=on,hv-time,hv-relaxed,hv-vapic,hv-spinlocks=0x4000,hv-vpindex,hv-runtime,hv-synic,hv-stimer,hv-reset,hv-vendor-id=441863197303,hv-frequencies,hv-reenlightenment,hv-tlbflush,kvm=off"
+        mmio_parameters = []
+        if mmio64_mb:
+            # the guest needs the host physical address width to map a window above the default 32 GB
+            cpu_options += ",host-phys-bits=on"
+            mmio_parameters = ["-fw_cfg", f"name=opt/ovmf/X-PciMmio64Mb,string={mmio64_mb}"]
+        return [
             "-name", f"guest={self._name},debug-threads=on",
             # "-machine", 'pc-q35-5.1,accel=kvm,usb=off,vmport=off,dump-guest-core=off,kernel_irqchip=on',
-            "-machine", 'q35,accel=kvm,vmport=off,dump-guest-core=off,kernel_irqchip=on,hpet=off',
+            "-machine", machine_options,
             "-bios", self.BIOS_PATH,
-            "-cpu", "host,migratable=on,hv-time,hv-relaxed,hv-vapic,hv-spinlocks=0x4000,hv-vpindex,hv-runtime,hv-synic,hv-stimer,hv-reset,hv-vendor-id=441863197303,hv-frequencies,hv-reenlightenment,hv-tlbflush,kvm=off",
+            "-cpu", cpu_options,
             "-m", str(self._settings["memory"]),
             "-overcommit",
             "mem-lock=off",
-            "-smp", f"{self._settings['cpus'] * self._settings.get('cpus-threads', 1)},sockets=1,dies=1,cores={self._settings['cpus']},threads={self._settings.get('cpus-threads', 1)}",
             "-uuid", self._settings["uuid"],
             "-no-user-config",
             "-nodefaults",
@@ -289,34 +564,158 @@ class Machine(object):
             "-nographic",
             "-sandbox", "on,obsolete=deny,elevateprivileges=deny,spawn=deny,resourcecontrol=deny",
             "-msg", "timestamp=on",
-        ]
+        ] + mmio_parameters + memory.exec_parameters()
 
-        parameters += self.exec_parameters_pci_slots()
-        parameters += self.exec_parameters_inputs()
-        parameters += self.exec_parameters_disks()
-        parameters += self.exec_parameters_scream()
-        parameters += self.exec_parameters_gpus()
-        parameters += self.exec_parameters_network()
-        parameters += self.exec_parameters_iso_disk(iso_path)
-        parameters += self.exec_parameters_usb_device()
-        parameters += self.exec_parameters_tpm()
-        parameters += self.exec_parameters_shared_dir(dir_share_path)
+    def runtime_resources(self) -> MachineResources:
+        resources: MachineResources = {
+            "gpus": self.gpu_function_addresses(),
+            "disks": [os.path.realpath(path) for path in self.disk_paths()],
+            "inputs": [os.path.realpath(self._settings[name]) for name in ("evdev-mouse", "evdev-keyboard") if self._settings.get(name)],
+        }
+        if self._settings.get("usb-device"):
+            resources["usb"] = [self._settings["usb-device"]]
+        if self._settings.get("tpm"):
+            # swtpm serves a single emulator per socket
+            resources["tpm"] = [str(Settings().tpm_socket_path())]
+        if self.network_mode() == "macvtap-passthru":
+            # passthru hands the whole nic to a single macvtap
+            resources["network"] = [Settings().network_interface()]
+        elif self.network_mode() == "sriov":
+            resources["network"] = [self._settings["network-vf"]]
+        return resources
+
+    def execute(self, iso_path: Union[str, None] = None, dir_share_path: str=None) -> None:
+        with profile_phase("check-requirements"):
+            self.check_requirements()
+            self.validate_disk_profiles()
 
+        settings = Settings()
+        if self.network_mode() != "sriov" and not settings.network_interface():
+            raise CommandError("Target network not configured")
+
+        with profile_phase("runtime-lease"):
+            self._lease = RuntimeRegistry().acquire(self._name, self.runtime_resources())
+        try:
+            with profile_phase("tap-network"):
+                self.add_network(settings)
+            try:
+                self.launch(iso_path, dir_share_path)
+            finally:
+                with profile_phase("tap-remove"):
+                    self.remove_network()
+        finally:
+            self._lease.release()
+            self._lease = None
+
+    def launch(self, iso_path: Union[str, None], dir_share_path: Optional[str]) -> None:
+        with profile_phase("cpu-plan"):
+            cpu_plan = self.cpu_plan()
+        memory = self.memory_backend(cpu_plan)
+        with profile_phase("memory-reserve"):
+            memory.reserve()
+        try:
+            with profile_phase("build-parameters"):
+                parameters = self.exec_parameters_machine(memory, self.mmio64_window_mb())
+                parameters += self.exec_parameters_cpu(cpu_plan)
+                parameters += NumaPlacement.exec_parameters(cpu_plan, memory.regions)
+                slots = self.pci_slots(memory)
+                devices = self.exec_parameters_gpus(slots)
+                devices += self.exec_parameters_disks(slots)
+                devices += self.exec_parameters_network(slots)
+                devices += self.exec_parameters_inputs(slots)
+                devices += self.exec_parameters_scream(slots)
+                # the root ports have to be declared before the devices plugged into them
+                parameters += slots.exec_parameters() + devices
+                parameters += self.exec_parameters_iso_disk(iso_path)
+                parameters += self.exec_parameters_usb_device()
+                parameters += self.exec_parameters_tpm()
+                parameters += self.exec_parameters_shared_dir(dir_share_path)
+                parameters += self.exec_parameters_qmp()
+                parameters += self.exec_parameters_job_command()
+            with profile_phase("vfio-bind"):
+                bound = self.bind_gpus(self.passthrough_addresses())
+            try:
+                self.run_emulator(parameters, cpu_plan)
+            finally:
+                # only the functions moved for this run go back, cards isolated at boot stay on vfio-pci
+                if bound:
+                    with profile_phase("vfio-release"):
+                        self.release_gpus(bound)
+        finally:
+            with profile_phase("memory-release"):
+                memory.release()
+
+    def run_emulator(self, parameters: List[str], cpu_plan: Optional[CpuPlan]) -> None:
         emulator = EmulatorTool()
-        emulator.must_exists()
+        with profile_phase("emulator-check"):
+            emulator.must_exists()
+        with profile_phase("sysctl"):
+            try:
+                emulator.execute_application([
+                    'sudo', 'sysctl', 'net.ipv4.ip_forward=1'
+                ])
+            except:
+                pass
+        if self.qmp_socket_path().exists():
+            os.unlink(self.qmp_socket_path())
+        with profile_phase("emulator-start"):
+            process = emulator.spawn_with_devices(parameters, self.network_fds())
+        try:
+            with profile_phase("qmp-socket"):
+                self.prepare_qmp_socket()
+            with profile_phase("emulator-pid"):
+                pid = self.find_emulator_pid(process.pid)
+            if pid and self._lease:
+                self._lease.set_emulator_pid(pid)
+            if cpu_plan:
+                with profile_phase("cpu-pinning"):
+                    self.pin_cpus(pid, cpu_plan)
+        finally:
+            with profile_phase("emulator-run"):
+                return_code = process.wait()
+        if return_code:
+            raise CommandError(f"The emulator exited with code {return_code}")
+
+    @staticmethod
+    def find_emulator_pid(sudo_pid: int) -> Optional[int]:
+        for _ in range(100):
+            pid = find_descendant_process(sudo_pid, os.path.basename(EmulatorTool().TOOL_NAME))
+            if pid:
+                return pid
+            time.sleep(0.1)
+        return None
+
+    def pin_cpus(self, pid: Optional[int], cpu_plan: CpuPlan) -> None:
+        if not pid:
+            click.echo("Could not find the emulator process, the vcpus were not pinned")
+            return
         try:
-            emulator.execute_application([
-                'sudo', 'sysctl', 'net.ipv4.ip_forward=1'
-            ])
-        except:
-            pass
-        emulator.execute_as_super(parameters)
+            CpuPinner(cpu_plan).pin(pid)
+        except CommandError as e:
+            click.echo(f"Failed to pin the vcpus: {e.args[0]}")
+            return
+        for line in cpu_plan.describe():
+            click.echo(line)
+
+    def running_entry(self) -> Optional[RuntimeEntry]:
+        return RuntimeRegistry().entry(self._name)
+
+    def kill(self) -> None:
+        entry = self.running_entry()
+        if not entry:
+            raise CommandError(f"The machine {self._name} is not running")
+        if not entry.emulator_running():
+            raise CommandError(f"The emulator process of {self._name} was not found")
+        ToolBase.execute_application(["sudo", "kill", "-TERM", str(entry.emulator_pid)])
 
     def set_cpus(self, cpu_count: int) -> None:
         if cpu_count < -1:
             raise CommandError("Invalid cpu count")
         self._settings["cpus"] = cpu_count
 
+    def set_cpu_pinning(self, enabled: bool) -> None:
+        self._settings["cpu-pinning"] = enabled
+
     def set_tpm(self, tpm: bool) -> None:
         self._settings["tpm"] = tpm
 
@@ -325,10 +724,26 @@ class Machine(object):
             raise CommandError("Memory too small. Expected 256 or more")
         self._settings["memory"] = memory_size
 
+    def set_memory_backend(self, backend: str, page_size: str, fallback: bool, share: bool) -> None:
+        if backend not in MEMORY_BACKENDS:
+            raise CommandError(f"Invalid memory backend {backend}, expected one of: {', '.join(MEMORY_BACKENDS)}")
+        if page_size not in HUGE_PAGE_SIZES:
+            raise CommandError(f"Invalid huge page size {page_size}, expected one of: {', '.join(HUGE_PAGE_SIZES)}")
+        if backend == "hugepages" and (self._settings["memory"] * 1024) % HUGE_PAGE_SIZES[page_size]:
+            raise CommandError(f"The machine memory must be a multiple of {page_size} to use huge pages")
+        self._settings["memory-backend"] = {
+            "backend": backend,
+            "page-size": page_size,
+            "fallback": fallback,
+            "share": share,
+        }
+
     def set_raw_disk(self, disk_path: str) -> None:
         if not os.path.exists(disk_path):
             raise CommandError(f"Disk not found: {disk_path}")
         self._settings["raw-disk1"] = disk_path
+        if "disk-profiles" in self._settings:
+            self._settings["disk-profiles"].setdefault("raw-disk1", dict(DEFAULT_DISK_PROFILE))
 
     def set_disk_path(self, disk_path: str) -> None:
         if not os.path.exists(disk_path):
@@ -354,6 +769,103 @@ class Machine(object):
             os.makedirs(disk_dir)
         return disk_dir.joinpath(f"{self._name}.qcow2")
 
+    def disk_paths(self) -> List[str]:
+        if self._settings.get("disk-path"):
+            paths = [str(self._settings["disk-path"])]
+        else:
+            paths = [str(Settings().disk_directory().joinpath(f"{self._name}-disks", f"{self._name}.qcow2"))]
+        return paths + [self._settings[name] for name in ("raw-disk1", "raw-disk2") if name in self._settings]
+
+    def disk_info(self) -> List[dict]:
+        disks = []
+        for name, path in zip(self.disk_names(), self.disk_paths()):
+            info: Dict[str, Any] = {"disk": name, "path": path, "format": "raw" if name != "main" else "qcow2"}
+            if name == "main":
+                header = read_qcow2_header(path)
+                if header is None:
+                    raise CommandError(f"Could not read the qcow2 header of {path}")
+                info.update({
+                    "virtual-size": header.virtual_size,
+                    "allocated": os.stat(path).st_blocks * 512,
+                    "cluster-size": header.cluster_size,
+                    "extended-l2": header.extended_l2,
+                    "lazy-refcounts": header.lazy_refcounts,
+                    "refcount-bits": header.refcount_bits,
+                    "backing-file": header.backing_file,
+                    "creation-profile": self.qcow2_profile().to_dict(),
+                })
+                info.update(header.cache_options(self.qcow2_profile()))
+            info["io-profile"] = self.disk_profile(name).to_dict()
+            disks.append(info)
+        return disks
+
+    def summary(self) -> dict:
+        gpus = self._settings.get("gpus") or []
+        return {
+            "name": self._name,
+            "cpus": self._settings["cpus"],
+            "memory": self._settings["memory"],
+            "tpm": self._settings.get("tpm", False),
+            "gpus": [item["address"] for gpu in gpus for item in gpu_functions(gpu)],
+            "disks": self.disk_paths(),
+            "usb-device": self._settings.get("usb-device", ""),
+            "nic-model": self.nic_model(),
+            "mac-address": self._settings.get("mac-address", ""),
+        }
+
+    def create_instance(self, name: str, gpus: List[dict], job_command: str = "") -> "Machine":
+        instance = Machine(name)
+        if instance.exists():
+            raise CommandError(f"The machine {name} already exists")
+        backing_path = self.get_disk_path()
+        if not Path(backing_path).exists():
+            raise CommandError(f"File not found: {backing_path}")
+        instance._settings = copy.deepcopy(self._settings)
+        instance._settings.update({
+            "name": name,
+            "uuid": str(uuid4()),
+            "mac-address": get_random_mac(),
+            "gpus": gpus,
+            "usb-device": "",
+            "tpm": False,
+            "job-command": job_command,
+        })
+        # the instances run headless next to each other, devices that can't be shared stay with the template
+        for key in ("disk-path", "raw-disk1", "raw-disk2", "evdev-mouse", "evdev-keyboard"):
+            instance._settings.pop(key, None)
+        for key in ("raw-disk1", "raw-disk2"):
+            instance._settings.get("disk-profiles", {}).pop(key, None)
+        if instance.network_mode() in ("macvtap-passthru", "sriov"):
+            instance._settings.pop("network-vf", None)
+            instance._settings["network-mode"] = "nat"
+        for line in create_qcow_overlay(Path(backing_path), Path(instance.get_disk_path())):
+            click.echo(line)
+        instance.save()
+        return instance
+
+    def delete_instance(self) -> None:
+        disk_path = Path(self.get_disk_path())
+        if disk_path.exists():
+            os.unlink(disk_path)
+        if disk_path.parent.exists() and not os.listdir(disk_path.parent):
+            os.rmdir(disk_path.parent)
+        if self.exists():
+            os.unlink(self.config_path())
+        job_command_path = self.job_command_path()
+        if job_command_path.exists():
+            os.unlink(job_command_path)
+
+    def job_command_path(self) -> Path:
+        return Settings().run_dir().joinpath(f"{self._name}.job-command")
+
+    def exec_parameters_job_command(self) -> List[str]:
+        if not self._settings.get("job-command"):
+            return []
+        # a file avoids escaping the commas of the command, the guest reads it from the qemu_fw_cfg sysfs
+        with open(self.job_command_path(), "w") as fp:
+            fp.write(self._settings["job-command"])
+        return ["-fw_cfg", f"name=opt/vm-trainer/job-command,file={self.job_command_path()}"]
+
     def create_disk(self) -> None:
         disk_filepath = self.get_disk_path()
 
@@ -364,18 +876,18 @@ class Machine(object):
         if disk_size < 5000:
             raise CommandError('The machine configuration has a very small disk. Operation Aborted')
 
-        for line in create_qcow_disk(disk_filepath, disk_size):
+        for line in create_qcow_disk(disk_filepath, disk_size, self.qcow2_profile().create_options()):
             click.echo(line)
 
     def select_gpus(self) -> None:
-        gpus = sorted(gpus_from_iommu_devices(), key=lambda gpu: gpu.video_vendor)
+        gpus = discover_gpus()
         if not gpus:
             raise CommandError("There is no GPU avaliable on this device")
 
         click.echo('Choose one or more gpu type the numbers separated by an comma:')
 
         for index, gpu in enumerate(gpus):
-            click.echo(f"{index} - {gpu.video_vendor} video-address: [{gpu.video_address}]")
+            click.echo(f"{index} - {gpu.description} functions: [{', '.join(device.address for device in gpu.functions())}]")
 
         user_input = input('Type the gpu numbers to use (comma separated):')
 
@@ -393,19 +905,7 @@ class Machine(object):
             indexes.add(index)
             selected_gpus.append(gpus[index])
 
-        data = []
-        for gpu in selected_gpus:
-            item = {
-                "video": {
-                    "address": gpu.video_address,
-                }
-            }
-            if gpu.audio_address:
-                item["audio"] = {
-                    "address": gpu.audio_address,
-                }
-            data.append(item)
-        self._settings["gpus"] = data
+        self._settings["gpus"] = [gpu.to_dict() for gpu in selected_gpus]
 
     def select_mouse(self) -> None:
         mouses = list(UserInput.list_mouses())
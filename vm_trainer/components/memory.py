@@ -0,0 +1,237 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import click
+
+from vm_trainer.components.tools import TeeTool
+from vm_trainer.exceptions import CommandError
+from vm_trainer.utils import format_cpu_list, read_text_file
+
+MEMORY_BACKENDS = ("default", "memfd", "hugepages")
+HUGE_PAGE_SIZES = {"2M": 2048, "1G": 1048576}  # page sizes in kB
+SIZE_UNITS_KB = {"K": 1, "M": 1024, "G": 1048576}
+
+
+def parse_size_kb(value: str) -> Optional[int]:
+    value = value.upper().rstrip("B")
+    if value[-1:] in SIZE_UNITS_KB and value[:-1].isdigit():
+        return int(value[:-1]) * SIZE_UNITS_KB[value[-1]]
+    return None
+
+
+class HugePagePool:
+    def __init__(self, page_size_kb: int, node: Optional[int] = None, root: Union[str, Path] = "/") -> None:
+        self._root = Path(root)
+        self._page_size_kb = page_size_kb
+        self._node = node
+
+    @property
+    def page_size_kb(self) -> int:
+        return self._page_size_kb
+
+    @property
+    def node(self) -> Optional[int]:
+        return self._node
+
+    def default_page_size_kb(self) -> int:
+        for line in read_text_file(self._root.joinpath("proc", "meminfo")).splitlines():
+            if line.startswith("Hugepagesize:"):
+                return int(line.split()[1])
+        return HUGE_PAGE_SIZES["2M"]
+
+    def pool_dir(self) -> Path:
+        dirname = f"hugepages-{self._page_size_kb}kB"
+        if self._node is None:
+            return self._root.joinpath("sys", "kernel", "mm", "hugepages", dirname)
+        return self._root.joinpath("sys", "devices", "system", "node", f"node{self._node}", "hugepages", dirname)
+
+    def nr_hugepages_path(self) -> Path:
+        if self._node is None and self._page_size_kb == self.default_page_size_kb():
+            return self._root.joinpath("proc", "sys", "vm", "nr_hugepages")
+        return self.pool_dir().joinpath("nr_hugepages")
+
+    def exists(self) -> bool:
+        return self.pool_dir().exists()
+
+    def total_pages(self) -> int:
+        return int(read_text_file(self.nr_hugepages_path(), "0"))
+
+    def free_pages(self) -> int:
+        return int(read_text_file(self.pool_dir().joinpath("free_hugepages"), "0"))
+
+    def set_total_pages(self, count: int) -> None:
+        TeeTool().write(self.nr_hugepages_path(), f"{count}\n")
+
+    def describe(self) -> str:
+        size = f"{self._page_size_kb // 1024}MB" if self._page_size_kb < 1048576 else f"{self._page_size_kb // 1048576}GB"
+        if self._node is None:
+            return f"{size} pages"
+        return f"{size} pages on node {self._node}"
+
+
+class HugePageReservation:
+    def __init__(self, pool: HugePagePool, pages: int) -> None:
+        self._pool = pool
+        self._pages = pages
+        self._added = 0
+
+    @property
+    def pool(self) -> HugePagePool:
+        return self._pool
+
+    def reserve(self) -> bool:
+        if not self._pool.exists():
+            click.echo(f"The host kernel does not support {self._pool.describe()}")
+            return False
+        free = self._pool.free_pages()
+        if free >= self._pages:
+            return True
+        total = self._pool.total_pages()
+        wanted = total + self._pages - free
+        try:
+            self._pool.set_total_pages(wanted)
+        except CommandError as e:
+            click.echo(e.args[0])
+        self._added = max(self._pool.total_pages() - total, 0)
+        available = free + self._added
+        if available >= self._pages:
+            click.echo(f"Reserved {self._added} {self._pool.describe()} ({self._pages} needed, {free} were free)")
+            return True
+        size_kb = self._pool.page_size_kb
+        missing = self._pages - available
+        click.echo(
+            f"Could not reserve {self._pool.describe()}: {self._pages} needed ({self._pages * size_kb // 1024}MB), "
+            f"{free} free and {self._added} added, short by {missing} ({missing * size_kb // 1024}MB)"
+        )
+        return False
+
+    def release(self) -> None:
+        if not self._added:
+            return
+        total = self._pool.total_pages()
+        self._pool.set_total_pages(max(total - self._added, 0))
+        self._added = 0
+
+
+class MemoryRegion:
+    def __init__(self, backend_id: str, size_mb: int, host_nodes: Optional[List[int]] = None) -> None:
+        self._backend_id = backend_id
+        self._size_mb = size_mb
+        self._host_nodes = host_nodes or []
+
+    @property
+    def backend_id(self) -> str:
+        return self._backend_id
+
+    @property
+    def size_mb(self) -> int:
+        return self._size_mb
+
+    @property
+    def host_nodes(self) -> List[int]:
+        return self._host_nodes
+
+    def pool_node(self) -> Optional[int]:
+        if len(self._host_nodes) == 1:
+            return self._host_nodes[0]
+        return None
+
+
+class MemoryBackend:
+    ROOT = "/"
+
+    def __init__(self, config: Dict, regions: List[MemoryRegion], root: Union[str, Path, None] = None) -> None:
+        self._root = Path(root or self.ROOT)
+        self._backend = config.get("backend", "default")
+        self._page_size = config.get("page-size", "2M")
+        self._fallback = config.get("fallback", True)
+        self._share = config.get("share", False)
+        self._regions = regions
+        self._reservations: List[HugePageReservation] = []
+
+    @property
+    def backend(self) -> str:
+        return self._backend
+
+    @property
+    def regions(self) -> List[MemoryRegion]:
+        return self._regions
+
+    def page_size_kb(self) -> int:
+        if self._page_size not in HUGE_PAGE_SIZES:
+            raise CommandError(f"Invalid huge page size {self._page_size}, expected one of: {', '.join(HUGE_PAGE_SIZES)}")
+        return HUGE_PAGE_SIZES[self._page_size]
+
+    def hugetlbfs_mount(self) -> Optional[str]:
+        default_size = HugePagePool(self.page_size_kb(), root=self._root).default_page_size_kb()
+        for line in read_text_file(self._root.joinpath("proc", "mounts")).splitlines():
+            fields = line.split()
+            if len(fields) < 4 or fields[2] != "hugetlbfs":
+                continue
+            options = dict(option.partition("=")[::2] for option in fields[3].split(","))
+            page_size = options.get("pagesize", "")
+            # the kernel lists a 1G mount as pagesize=1024M
+            if parse_size_kb(page_size) == self.page_size_kb() or (not page_size and self.page_size_kb() == default_size):
+                return fields[1]
+        return None
+
+    def required_pages(self, region: MemoryRegion) -> int:
+        size_kb = region.size_mb * 1024
+        if size_kb % self.page_size_kb():
+            raise CommandError(f"The memory size {region.size_mb}MB is not a multiple of the {self._page_size} huge page size")
+        return size_kb // self.page_size_kb()
+
+    def reserve(self) -> None:
+        if self._backend != "hugepages":
+            return
+        for region in self._regions:
+            pool = HugePagePool(self.page_size_kb(), region.pool_node(), self._root)
+            reservation = HugePageReservation(pool, self.required_pages(region))
+            self._reservations.append(reservation)
+            if reservation.reserve():
+                continue
+            self.release()
+            if not self._fallback:
+                raise CommandError("Not enough huge pages for the machine memory")
+            click.echo("Falling back to regular pages for the machine memory")
+            self._backend = "default"
+            return
+
+    def release(self) -> None:
+        for reservation in reversed(self._reservations):
+            try:
+                reservation.release()
+            except CommandError as e:
+                click.echo(f"Could not release {reservation.pool.describe()}: {e.args[0]}")
+        self._reservations = []
+
+    def needs_objects(self) -> bool:
+        return self._backend != "default" or any(region.host_nodes for region in self._regions)
+
+    def region_options(self, region: MemoryRegion) -> List[Tuple[str, str]]:
+        options = [("id", region.backend_id), ("size", f"{region.size_mb}M")]
+        if self._backend == "hugepages":
+            mount = self.hugetlbfs_mount()
+            if mount:
+                options = [("qom-type", "memory-backend-file")] + options + [("mem-path", mount)]
+            else:
+                options = [("qom-type", "memory-backend-memfd")] + options + [("hugetlb", "on"), ("hugetlbsize", self._page_size)]
+            options.append(("prealloc", "on"))
+        elif self._backend == "memfd":
+            options = [("qom-type", "memory-backend-memfd")] + options
+        else:
+            options = [("qom-type", "memory-backend-ram")] + options
+        if self._share:
+            options.append(("share", "on"))
+        if region.host_nodes:
+            options += [("host-nodes", format_cpu_list(region.host_nodes)), ("policy", "bind")]
+        return options
+
+    def exec_parameters(self) -> List[str]:
+        if not self.needs_objects():
+            return []
+        params = []
+        for region in self._regions:
+            options = self.region_options(region)
+            params += ["-object", ",".join([options[0][1]] + [f"{key}={value}" for key, value in options[1:]])]
+        return params
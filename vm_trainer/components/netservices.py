@@ -0,0 +1,102 @@
+import asyncio
+import ipaddress
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from vm_trainer.components.dhcp import (DHCP_CLIENT_PORT, DHCP_SERVER_PORT,
+                                        DhcpServer, assign_addresses,
+                                        serve_dhcp)
+from vm_trainer.components.dns import (DNS_PORT, DnsForwarder,
+                                       resolv_conf_nameservers, serve_dns)
+from vm_trainer.exceptions import CommandError
+
+DEFAULT_DOMAIN = "vm"
+
+
+def load_leases(filepath: Path) -> Dict[str, str]:
+    try:
+        with open(filepath, "r") as fp:
+            return json.load(fp).get("leases", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(filepath: Path, data: dict) -> None:
+    temp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(temp_path, filepath)
+
+
+def upstream_servers(upstreams: List[str], server_ip: str) -> List[str]:
+    # the bridge address can't forward to itself, a local stub resolver is reached on loopback anyway
+    servers = [server for server in upstreams or resolv_conf_nameservers() if server != server_ip]
+    if not servers:
+        raise CommandError("No upstream dns server was found, pass one with --upstream")
+    return servers
+
+
+def build_config(machines: List[dict], network_ip: str, interface: str, leases_path: Path,
+                 upstreams: List[str], domain: str = DEFAULT_DOMAIN) -> dict:
+    bridge = ipaddress.ip_interface(network_ip)
+    server_ip = str(bridge.ip)
+    mac_names = {summary["mac-address"].lower(): summary["name"] for summary in machines if summary.get("mac-address")}
+    leases = assign_addresses({name: mac for mac, name in mac_names.items()}, str(bridge.network), server_ip,
+                              load_leases(leases_path))
+    # the machines keep their address across restarts of the services
+    save_json(leases_path, {"network": str(bridge.network), "leases": leases})
+    return {
+        "interface": interface,
+        "network": str(bridge.network),
+        "server-ip": server_ip,
+        "leases": leases,
+        "hostnames": mac_names,
+        "domain": domain,
+        "upstreams": upstream_servers(upstreams, server_ip),
+        "upstream-port": DNS_PORT,
+        "dhcp-address": "0.0.0.0",
+        "dhcp-port": DHCP_SERVER_PORT,
+        "dhcp-client-port": DHCP_CLIENT_PORT,
+        "dhcp-reply-address": "255.255.255.255",
+        "dns-address": server_ip,
+        "dns-port": DNS_PORT,
+    }
+
+
+async def run_services(config: dict, ready: Optional[asyncio.Event] = None) -> None:
+    dhcp = DhcpServer(config["network"], config["server-ip"], config["leases"], config["hostnames"],
+                      [config["dns-address"]], config["domain"])
+    forwarder = DnsForwarder([(server, config.get("upstream-port", DNS_PORT)) for server in config["upstreams"]])
+    dhcp_transport = await serve_dhcp(dhcp, config["interface"], config["dhcp-address"], config["dhcp-port"],
+                                      config["dhcp-reply-address"], config["dhcp-client-port"])
+    dns_transport, dns_server = await serve_dns(forwarder, config["dns-address"], config["dns-port"])
+    if ready is not None:
+        ready.set()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        dhcp_transport.close()
+        dns_transport.close()
+        dns_server.close()
+
+
+def main(arguments: List[str]) -> None:
+    if len(arguments) != 1:
+        print("usage: python -m vm_trainer.components.netservices <config.json>", file=sys.stderr)
+        sys.exit(2)
+    with open(arguments[0], "r") as fp:
+        config = json.load(fp)
+    try:
+        asyncio.run(run_services(config))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Could not start the network services on {config['interface']}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
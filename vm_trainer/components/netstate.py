@@ -0,0 +1,132 @@
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from vm_trainer.components.tools import IpTool
+from vm_trainer.exceptions import CommandError
+from vm_trainer.utils import read_text_file
+
+IFF_UP = 0x1
+IFF_MULTI_QUEUE = 0x0100
+PHYSICAL_DEVICE_RE = re.compile(r"devices\/pci[0-9a-f]{4}:")
+BATCH_FAILED_RE = re.compile(r"Command failed -:([0-9]+)")
+
+IpCommand = Tuple[str, List[str]]
+
+
+class NetworkInterface:
+    def __init__(self, name: str, device_path: str, flags: int, tun_flags: Optional[int], bridge: bool, master: Optional[str]) -> None:
+        self._name = name
+        self._device_path = device_path
+        self._flags = flags
+        self._tun_flags = tun_flags
+        self._bridge = bridge
+        self._master = master
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def physical(self) -> bool:
+        return bool(PHYSICAL_DEVICE_RE.search(self._device_path))
+
+    @property
+    def up(self) -> bool:
+        return bool(self._flags & IFF_UP)
+
+    @property
+    def tap(self) -> bool:
+        return self._tun_flags is not None
+
+    @property
+    def multi_queue(self) -> bool:
+        return bool((self._tun_flags or 0) & IFF_MULTI_QUEUE)
+
+    @property
+    def bridge(self) -> bool:
+        return self._bridge
+
+    @property
+    def master(self) -> Optional[str]:
+        return self._master
+
+
+class NetworkState:
+    SYSFS_ROOT = "/sys"
+
+    def __init__(self, sysfs_root: Union[str, Path, None] = None) -> None:
+        self._net_dir = Path(sysfs_root or self.SYSFS_ROOT).joinpath("class", "net")
+        self._interfaces: Dict[str, NetworkInterface] = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        self._interfaces = {}
+        try:
+            names = sorted(os.listdir(self._net_dir))
+        except OSError:
+            names = []
+        for name in names:
+            interface_dir = self._net_dir.joinpath(name)
+            try:
+                device_path = os.readlink(interface_dir)
+            except OSError:
+                device_path = ""
+            master_link = interface_dir.joinpath("master")
+            tun_flags = read_text_file(interface_dir.joinpath("tun_flags"))
+            self._interfaces[name] = NetworkInterface(
+                name,
+                device_path,
+                int(read_text_file(interface_dir.joinpath("flags")) or "0", 16),
+                int(tun_flags, 16) if tun_flags else None,
+                interface_dir.joinpath("bridge").is_dir(),
+                os.path.basename(os.readlink(master_link)) if master_link.is_symlink() else None,
+            )
+
+    def interface(self, name: str) -> Optional[NetworkInterface]:
+        return self._interfaces.get(name)
+
+    def interfaces(self) -> List[NetworkInterface]:
+        return list(self._interfaces.values())
+
+    def physical_interfaces(self) -> List[str]:
+        return [interface.name for interface in self.interfaces() if interface.physical]
+
+    def logical_interfaces(self) -> List[str]:
+        return [interface.name for interface in self.interfaces() if not interface.physical]
+
+
+class IpTransaction:
+    def __init__(self) -> None:
+        # every command carries the ones that revert it, none when nothing has to be reverted
+        self._commands: List[IpCommand] = []
+
+    def add(self, command: str, undo: Union[str, List[str], None] = None) -> None:
+        self._commands.append((command, [undo] if isinstance(undo, str) else list(undo or [])))
+
+    def commands(self) -> List[str]:
+        return [command for command, _ in self._commands]
+
+    def undo_commands(self, applied: int) -> List[str]:
+        return [command for _, undo in reversed(self._commands[:applied]) for command in undo]
+
+    @staticmethod
+    def failed_line(stderr: str) -> Optional[int]:
+        match = BATCH_FAILED_RE.search(stderr)
+        return int(match.group(1)) if match else None
+
+    def apply(self, ip_tool: Optional[IpTool] = None) -> None:
+        if not self._commands:
+            return
+        ip_tool = ip_tool or IpTool()
+        return_code, stderr = ip_tool.run_batch(self.commands())
+        if not return_code:
+            return
+        # ip stops at the first failing line, the lines before it were applied
+        failed = self.failed_line(stderr)
+        applied = failed - 1 if failed else 0
+        undo = self.undo_commands(applied)
+        if undo:
+            ip_tool.run_batch(undo, force=True)
+        raise CommandError(f"Could not configure the network: {stderr.strip()}")
@@ -1,58 +1,181 @@
 import os
-import re
-from typing import Iterator
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
 
-from vm_trainer.components.tools import IpTablesTool, IpTool
-from vm_trainer.utils import run_read_output
+from vm_trainer.components.firewall import NatRules, bridge_subnet, firewall
+from vm_trainer.components.netstate import IpTransaction, NetworkState
+from vm_trainer.components.tools import IpTool
+from vm_trainer.exceptions import CommandError
+from vm_trainer.utils import read_text_file
+
+NIC_MODELS = ("virtio", "e1000e")
+MAX_NET_QUEUES = 16
+NETWORK_MODES = ("nat", "macvtap-bridge", "macvtap-passthru", "sriov")
+MACVTAP_INTERFACE_PREFIX = "vmtrainermvt"
+# the descriptors below 3 are the standard streams of the emulator
+FIRST_PASSED_FD = 3
 
 
 class TapNetwork(object):
     TAP_INTERFACE_NAME = "vmtrainertap0"
     BRIDGE_INTERFACE_NAME = "vmtrainerbr0"
 
-    IP_LINK_NAME_RE = re.compile(r"[^:]+:[ ]+([^:]+):.*")
-    PHYSICAL_INTERFACE_RE = re.compile(r"devices\/pci[0-9a-f]{4}:")
-
     @staticmethod
     def get_physical_interfaces() -> Iterator[str]:
-        logical_ones = list(TapNetwork.get_logical_interfaces())
-        for interface in run_read_output(["ip", "-o", "link", "show"]):
-            match = TapNetwork.IP_LINK_NAME_RE.match(interface)
-            if not match:
-                continue
-            if match.group(1) not in logical_ones:
-                yield match.group(1)
-
-    @staticmethod
-    def is_physical_interface(filepath: str) -> bool:
-        try:
-            target_path = os.readlink(filepath)
-        except OSError:
-            target_path = ""
-        if TapNetwork.PHYSICAL_INTERFACE_RE.search(target_path):
-            return True
-        return False
+        return iter(NetworkState().physical_interfaces())
 
     @staticmethod
     def get_logical_interfaces() -> Iterator[str]:
-        for name in os.listdir("/sys/class/net/"):
-            if name not in ("..", ".") and not TapNetwork.is_physical_interface(os.path.join("/sys/class/net/", name)):
-                yield name
+        return iter(NetworkState().logical_interfaces())
 
     @staticmethod
     def get_mac(name: str) -> str:
         return IpTool().get_mac_address(name)
 
     @staticmethod
-    def add_tap_network(target_interface: str, ip_address: str) -> None:
-        ip_tool = IpTool()
-        ip_tool.create_bridge_interface(TapNetwork.BRIDGE_INTERFACE_NAME, ip_address)
-        ip_tool.create_tap_interface(TapNetwork.TAP_INTERFACE_NAME, TapNetwork.BRIDGE_INTERFACE_NAME)
-        ip_tables = IpTablesTool()
-        ip_tables.create_nat_routing(TapNetwork.BRIDGE_INTERFACE_NAME, target_interface)
+    def vhost_net_available() -> bool:
+        return os.path.exists("/dev/vhost-net")
+
+    @staticmethod
+    def bridge_commands(state: NetworkState, transaction: IpTransaction, name: str, ip_address: str) -> None:
+        bridge = state.interface(name)
+        if bridge is None:
+            transaction.add(f"link add name {name} type bridge", f"link delete {name} type bridge")
+            transaction.add(f"addr add dev {name} {ip_address}")
+        if bridge is None or not bridge.up:
+            transaction.add(f"link set {name} up", f"link set {name} down")
+
+    @staticmethod
+    def tap_commands(state: NetworkState, transaction: IpTransaction, name: str, bridge_name: str, multi_queue: bool) -> None:
+        tap = state.interface(name)
+        mode = "mode tap multi_queue" if multi_queue else "mode tap"
+        if tap is not None and tap.multi_queue != multi_queue:
+            # the kernel refuses to attach a netdev whose queue mode differs from the tap, recreate it
+            previous_mode = "mode tap multi_queue" if tap.multi_queue else "mode tap"
+            restore = [f"tuntap add dev {name} {previous_mode}"]
+            if tap.master:
+                restore.append(f"link set {name} master {tap.master}")
+            if tap.up:
+                restore.append(f"link set {name} up")
+            transaction.add(f"tuntap del dev {name} {previous_mode}", restore)
+            tap = None
+        if tap is None:
+            transaction.add(f"tuntap add dev {name} {mode}", f"tuntap del dev {name} mode tap")
+        if tap is None or tap.master != bridge_name:
+            transaction.add(f"link set {name} master {bridge_name}", f"link set {name} nomaster")
+        if tap is None or not tap.up:
+            transaction.add(f"link set {name} up", f"link set {name} down")
+
+    @staticmethod
+    def add_tap_network(target_interface: str, ip_address: str, multi_queue: bool = False, tap_name: str = TAP_INTERFACE_NAME) -> None:
+        # one sysfs pass and a single ip -batch instead of an ip process per check and change
+        state = NetworkState()
+        transaction = IpTransaction()
+        TapNetwork.bridge_commands(state, transaction, TapNetwork.BRIDGE_INTERFACE_NAME, ip_address)
+        TapNetwork.tap_commands(state, transaction, tap_name, TapNetwork.BRIDGE_INTERFACE_NAME, multi_queue)
+        transaction.apply()
+        firewall().install(NatRules(TapNetwork.BRIDGE_INTERFACE_NAME, target_interface, bridge_subnet(ip_address)))
 
     @staticmethod
     def remove_tap_network() -> None:
-        ip_tool = IpTool()
-        ip_tool.remove_tap_interface(TapNetwork.TAP_INTERFACE_NAME)
-        ip_tool.remove_bridge_interface(TapNetwork.BRIDGE_INTERFACE_NAME)
+        state = NetworkState()
+        commands = []
+        if state.interface(TapNetwork.TAP_INTERFACE_NAME):
+            commands.append(f"tuntap del dev {TapNetwork.TAP_INTERFACE_NAME} mode tap")
+        if state.interface(TapNetwork.BRIDGE_INTERFACE_NAME):
+            commands += [
+                f"link set {TapNetwork.BRIDGE_INTERFACE_NAME} down",
+                f"link delete {TapNetwork.BRIDGE_INTERFACE_NAME} type bridge",
+            ]
+        if commands:
+            IpTool().run_batch(commands, force=True)
+        firewall().remove(TapNetwork.BRIDGE_INTERFACE_NAME)
+
+
+class MacvtapNetwork(object):
+    SYSFS_ROOT = "/sys"
+
+    @staticmethod
+    def interface_commands(state: NetworkState, transaction: IpTransaction, parent: str, name: str, mode: str, mac_address: str) -> None:
+        parent_interface = state.interface(parent)
+        if parent_interface is None:
+            raise CommandError(f"The network interface {parent} does not exist")
+        if not parent_interface.physical:
+            # a macvtap sits on the nic itself, a vpn or bridge interface has no frames to hand over
+            raise CommandError(f"The network interface {parent} is not a physical interface, use the nat network mode")
+        if state.interface(name) is not None:
+            transaction.add(f"link delete {name}")
+        transaction.add(f"link add link {parent} name {name} address {mac_address} type macvtap mode {mode}", f"link delete {name}")
+        transaction.add(f"link set {name} up", f"link set {name} down")
+
+    @staticmethod
+    def add_macvtap(parent: str, name: str, mode: str, mac_address: str) -> None:
+        transaction = IpTransaction()
+        MacvtapNetwork.interface_commands(NetworkState(), transaction, parent, name, mode, mac_address)
+        transaction.apply()
+        MacvtapNetwork.wait_device(MacvtapNetwork.device_path(name))
+
+    @staticmethod
+    def remove_macvtap(name: str) -> None:
+        if NetworkState().interface(name) is not None:
+            IpTool().run_batch([f"link delete {name}"], force=True)
+
+    @staticmethod
+    def device_path(name: str, sysfs_root: Union[str, Path, None] = None) -> str:
+        ifindex = read_text_file(Path(sysfs_root or MacvtapNetwork.SYSFS_ROOT).joinpath("class", "net", name, "ifindex"))
+        if not ifindex:
+            raise CommandError(f"The macvtap interface {name} does not exist")
+        return f"/dev/tap{ifindex}"
+
+    @staticmethod
+    def wait_device(path: str) -> None:
+        # udev creates the character device shortly after the interface
+        for _ in range(50):
+            if os.path.exists(path):
+                return
+            time.sleep(0.1)
+        raise CommandError(f"The macvtap device {path} was not created")
+
+    @staticmethod
+    def queue_fds(name: str, queues: int) -> Dict[int, str]:
+        # every queue is a separate open of the same character device
+        path = MacvtapNetwork.device_path(name)
+        return {FIRST_PASSED_FD + queue: path for queue in range(queues)}
+
+
+class SriovFunction(object):
+    SYSFS_ROOT = "/sys"
+
+    def __init__(self, address: str, sysfs_root: Union[str, Path, None] = None) -> None:
+        self._address = address
+        self._devices_dir = Path(sysfs_root or self.SYSFS_ROOT).joinpath("bus", "pci", "devices")
+
+    def physical_function(self) -> str:
+        physfn = self._devices_dir.joinpath(self._address, "physfn")
+        if not physfn.is_symlink():
+            raise CommandError(f"The pci device {self._address} is not a SR-IOV virtual function")
+        return os.path.basename(os.readlink(physfn))
+
+    def index(self) -> int:
+        pf_dir = self._devices_dir.joinpath(self.physical_function())
+        for entry in os.listdir(pf_dir):
+            if entry.startswith("virtfn") and os.path.basename(os.readlink(pf_dir.joinpath(entry))) == self._address:
+                return int(entry[len("virtfn"):])
+        raise CommandError(f"The virtual function {self._address} is not listed by its physical function")
+
+    def parent_interfaces(self) -> List[str]:
+        net_dir = self._devices_dir.joinpath(self.physical_function(), "net")
+        return sorted(os.listdir(net_dir)) if net_dir.is_dir() else []
+
+    def mac_command(self, mac_address: str) -> str:
+        interfaces = self.parent_interfaces()
+        if not interfaces:
+            raise CommandError(f"The physical function of {self._address} has no network interface")
+        return f"link set {interfaces[0]} vf {self.index()} mac {mac_address}"
+
+    def set_mac_address(self, mac_address: str, ip_tool: Optional[IpTool] = None) -> None:
+        # the pf driver filters the frames by mac, the guest keeps the address of the machine
+        return_code, stderr = (ip_tool or IpTool()).run_batch([self.mac_command(mac_address)])
+        if return_code:
+            raise CommandError(f"Could not set the mac address of the virtual function {self._address}: {stderr.strip()}")
@@ -0,0 +1,67 @@
+from pathlib import Path
+from typing import List, Optional, Union
+
+import click
+
+from vm_trainer.components.cpu_topology import (CpuPinningPlanner, CpuPlan,
+                                                HostTopology)
+from vm_trainer.components.memory import MemoryRegion
+from vm_trainer.utils import read_text_file
+
+
+class NumaPlacement:
+    SYSFS_ROOT = "/sys"
+
+    def __init__(self, gpu_addresses: List[str], sysfs_root: Union[str, Path, None] = None) -> None:
+        self._root = Path(sysfs_root or self.SYSFS_ROOT)
+        self._gpu_addresses = gpu_addresses
+
+    def gpu_node(self, address: str) -> Optional[int]:
+        node = int(read_text_file(self._root.joinpath("bus", "pci", "devices", address, "numa_node"), "-1"))
+        if node < 0:
+            return None
+        return node
+
+    def gpu_nodes(self) -> List[int]:
+        nodes: List[int] = []
+        for address in self._gpu_addresses:
+            node = self.gpu_node(address)
+            if node is not None and node not in nodes:
+                nodes.append(node)
+        return nodes
+
+    def cpu_plan(self, vcpus: int, topology: HostTopology) -> CpuPlan:
+        planner = CpuPinningPlanner(topology)
+        nodes = self.gpu_nodes()
+        if len(nodes) > 1:
+            if vcpus % len(nodes) == 0:
+                # every node gets its own cores, the later nodes can't fall back on the cores of the earlier ones
+                plans: List[CpuPlan] = []
+                pinned: List[int] = []
+                for node in nodes:
+                    plans.append(planner.plan(vcpus // len(nodes), [node], exclude=pinned, strict=True))
+                    pinned += plans[-1].vcpu_pins
+                node_cores = [core for core in topology.cores if core.node_id in nodes]
+                emulator_cpus, iothread_cpus = planner.spare_cpus(pinned, node_cores)
+                return CpuPlan.combine(plans, nodes, emulator_cpus, iothread_cpus)
+            click.echo(f"The gpus span the NUMA nodes {nodes} but {vcpus} vcpus can't be split evenly, using node {nodes[0]}")
+        return planner.plan(vcpus, nodes[:1] or None)
+
+    def memory_regions(self, memory_mb: int, cpu_plan: Optional[CpuPlan], alignment_mb: int = 2) -> List[MemoryRegion]:
+        nodes = self.gpu_nodes()
+        if cpu_plan and len(cpu_plan.host_nodes) > 1 and cpu_plan.host_nodes == nodes:
+            per_node = memory_mb // len(nodes) // alignment_mb * alignment_mb
+            regions = [MemoryRegion(f"mem{index}", per_node, [node]) for index, node in enumerate(nodes[:-1])]
+            regions.append(MemoryRegion(f"mem{len(nodes) - 1}", memory_mb - per_node * (len(nodes) - 1), [nodes[-1]]))
+            return regions
+        return [MemoryRegion("mem0", memory_mb, nodes[:1])]
+
+    @staticmethod
+    def exec_parameters(cpu_plan: Optional[CpuPlan], regions: List[MemoryRegion]) -> List[str]:
+        if not cpu_plan or len(regions) < 2:
+            return []
+        params = []
+        for index, region in enumerate(regions):
+            vcpus = cpu_plan.socket_vcpus(index)
+            params += ["-numa", f"node,nodeid={index},cpus={vcpus[0]}-{vcpus[-1]},memdev={region.backend_id}"]
+        return params
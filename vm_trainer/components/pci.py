@@ -0,0 +1,368 @@
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from vm_trainer.settings import Settings
+
+PCI_IDS_PATHS = (
+    "/usr/share/hwdata/pci.ids",
+    "/usr/share/misc/pci.ids",
+    "/usr/share/pci.ids",
+    "/usr/local/share/pci.ids",
+)
+PCI_IDS_INDEX_VERSION = 1
+LINK_SPEED_RE = re.compile(r"([0-9.]+) GT/s")
+# the values accepted by the x-speed property of pcie-root-port
+# link speed in GT/s -> value of the PCIELinkSpeed property of the root port
+ROOT_PORT_SPEEDS = {"2.5": "2_5", "5": "5", "8": "8", "16": "16", "32": "32", "64": "64"}
+IORESOURCE_MEM = 0x200
+IORESOURCE_MEM_64 = 0x100000
+# the 64-bit aperture ovmf uses when X-PciMmio64Mb is not set
+OVMF_DEFAULT_MMIO64_MB = 32768
+ADDRESS_SIZES_RE = re.compile(r"address sizes\s*:\s*([0-9]+) bits physical")
+
+
+def read_hex_attribute(filepath: Union[str, Path], default: int = 0) -> int:
+    try:
+        with open(filepath, "r") as fp:
+            return int(fp.read().strip(), 16)
+    except (OSError, ValueError):
+        return default
+
+
+def next_power_of_two(value: int) -> int:
+    return 1 << max(value - 1, 0).bit_length()
+
+
+def mmio64_window_mb(devices_bars: List[List[int]]) -> int:
+    # every bar is aligned to its size and every root port window to its largest bar,
+    # packing the device windows from the largest down keeps the sum aligned
+    windows = sorted((next_power_of_two(sum(bars)) for bars in devices_bars if bars), reverse=True)
+    if not windows:
+        return 0
+    return next_power_of_two(sum(windows)) >> 20
+
+
+def host_physical_address_bits(cpuinfo_path: Union[str, Path] = "/proc/cpuinfo") -> Optional[int]:
+    try:
+        with open(cpuinfo_path, "r") as fp:
+            for line in fp:
+                match = ADDRESS_SIZES_RE.match(line)
+                if match:
+                    return int(match.group(1))
+    except OSError:
+        pass
+    return None
+
+
+class PciIds:
+    def __init__(self, ids_path: Union[str, Path, None] = None, index_path: Union[str, Path, None] = None) -> None:
+        self._ids_path = Path(ids_path) if ids_path else self.find_ids_file()
+        self._index_path = Path(index_path) if index_path else None
+        self._vendors: Dict[str, Tuple[int, str]] = {}
+        self._classes: Dict[str, str] = {}
+        self._devices: Dict[str, Dict[str, str]] = {}
+        self._loaded = False
+
+    @staticmethod
+    def find_ids_file() -> Optional[Path]:
+        for filepath in PCI_IDS_PATHS:
+            if os.path.exists(filepath):
+                return Path(filepath)
+        return None
+
+    def index_path(self) -> Path:
+        if self._index_path is None:
+            self._index_path = Settings().settings_dir().joinpath("pci-ids-index.json")
+        return self._index_path
+
+    def source_key(self) -> List:
+        assert self._ids_path is not None
+        stat = os.stat(self._ids_path)
+        return [str(self._ids_path), stat.st_mtime_ns, stat.st_size]
+
+    def load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if self._ids_path is None:
+            return
+        key = self.source_key()
+        try:
+            with open(self.index_path(), "r") as fp:
+                index = json.load(fp)
+            if index.get("version") == PCI_IDS_INDEX_VERSION and index.get("source") == key:
+                self._vendors = {vendor: (offset, name) for vendor, (offset, name) in index["vendors"].items()}
+                self._classes = index["classes"]
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        self.build_index()
+        temp_path = f"{self.index_path()}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump({"version": PCI_IDS_INDEX_VERSION, "source": key, "vendors": self._vendors,
+                       "classes": self._classes}, fp, separators=(",", ":"))
+        os.replace(temp_path, self.index_path())
+
+    def build_index(self) -> None:
+        # the index keeps the vendor names and the offset of each vendor block,
+        # device names are read from the block when a device of that vendor is looked up
+        assert self._ids_path is not None
+        self._vendors = {}
+        self._classes = {}
+        current_class = ""
+        offset = 0
+        with open(self._ids_path, "rb") as fp:
+            for raw_line in fp:
+                line_offset = offset
+                offset += len(raw_line)
+                line = raw_line.decode("utf-8", "replace").rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("C "):
+                    current_class, _, name = line[2:].partition("  ")
+                    self._classes[current_class] = name
+                    continue
+                if line.startswith("\t"):
+                    if current_class and not line.startswith("\t\t"):
+                        subclass, _, name = line[1:].partition("  ")
+                        self._classes[current_class + subclass] = name
+                    continue
+                current_class = ""
+                vendor, _, name = line.partition("  ")
+                self._vendors[vendor] = (line_offset, name)
+
+    def vendor_devices(self, vendor: str) -> Dict[str, str]:
+        if vendor in self._devices:
+            return self._devices[vendor]
+        devices: Dict[str, str] = {}
+        if vendor in self._vendors and self._ids_path is not None:
+            with open(self._ids_path, "rb") as fp:
+                fp.seek(self._vendors[vendor][0])
+                fp.readline()
+                for raw_line in fp:
+                    line = raw_line.decode("utf-8", "replace").rstrip("\n")
+                    if line.startswith("\t\t") or line.startswith("#"):
+                        continue
+                    if not line.startswith("\t"):
+                        break
+                    device, _, name = line[1:].partition("  ")
+                    devices[device] = name
+        self._devices[vendor] = devices
+        return devices
+
+    def vendor_name(self, vendor_id: int) -> Optional[str]:
+        self.load()
+        vendor = self._vendors.get(f"{vendor_id:04x}")
+        return vendor[1] if vendor else None
+
+    def device_name(self, vendor_id: int, device_id: int) -> Optional[str]:
+        self.load()
+        return self.vendor_devices(f"{vendor_id:04x}").get(f"{device_id:04x}")
+
+    def class_name(self, class_code: int) -> Optional[str]:
+        self.load()
+        return self._classes.get(f"{class_code >> 8:04x}") or self._classes.get(f"{class_code >> 16:02x}")
+
+
+class PciDevice:
+    def __init__(self, address: str, vendor_id: int, device_id: int, class_code: int, revision: int,
+                 numa_node: int, iommu_group: Optional[int]) -> None:
+        self._address = address
+        self._vendor_id = vendor_id
+        self._device_id = device_id
+        self._class_code = class_code
+        self._revision = revision
+        self._numa_node = numa_node
+        self._iommu_group = iommu_group
+
+    @property
+    def address(self) -> str:
+        return self._address
+
+    @property
+    def vendor_id(self) -> int:
+        return self._vendor_id
+
+    @property
+    def device_id(self) -> int:
+        return self._device_id
+
+    @property
+    def class_code(self) -> int:
+        return self._class_code
+
+    @property
+    def revision(self) -> int:
+        return self._revision
+
+    @property
+    def numa_node(self) -> int:
+        return self._numa_node
+
+    @property
+    def iommu_group(self) -> Optional[int]:
+        return self._iommu_group
+
+    def short_address(self) -> str:
+        # lspci omits the domain when it is 0000
+        return self._address[5:] if self._address.startswith("0000:") else self._address
+
+    def lspci_line(self, pci_ids: PciIds) -> str:
+        class_id = self._class_code >> 8
+        class_name = pci_ids.class_name(self._class_code) or f"Class {class_id:04x}"
+        vendor_name = pci_ids.vendor_name(self._vendor_id)
+        device_name = pci_ids.device_name(self._vendor_id, self._device_id) or f"Device {self._device_id:04x}"
+        name = f"{vendor_name} {device_name}" if vendor_name else device_name
+        line = f"{self.short_address()} {class_name} [{class_id:04x}]: {name} [{self._vendor_id:04x}:{self._device_id:04x}]"
+        if self._revision:
+            line += f" (rev {self._revision:02x})"
+        return line
+
+
+def parse_link_speed(value: str) -> Optional[float]:
+    match = LINK_SPEED_RE.search(value)
+    return float(match.group(1)) if match else None
+
+
+def parse_link_width(value: str) -> Optional[int]:
+    value = value.strip()
+    return int(value) if value.isdigit() and int(value) > 0 else None
+
+
+class PciLink:
+    def __init__(self, current_speed: Optional[float], current_width: Optional[int],
+                 max_speed: Optional[float], max_width: Optional[int]) -> None:
+        self._current_speed = current_speed
+        self._current_width = current_width
+        self._max_speed = max_speed
+        self._max_width = max_width
+
+    @property
+    def max_speed(self) -> Optional[float]:
+        return self._max_speed
+
+    @property
+    def max_width(self) -> Optional[int]:
+        return self._max_width
+
+    def speed_degraded(self) -> bool:
+        return bool(self._current_speed and self._max_speed and self._current_speed < self._max_speed)
+
+    def width_degraded(self) -> bool:
+        return bool(self._current_width and self._max_width and self._current_width < self._max_width)
+
+    def root_port_options(self) -> str:
+        options = ""
+        if self._max_speed:
+            speed = f"{self._max_speed:g}"
+            if speed in ROOT_PORT_SPEEDS:
+                options += f",x-speed={ROOT_PORT_SPEEDS[speed]}"
+        if self._max_width:
+            options += f",x-width={self._max_width}"
+        return options
+
+    def describe(self) -> str:
+        def link(speed: Optional[float], width: Optional[int]) -> str:
+            return f"{f'{speed:g}' if speed else '?'} GT/s x{width or '?'}"
+        text = f"current {link(self._current_speed, self._current_width)}, max {link(self._max_speed, self._max_width)}"
+        if self.width_degraded():
+            text += " DEGRADED WIDTH"
+        if self.speed_degraded():
+            # gpus lower the link speed while idle, check again under load before blaming the riser
+            text += " DEGRADED SPEED (may be power saving while idle)"
+        return text
+
+
+class PciScanner:
+    SYSFS_ROOT = "/sys"
+
+    def __init__(self, sysfs_root: Union[str, Path, None] = None, pci_ids: Optional[PciIds] = None) -> None:
+        self._root = Path(sysfs_root or self.SYSFS_ROOT)
+        self._pci_ids = pci_ids or PciIds()
+
+    @property
+    def pci_ids(self) -> PciIds:
+        return self._pci_ids
+
+    def iommu_groups_dir(self) -> Path:
+        return self._root.joinpath("kernel", "iommu_groups")
+
+    def read_device(self, device_dir: Path, iommu_group: Optional[int]) -> PciDevice:
+        return PciDevice(
+            device_dir.name,
+            read_hex_attribute(device_dir.joinpath("vendor")),
+            read_hex_attribute(device_dir.joinpath("device")),
+            read_hex_attribute(device_dir.joinpath("class")),
+            read_hex_attribute(device_dir.joinpath("revision")),
+            self.read_numa_node(device_dir),
+            iommu_group,
+        )
+
+    @staticmethod
+    def read_numa_node(device_dir: Path) -> int:
+        try:
+            with open(device_dir.joinpath("numa_node"), "r") as fp:
+                return int(fp.read().strip())
+        except (OSError, ValueError):
+            return -1
+
+    def iommu_devices(self) -> Iterator[PciDevice]:
+        groups_dir = self.iommu_groups_dir()
+        if not groups_dir.exists():
+            return
+        for group in sorted(os.listdir(groups_dir), key=lambda name: int(name) if name.isdigit() else -1):
+            devices_dir = groups_dir.joinpath(group, "devices")
+            for address in sorted(os.listdir(devices_dir)):
+                yield self.read_device(devices_dir.joinpath(address), int(group) if group.isdigit() else None)
+
+    def device(self, address: str) -> PciDevice:
+        device_dir = self._root.joinpath("bus", "pci", "devices", address)
+        group_link = device_dir.joinpath("iommu_group")
+        group = os.path.basename(os.readlink(group_link)) if group_link.is_symlink() else ""
+        return self.read_device(device_dir, int(group) if group.isdigit() else None)
+
+    def link(self, address: str) -> Optional[PciLink]:
+        device_dir = self._root.joinpath("bus", "pci", "devices", address)
+        values = {}
+        for name in ("current_link_speed", "current_link_width", "max_link_speed", "max_link_width"):
+            try:
+                with open(device_dir.joinpath(name), "r") as fp:
+                    values[name] = fp.read()
+            except OSError:
+                values[name] = ""
+        if not values["max_link_speed"] and not values["max_link_width"]:
+            return None
+        return PciLink(
+            parse_link_speed(values["current_link_speed"]),
+            parse_link_width(values["current_link_width"]),
+            parse_link_speed(values["max_link_speed"]),
+            parse_link_width(values["max_link_width"]),
+        )
+
+    def bar_sizes(self, address: str) -> List[int]:
+        device_dir = self._root.joinpath("bus", "pci", "devices", address)
+        sizes: List[int] = []
+        try:
+            with open(device_dir.joinpath("resource"), "r") as fp:
+                resources = fp.read().splitlines()
+        except OSError:
+            return sizes
+        # the first six lines are the bars, the rom and the bridge windows follow
+        for index, line in enumerate(resources[:6]):
+            start, end, flags = (int(value, 16) for value in line.split())
+            if not end or not flags & IORESOURCE_MEM or not flags & IORESOURCE_MEM_64:
+                continue
+            size = end - start + 1
+            # a resizable bar can grow up to the largest size it advertises, bit n is 2^n MB
+            supported = read_hex_attribute(device_dir.joinpath(f"resource{index}_resize"))
+            if supported:
+                size = max(size, 1 << (supported.bit_length() - 1 + 20))
+            sizes.append(size)
+        return sizes
+
+    def lspci_lines(self) -> Iterator[str]:
+        for device in self.iommu_devices():
+            yield device.lspci_line(self._pci_ids)
@@ -0,0 +1,108 @@
+from typing import Dict, List, Optional
+
+from vm_trainer.exceptions import CommandError
+
+ROOT_BUS = "pcie.0"
+# pcie.0 slot 0x0 is the host bridge and 0x1f the ICH9 functions
+FIRST_SLOT = 0x2
+LAST_SLOT = 0x1e
+FUNCTIONS_PER_SLOT = 8
+FIRST_EXPANDER_BUS_NR = 0x80
+EXPANDER_BUS_STRIDE = 0x10
+
+
+class PciBus:
+    def __init__(self, bus_id: str, first_slot: int) -> None:
+        self._bus_id = bus_id
+        self._slot = first_slot
+        self._function = 0
+
+    @property
+    def bus_id(self) -> str:
+        return self._bus_id
+
+    def next_slot(self) -> str:
+        # devices that can't share a slot with root ports take a whole slot of their own
+        if self._function:
+            self._slot += 1
+            self._function = 0
+        if self._slot > LAST_SLOT:
+            raise CommandError(f"No free pci slots left on the bus {self._bus_id}")
+        slot = self._slot
+        self._slot += 1
+        return f"0x{slot:x}"
+
+    def next_address(self) -> str:
+        if self._slot > LAST_SLOT:
+            raise CommandError(f"No free pci slots left on the bus {self._bus_id}")
+        slot, function = self._slot, self._function
+        self._function += 1
+        if self._function == FUNCTIONS_PER_SLOT:
+            self._slot += 1
+            self._function = 0
+        return f"0x{slot:x}.0x{function:x}"
+
+
+class PciSlotAllocator:
+    def __init__(self, guest_numa_nodes: Optional[Dict[int, int]] = None) -> None:
+        self._guest_numa_nodes = guest_numa_nodes or {}
+        self._buses: Dict[str, PciBus] = {ROOT_BUS: PciBus(ROOT_BUS, FIRST_SLOT)}
+        self._expanders: Dict[int, str] = {}
+        self._controllers: List[List[str]] = []
+        self._root_ports: List[str] = []
+        self._owners: Dict[str, str] = {}
+        self._bridge: Optional[str] = None
+        self._bridge_slot = 1
+
+    def expander_bus(self, host_node: Optional[int]) -> str:
+        if host_node is None or host_node not in self._guest_numa_nodes:
+            return ROOT_BUS
+        guest_node = self._guest_numa_nodes[host_node]
+        if guest_node not in self._expanders:
+            expander_id = f"pxb{guest_node}"
+            bus_nr = FIRST_EXPANDER_BUS_NR + EXPANDER_BUS_STRIDE * len(self._expanders)
+            address = self._buses[ROOT_BUS].next_slot()
+            self._controllers.append([
+                "-device", f"pxb-pcie,id={expander_id},bus_nr={bus_nr},numa_node={guest_node},bus={ROOT_BUS},addr={address}",
+            ])
+            self._buses[expander_id] = PciBus(expander_id, 0x0)
+            self._expanders[guest_node] = expander_id
+        return self._expanders[guest_node]
+
+    def root_port(self, owner: str, host_node: Optional[int] = None, options: str = "") -> str:
+        bus = self._buses[self.expander_bus(host_node)]
+        index = len(self._root_ports) + 1
+        port_id = f"pci.{index}"
+        address = bus.next_address()
+        multifunction = ",multifunction=on" if address.endswith(".0x0") else ""
+        self._controllers.append([
+            "-device", f"pcie-root-port,port=0x{0x10 + index - 1:x},chassis={index},id={port_id},bus={bus.bus_id},addr={address}{multifunction}{options}",
+        ])
+        self._root_ports.append(port_id)
+        self._owners[port_id] = owner
+        return port_id
+
+    def pci_bridge(self) -> str:
+        if self._bridge is None:
+            port_id = self.root_port("pcie-pci-bridge")
+            self._bridge = "pci-bridge0"
+            self._controllers.append(["-device", f"pcie-pci-bridge,id={self._bridge},bus={port_id},addr=0x0"])
+        return self._bridge
+
+    def bridge_slot(self) -> str:
+        # conventional pci devices (ivshmem) sit on the pcie-pci-bridge, slot 0 is reserved for shpc
+        bridge = self.pci_bridge()
+        if self._bridge_slot > LAST_SLOT:
+            raise CommandError("No free slots left on the pci bridge")
+        slot = self._bridge_slot
+        self._bridge_slot += 1
+        return f"bus={bridge},addr=0x{slot:x}"
+
+    def owners(self) -> Dict[str, str]:
+        return dict(self._owners)
+
+    def exec_parameters(self) -> List[str]:
+        params: List[str] = []
+        for controller in self._controllers:
+            params += controller
+        return params
@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from vm_trainer.profiling import PROFILER
+from vm_trainer.settings import Settings
+
+CommandArgs = List[str]
+ProbeCommands = Dict[str, CommandArgs]
+ProbeOutputs = Dict[str, str]
+
+PROBE_TIMEOUT = 30
+MAX_PROBE_WORKERS = 8
+
+
+class ProbeCache:
+    def __init__(self, cache_path: Union[str, Path, None] = None) -> None:
+        self._cache_path = Path(cache_path) if cache_path else None
+        self._entries: Optional[Dict[str, Dict]] = None
+
+    def cache_path(self) -> Path:
+        if self._cache_path is None:
+            self._cache_path = Settings().probe_cache_path()
+        return self._cache_path
+
+    def load(self) -> Dict[str, Dict]:
+        if self._entries is None:
+            try:
+                with open(self.cache_path(), "r") as fp:
+                    self._entries = json.load(fp)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def save(self) -> None:
+        temp_path = self.cache_path().with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, "w") as fp:
+            json.dump(self.load(), fp)
+        os.replace(temp_path, self.cache_path())
+
+    def clear(self) -> None:
+        self._entries = {}
+        if self.cache_path().exists():
+            os.unlink(self.cache_path())
+
+    @staticmethod
+    def binary_key(tool_name: str) -> Optional[List]:
+        binary_path = shutil.which(tool_name)
+        if not binary_path:
+            return None
+        binary_path = os.path.realpath(binary_path)
+        stat = os.stat(binary_path)
+        return [binary_path, stat.st_mtime_ns, stat.st_ino]
+
+    def cached_outputs(self, tool_name: str, key: List) -> ProbeOutputs:
+        entry = self.load().get(tool_name)
+        if not entry or entry.get("key") != key:
+            # the binary was upgraded or replaced, every probe has to run again
+            entry = {"key": key, "outputs": {}}
+            self.load()[tool_name] = entry
+        return entry["outputs"]
+
+    @staticmethod
+    def run_probe(binary_path: str, parameters: CommandArgs) -> Optional[str]:
+        start = time.perf_counter()
+        exit_status = None
+        try:
+            result = subprocess.run([binary_path] + parameters, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    stdin=subprocess.DEVNULL, universal_newlines=True, timeout=PROBE_TIMEOUT)
+            exit_status = result.returncode
+            return result.stdout
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        finally:
+            PROFILER.record_command([binary_path] + parameters, start, exit_status)
+
+    def probe_many(self, requests: List[Tuple[str, ProbeCommands]]) -> List[Optional[ProbeOutputs]]:
+        results: List[Optional[ProbeOutputs]] = []
+        missing: List[Tuple[int, str, str, CommandArgs]] = []
+        for tool_name, commands in requests:
+            key = self.binary_key(tool_name)
+            if key is None:
+                results.append(None)
+                continue
+            outputs = self.cached_outputs(tool_name, key)
+            for name, parameters in commands.items():
+                if name not in outputs:
+                    missing.append((len(results), name, key[0], parameters))
+            results.append(outputs)
+        if missing:
+            # imported here, concurrent.futures pulls logging into every cli start
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(len(missing), MAX_PROBE_WORKERS)) as executor:
+                texts = list(executor.map(lambda probe: self.run_probe(probe[2], probe[3]), missing))
+            failed = []
+            for (index, name, _, _), text in zip(missing, texts):
+                if text is None:
+                    failed.append((index, name))
+                else:
+                    results[index][name] = text  # type: ignore
+            if len(failed) < len(missing):
+                self.save()
+            # a probe that timed out or could not start is retried by the next run instead of being cached empty
+            for index, name in failed:
+                results[index] = dict(results[index] or {}, **{name: ""})
+        return results
+
+    def probe(self, tool_name: str, commands: ProbeCommands) -> Optional[ProbeOutputs]:
+        return self.probe_many([(tool_name, commands)])[0]
+
+
+PROBE_CACHE = ProbeCache()
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Union
+
+from vm_trainer.components.tools import ToolBase
+from vm_trainer.exceptions import CommandError, QMPError
+
+QMPMessage = Dict[str, Any]
+
+
+class QMPClient:
+    RECONNECT_DELAY = 0.2
+    MAX_RECONNECT_DELAY = 5.0
+    # a reply is a single line, the 64 KiB default of asyncio is too small for query-qmp-schema and the like
+    STREAM_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, socket_path: Union[str, Path], reconnect: bool = True) -> None:
+        self._socket_path = str(socket_path)
+        self._reconnect = reconnect
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self._closing = False
+        self._next_id = 0
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._subscribers: List[asyncio.Queue] = []
+        self._filters: Dict[int, Optional[Set[str]]] = {}
+        self._greeting: QMPMessage = {}
+        self._peer_pid: Optional[int] = None
+
+    @property
+    def greeting(self) -> QMPMessage:
+        return self._greeting
+
+    @property
+    def peer_pid(self) -> Optional[int]:
+        return self._peer_pid
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def connect(self, timeout: float = 5.0) -> None:
+        self._closing = False
+        try:
+            await asyncio.wait_for(self._open(), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise QMPError(f"Could not connect to the qmp socket {self._socket_path}: {e}")
+
+    async def _open(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(self._socket_path, limit=self.STREAM_LIMIT)
+        sock = self._writer.get_extra_info("socket")
+        if sock is not None and hasattr(socket, "SO_PEERCRED"):
+            credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+            self._peer_pid = struct.unpack("3i", credentials)[0]
+        self._greeting = json.loads(await self._reader.readline())
+        if "QMP" not in self._greeting:
+            raise QMPError(f"Unexpected qmp greeting: {self._greeting}")
+        self._writer.write(json.dumps({"execute": "qmp_capabilities"}).encode() + b"\n")
+        await self._writer.drain()
+        while True:
+            message = json.loads(await self._reader.readline())
+            if "error" in message:
+                raise QMPError(message["error"].get("desc", "qmp_capabilities failed"))
+            if "return" in message:
+                break
+            self._dispatch_event(message)
+        self._connected.set()
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        assert self._reader is not None
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "event" in message:
+                    self._dispatch_event(message)
+                    continue
+                future = self._pending.pop(str(message.get("id")), None)
+                if future and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError):
+            pass
+        self._connection_lost()
+
+    def _connection_lost(self) -> None:
+        self._connected.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(QMPError("The qmp connection was closed"))
+        self._pending = {}
+        self._dispatch_event({"event": "QMP_DISCONNECTED", "data": {}})
+        if self._reconnect and not self._closing:
+            self._reconnect_task = asyncio.ensure_future(self._reconnect_loop())
+
+    async def _reconnect_loop(self) -> None:
+        delay = self.RECONNECT_DELAY
+        while not self._closing:
+            try:
+                await self._open()
+                return
+            except (OSError, ValueError, QMPError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def _dispatch_event(self, message: QMPMessage) -> None:
+        for queue in self._subscribers:
+            names = self._filters.get(id(queue))
+            if names is None or message["event"] in names:
+                queue.put_nowait(message)
+
+    def subscribe(self, names: Optional[List[str]] = None) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        self._filters[id(queue)] = set(names) if names else None
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+            self._filters.pop(id(queue), None)
+
+    async def wait_event(self, queue: asyncio.Queue, timeout: float) -> Optional[QMPMessage]:
+        try:
+            return await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def send(self, command: str, arguments: Optional[Dict] = None) -> asyncio.Future:
+        if self._writer is None or not self.connected:
+            raise QMPError("The qmp socket is not connected")
+        self._next_id += 1
+        command_id = str(self._next_id)
+        message: QMPMessage = {"execute": command, "id": command_id}
+        if arguments:
+            message["arguments"] = arguments
+        future = asyncio.get_event_loop().create_future()
+        self._pending[command_id] = future
+        # commands are written without waiting for the previous replies, the id pairs them back
+        self._writer.write(json.dumps(message).encode() + b"\n")
+        return future
+
+    async def execute(self, command: str, arguments: Optional[Dict] = None, timeout: float = 10.0) -> Any:
+        if not self.connected:
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise QMPError("The qmp socket is not connected")
+        future = self.send(command, arguments)
+        assert self._writer is not None
+        await self._writer.drain()
+        try:
+            reply = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise QMPError(f"Timeout waiting for the qmp command {command}")
+        if "error" in reply:
+            raise QMPError(f"{command}: {reply['error'].get('desc', reply['error'])}")
+        return reply.get("return")
+
+    async def execute_many(self, commands: List[str], timeout: float = 10.0) -> List[Any]:
+        return list(await asyncio.gather(*[self.execute(command, timeout=timeout) for command in commands]))
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._connected.clear()
+
+
+class MachineMonitor:
+    QUIT_TIMEOUT = 10.0
+
+    def __init__(self, socket_path: Union[str, Path]) -> None:
+        self._socket_path = Path(socket_path)
+
+    def is_available(self) -> bool:
+        return self._socket_path.exists()
+
+    async def _execute(self, command: str, arguments: Optional[Dict] = None) -> Any:
+        client = QMPClient(self._socket_path, reconnect=False)
+        await client.connect()
+        try:
+            return await client.execute(command, arguments)
+        finally:
+            await client.close()
+
+    def execute(self, command: str, arguments: Optional[Dict] = None) -> Any:
+        return asyncio.run(self._execute(command, arguments))
+
+    def status(self) -> str:
+        if not self.is_available():
+            return "stopped"
+        try:
+            result = self.execute("query-status")
+        except CommandError:
+            return "stopped"
+        return result.get("status", "unknown")
+
+    def pause(self) -> None:
+        self.execute("stop")
+
+    def resume(self) -> None:
+        self.execute("cont")
+
+    async def _stop(self, timeout: float) -> Optional[int]:
+        client = QMPClient(self._socket_path, reconnect=False)
+        await client.connect()
+        pid = client.peer_pid
+        events = client.subscribe(["SHUTDOWN", "QMP_DISCONNECTED"])
+        try:
+            await client.execute("system_powerdown")
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                event = await client.wait_event(events, deadline - time.monotonic())
+                if event is None:
+                    break
+                if event["event"] in ("SHUTDOWN", "QMP_DISCONNECTED"):
+                    return None
+            # the guest ignored the acpi power button, ask qemu to quit
+            try:
+                await client.execute("quit", timeout=self.QUIT_TIMEOUT)
+                while True:
+                    event = await client.wait_event(events, self.QUIT_TIMEOUT)
+                    if event is None:
+                        break
+                    if event["event"] == "QMP_DISCONNECTED":
+                        return None
+            except QMPError:
+                if not client.connected:
+                    return None
+            return pid
+        finally:
+            await client.close()
+
+    def stop(self, timeout: float) -> None:
+        pid = asyncio.run(self._stop(timeout))
+        if pid and os.path.exists(f"/proc/{pid}"):
+            ToolBase.execute_application(["sudo", "kill", "-KILL", str(pid)])
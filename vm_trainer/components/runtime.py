@@ -0,0 +1,189 @@
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Union
+
+from vm_trainer.exceptions import CommandError
+from vm_trainer.settings import Settings
+from vm_trainer.utils import read_text_file
+
+TAP_INTERFACE_PREFIX = "vmtrainertap"
+RUNTIME_SUFFIX = ".runtime.json"
+LOCK_SUFFIX = ".lock"
+
+MachineResources = Dict[str, List[str]]
+
+
+class RuntimeEntry:
+    def __init__(self, data: Dict) -> None:
+        self._data = data
+
+    @property
+    def name(self) -> str:
+        return self._data["name"]
+
+    @property
+    def tap_interface(self) -> str:
+        return self._data["tap"]
+
+    @property
+    def emulator_pid(self) -> Optional[int]:
+        return self._data.get("emulator-pid")
+
+    @property
+    def started(self) -> float:
+        return self._data["started"]
+
+    @property
+    def resources(self) -> MachineResources:
+        return self._data["resources"]
+
+    def emulator_running(self) -> bool:
+        # the pid may have been reused after a crash, only a qemu started for this machine counts
+        pid = self.emulator_pid
+        return bool(pid) and f"guest={self.name},debug-threads=on" in process_command_line(pid)
+
+    def uptime(self) -> float:
+        return max(time.time() - self.started, 0.0)
+
+    def to_dict(self) -> Dict:
+        return dict(self._data)
+
+
+class MachineLease:
+    def __init__(self, registry: "RuntimeRegistry", name: str, tap_interface: str, lock_fp: IO) -> None:
+        self._registry = registry
+        self._name = name
+        self._tap_interface = tap_interface
+        self._lock_fp = lock_fp
+
+    @property
+    def tap_interface(self) -> str:
+        return self._tap_interface
+
+    def set_emulator_pid(self, pid: int) -> None:
+        self._registry.update(self._name, {"emulator-pid": pid})
+
+    def release(self) -> None:
+        self._registry.remove(self._name)
+        # closing the file drops the lock, the lock file itself stays for the next launch
+        self._lock_fp.close()
+
+
+class RuntimeRegistry:
+    def __init__(self, run_dir: Union[str, Path, None] = None) -> None:
+        self._run_dir = Path(run_dir) if run_dir else Settings().run_dir()
+
+    def entry_path(self, name: str) -> Path:
+        return self._run_dir.joinpath(f"{name}{RUNTIME_SUFFIX}")
+
+    def lock_path(self, name: str) -> Path:
+        return self._run_dir.joinpath(f"{name}{LOCK_SUFFIX}")
+
+    def is_locked(self, name: str) -> bool:
+        # the launcher holds the machine lock for as long as the emulator runs
+        try:
+            with open(self.lock_path(name), "a") as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def read_entry(self, name: str) -> Optional[RuntimeEntry]:
+        try:
+            with open(self.entry_path(name), "r") as fp:
+                return RuntimeEntry(json.load(fp))
+        except (OSError, ValueError):
+            return None
+
+    def write_entry(self, data: Dict) -> None:
+        temp_path = f"{self.entry_path(data['name'])}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(data, fp)
+        os.replace(temp_path, self.entry_path(data["name"]))
+
+    def entry(self, name: str) -> Optional[RuntimeEntry]:
+        entry = self.read_entry(name)
+        if entry is None:
+            return None
+        if not self.is_locked(name) and not entry.emulator_running():
+            # the launcher died without cleaning up, a qemu it left behind still holds the resources
+            self.remove(name)
+            return None
+        return entry
+
+    def running(self) -> List[RuntimeEntry]:
+        entries = []
+        for filename in sorted(os.listdir(self._run_dir)):
+            if filename.endswith(RUNTIME_SUFFIX):
+                entry = self.entry(filename[:-len(RUNTIME_SUFFIX)])
+                if entry:
+                    entries.append(entry)
+        return entries
+
+    def update(self, name: str, values: Dict) -> None:
+        entry = self.read_entry(name)
+        if entry is None:
+            raise CommandError(f"The machine {name} is not running")
+        self.write_entry(dict(entry.to_dict(), **values))
+
+    def remove(self, name: str) -> None:
+        try:
+            os.unlink(self.entry_path(name))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def free_tap_interface(entries: List[RuntimeEntry]) -> str:
+        used = {entry.tap_interface for entry in entries}
+        index = 0
+        while f"{TAP_INTERFACE_PREFIX}{index}" in used:
+            index += 1
+        return f"{TAP_INTERFACE_PREFIX}{index}"
+
+    @staticmethod
+    def conflicts(resources: MachineResources, entries: List[RuntimeEntry]) -> List[str]:
+        conflicts = []
+        for entry in entries:
+            for kind, values in resources.items():
+                for value in sorted(set(values) & set(entry.resources.get(kind, []))):
+                    conflicts.append(f"{kind} {value} is used by {entry.name}")
+        return conflicts
+
+    def acquire(self, name: str, resources: MachineResources) -> MachineLease:
+        # the registry lock serializes the launches so two of them can't book the same resources
+        with open(self._run_dir.joinpath(f".registry{LOCK_SUFFIX}"), "a") as registry_fp:
+            fcntl.flock(registry_fp, fcntl.LOCK_EX)
+            lock_fp = open(self.lock_path(name), "a")
+            try:
+                fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_fp.close()
+                raise CommandError(f"The machine {name} is already running")
+            previous = self.read_entry(name)
+            if previous is not None and previous.emulator_running():
+                lock_fp.close()
+                raise CommandError(f"The emulator of {name} is still running as process {previous.emulator_pid}")
+            others = [entry for entry in self.running() if entry.name != name]
+            conflicts = self.conflicts(resources, others)
+            if conflicts:
+                lock_fp.close()
+                raise CommandError("The machine can't start, " + "; ".join(conflicts))
+            tap_interface = self.free_tap_interface(others)
+            self.write_entry({
+                "name": name,
+                "launcher-pid": os.getpid(),
+                "emulator-pid": None,
+                "started": time.time(),
+                "tap": tap_interface,
+                "resources": resources,
+            })
+        return MachineLease(self, name, tap_interface, lock_fp)
+
+
+def process_command_line(pid: int) -> List[str]:
+    return [item for item in read_text_file(f"/proc/{pid}/cmdline").split("\0") if item]
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import click
+
+from vm_trainer.components.qmp import QMPClient
+from vm_trainer.exceptions import CommandError
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+INTERFACE_COUNTERS = ("rx_bytes", "tx_bytes", "rx_packets", "tx_packets", "rx_dropped", "tx_dropped")
+BLOCK_COUNTERS = ("rd_bytes", "wr_bytes", "rd_operations", "wr_operations", "flush_operations",
+                  "rd_total_time_ns", "wr_total_time_ns")
+
+Sample = Dict[str, Any]
+
+
+class CachedFile:
+    def __init__(self, filepath: Union[str, Path]) -> None:
+        self._filepath = str(filepath)
+        self._fd: Optional[int] = None
+
+    def read(self) -> Optional[str]:
+        try:
+            if self._fd is None:
+                self._fd = os.open(self._filepath, os.O_RDONLY)
+            # pread from offset 0 refreshes procfs and sysfs files without reopening them
+            return os.pread(self._fd, 4096, 0).decode()
+        except OSError:
+            self.close()
+            return None
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class ThreadCpuTime:
+    def __init__(self, pid: int, tid: int, proc_root: Union[str, Path] = "/proc") -> None:
+        self._file = CachedFile(Path(proc_root).joinpath(str(pid), "task", str(tid), "stat"))
+
+    def seconds(self) -> Optional[float]:
+        stat = self._file.read()
+        if not stat:
+            return None
+        fields = stat[stat.rfind(")") + 2:].split()
+        # utime and stime are the fields 14 and 15 of the stat file
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class InterfaceStatistics:
+    def __init__(self, interface: str, sysfs_root: Union[str, Path] = "/sys") -> None:
+        statistics_dir = Path(sysfs_root).joinpath("class", "net", interface, "statistics")
+        self._files = {name: CachedFile(statistics_dir.joinpath(name)) for name in INTERFACE_COUNTERS}
+
+    def counters(self) -> Dict[str, int]:
+        result = {}
+        for name, cached_file in self._files.items():
+            value = cached_file.read()
+            if value is not None:
+                result[name] = int(value)
+        return result
+
+    def close(self) -> None:
+        for cached_file in self._files.values():
+            cached_file.close()
+
+
+class MachineSampler:
+    def __init__(self, name: str, socket_path: Union[str, Path], interface: str,
+                 proc_root: Union[str, Path] = "/proc", sysfs_root: Union[str, Path] = "/sys") -> None:
+        self._name = name
+        self._client = QMPClient(socket_path)
+        self._interface = InterfaceStatistics(interface, sysfs_root)
+        self._interface_name = interface
+        self._proc_root = proc_root
+        self._pid = 0
+        self._vcpus: Dict[int, ThreadCpuTime] = {}
+        self._iothreads: Dict[str, ThreadCpuTime] = {}
+        self._emulator: Optional[ThreadCpuTime] = None
+        self._previous: Optional[Sample] = None
+
+    async def start(self) -> None:
+        await self._client.connect()
+        await self.discover_threads()
+
+    async def discover_threads(self) -> None:
+        cpus, iothreads = await self._client.execute_many(["query-cpus-fast", "query-iothreads"])
+        self._pid = self._client.peer_pid or 0
+        if not self._pid:
+            raise CommandError("Could not find the emulator process id")
+        self.close_threads()
+        self._vcpus = {cpu["cpu-index"]: ThreadCpuTime(self._pid, cpu["thread-id"], self._proc_root) for cpu in cpus}
+        self._iothreads = {thread["id"]: ThreadCpuTime(self._pid, thread["thread-id"], self._proc_root) for thread in iothreads}
+        self._emulator = ThreadCpuTime(self._pid, self._pid, self._proc_root)
+
+    def close_threads(self) -> None:
+        for reader in list(self._vcpus.values()) + list(self._iothreads.values()):
+            reader.close()
+        if self._emulator:
+            self._emulator.close()
+
+    async def stop(self) -> None:
+        self.close_threads()
+        self._interface.close()
+        await self._client.close()
+
+    async def sample(self) -> Sample:
+        blockstats = await self._client.execute("query-blockstats")
+        vcpus = {index: reader.seconds() for index, reader in self._vcpus.items()}
+        if any(value is None for value in vcpus.values()):
+            # the emulator was restarted or a vcpu was unplugged
+            await self.discover_threads()
+            vcpus = {index: reader.seconds() for index, reader in self._vcpus.items()}
+        sample: Sample = {
+            "machine": self._name,
+            "timestamp": time.time(),
+            "pid": self._pid,
+            "emulator_seconds": self._emulator.seconds() if self._emulator else None,
+            "vcpu_seconds": vcpus,
+            "iothread_seconds": {name: reader.seconds() for name, reader in self._iothreads.items()},
+            "block": {
+                (device.get("qdev") or device.get("device") or device.get("node-name", "")): {
+                    name: device["stats"].get(name, 0) for name in BLOCK_COUNTERS
+                }
+                for device in blockstats
+            },
+            "interface": self._interface_name,
+            "network": self._interface.counters(),
+        }
+        self.add_rates(sample)
+        self._previous = sample
+        return sample
+
+    def add_rates(self, sample: Sample) -> None:
+        previous = self._previous
+        if not previous:
+            return
+        elapsed = sample["timestamp"] - previous["timestamp"]
+        if elapsed <= 0:
+            return
+
+        def usage(current: Optional[float], before: Optional[float]) -> Optional[float]:
+            if current is None or before is None:
+                return None
+            return round(100.0 * (current - before) / elapsed, 1)
+
+        sample["vcpu_usage_percent"] = {
+            index: usage(value, previous["vcpu_seconds"].get(index)) for index, value in sample["vcpu_seconds"].items()
+        }
+        sample["iothread_usage_percent"] = {
+            name: usage(value, previous["iothread_seconds"].get(name)) for name, value in sample["iothread_seconds"].items()
+        }
+        sample["block_bytes_per_second"] = {
+            device: {
+                "read": round((stats["rd_bytes"] - previous["block"].get(device, stats)["rd_bytes"]) / elapsed),
+                "write": round((stats["wr_bytes"] - previous["block"].get(device, stats)["wr_bytes"]) / elapsed),
+            }
+            for device, stats in sample["block"].items()
+        }
+        sample["network_bytes_per_second"] = {
+            name: round((sample["network"][name] - previous["network"].get(name, sample["network"][name])) / elapsed)
+            for name in ("rx_bytes", "tx_bytes") if name in sample["network"]
+        }
+
+
+def format_json(sample: Sample) -> str:
+    return json.dumps(sample, sort_keys=True)
+
+
+def escape_label(value: Any) -> str:
+    # the exposition format escapes the backslash, the double quote and the line feed of label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus(samples: List[Sample]) -> str:
+    metrics: Dict[str, List[str]] = {}
+    help_texts = {
+        "vmtrainer_emulator_cpu_seconds_total": "CPU time of the emulator main thread",
+        "vmtrainer_vcpu_cpu_seconds_total": "CPU time of each vcpu thread",
+        "vmtrainer_iothread_cpu_seconds_total": "CPU time of each iothread",
+        "vmtrainer_block_counter_total": "Block device counters from query-blockstats",
+        "vmtrainer_network_counter_total": "Tap interface counters",
+    }
+
+    def add(metric: str, labels: Dict[str, Any], value: Any) -> None:
+        if value is None:
+            return
+        label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        metrics.setdefault(metric, []).append(f"{metric}{{{label_text}}} {value}")
+
+    for sample in samples:
+        machine = sample["machine"]
+        add("vmtrainer_emulator_cpu_seconds_total", {"machine": machine}, sample["emulator_seconds"])
+        for index, value in sample["vcpu_seconds"].items():
+            add("vmtrainer_vcpu_cpu_seconds_total", {"machine": machine, "vcpu": index}, value)
+        for name, value in sample["iothread_seconds"].items():
+            add("vmtrainer_iothread_cpu_seconds_total", {"machine": machine, "iothread": name}, value)
+        for device, stats in sample["block"].items():
+            for counter, value in stats.items():
+                add("vmtrainer_block_counter_total", {"machine": machine, "device": device, "counter": counter}, value)
+        for counter, value in sample["network"].items():
+            add("vmtrainer_network_counter_total", {"machine": machine, "interface": sample["interface"], "counter": counter}, value)
+
+    lines: List[str] = []
+    for metric, values in metrics.items():
+        lines.append(f"# HELP {metric} {help_texts[metric]}")
+        lines.append(f"# TYPE {metric} counter")
+        lines += values
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    def __init__(self, sampler: MachineSampler, interval: float) -> None:
+        self._sampler = sampler
+        self._interval = interval
+        self._last: Optional[Sample] = None
+
+    async def sample_loop(self) -> None:
+        while True:
+            self._last = await self._sampler.sample()
+            await asyncio.sleep(self._interval)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request.split(b" ")[1] if request.count(b" ") >= 2 else b"/"
+        if path.startswith(b"/metrics") and self._last:
+            body = format_prometheus([self._last]).encode()
+            status = b"200 OK"
+        else:
+            body = b"not found\n"
+            status = b"404 Not Found"
+        headers = b"Content-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)).encode()
+        writer.write(b"HTTP/1.0 " + status + b"\r\n" + headers + b"\r\n\r\n" + body)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, address: str, port: int) -> None:
+        await self._sampler.start()
+        server = await asyncio.start_server(self.handle, address, port)
+        try:
+            await asyncio.gather(server.serve_forever(), self.sample_loop())
+        finally:
+            server.close()
+            await self._sampler.stop()
+
+
+async def stream_samples(sampler: MachineSampler, interval: float, count: int, output_format: str) -> None:
+    await sampler.start()
+    try:
+        taken = 0
+        while not count or taken < count:
+            sample = await sampler.sample()
+            if output_format == "prometheus":
+                click.echo(format_prometheus([sample]))
+            else:
+                click.echo(format_json(sample))
+            taken += 1
+            if not count or taken < count:
+                await asyncio.sleep(interval)
+    finally:
+        await sampler.stop()
@@ -1,14 +1,21 @@
 import os
+import re
+import shlex
+import shutil
 import subprocess
+import time
 from getpass import getuser
 from pathlib import Path
-from typing import List, Union, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import click
 
+from vm_trainer.components.probes import (PROBE_CACHE, ProbeCommands,
+                                          ProbeOutputs)
 from vm_trainer.exceptions import CommandError
+from vm_trainer.profiling import PROFILER
 from vm_trainer.settings import Settings
-from vm_trainer.utils import run_read_output
+from vm_trainer.utils import format_cpu_list
 
 CommandArgs = List[str]
 
@@ -34,35 +41,57 @@ class ToolBase(object):
     DO_NOTHING_PARAMETER = "--version"
 
     @staticmethod
-    def execute_application(parameters: CommandArgs, cwd: Union[str, None] = None) -> None:
+    def execute_application(parameters: CommandArgs, cwd: Union[str, None] = None, quiet: bool = False) -> None:
+        start = time.perf_counter()
+        exit_status = None
         try:
-            kwargs = {}
+            kwargs: Dict[str, Any] = {}
             if cwd:
                 kwargs["cwd"] = cwd
+            if quiet:
+                kwargs["stdout"] = subprocess.DEVNULL
             subprocess.check_call(parameters, **kwargs)  # type: ignore
+            exit_status = 0
         except subprocess.CalledProcessError as e:
+            exit_status = e.returncode
             raise CommandError(e.args[0])
+        finally:
+            PROFILER.record_command(parameters, start, exit_status)
+
+    @staticmethod
+    def spawn_application(parameters: CommandArgs) -> subprocess.Popen:
+        start = time.perf_counter()
+        try:
+            return subprocess.Popen(parameters)
+        except OSError as e:
+            raise CommandError(f"Could not start {parameters[0]}: {e}")
+        finally:
+            PROFILER.record_command(parameters, start, None)
 
     def execute(self, parameters: CommandArgs) -> None:
         self.execute_application([self.TOOL_NAME] + parameters)
 
-    def execute_as_super(self, parameters: CommandArgs) -> None:
-        # self.execute_application(["sudo", "chrt", "-r", "1", "taskset", "-c", "0-3", self.TOOL_NAME] + parameters)
-        self.execute_application(["sudo", self.TOOL_NAME] + parameters)
+    def execute_as_super(self, parameters: CommandArgs, quiet: bool = False) -> None:
+        self.execute_application(["sudo", self.TOOL_NAME] + parameters, quiet=quiet)
+
+    def spawn_as_super(self, parameters: CommandArgs) -> subprocess.Popen:
+        return self.spawn_application(["sudo", self.TOOL_NAME] + parameters)
 
     def install(self, show_message: bool = False) -> None:
         raise NotImplementedError()
 
+    def probe_commands(self) -> ProbeCommands:
+        return {"version": [self.DO_NOTHING_PARAMETER]}
+
+    def probe(self, commands: Optional[ProbeCommands] = None) -> Optional[ProbeOutputs]:
+        return PROBE_CACHE.probe(self.TOOL_NAME, commands or self.probe_commands())
+
     def exists(self, show_message: bool = False) -> bool:
-        with open(os.devnull, "w") as nullfp:
-            try:
-                subprocess.check_call([self.TOOL_NAME, self.DO_NOTHING_PARAMETER], stdout=nullfp)
-                if show_message:
-                    click.echo(self.alread_installed_message())
-                return True
-            except FileNotFoundError:
-                pass
+        if self.probe() is None:
             return False
+        if show_message:
+            click.echo(self.alread_installed_message())
+        return True
 
     def must_exists(self) -> None:
         if not self.exists():
@@ -184,25 +213,21 @@ class IpTool(ToolBase):
             return fp.read().strip()
 
     def interface_exists(self, name: str) -> bool:
-        try:
-            data = "".join(run_read_output(["ip", "-o", "link", "show", name])).strip()
-        except subprocess.CalledProcessError:
-            data = ""
-        return name in data
-
-    def create_bridge_interface(self, name: str, ip_address: str) -> None:
-        if self.interface_exists(name):
-            return
-        self.execute_as_super(["link", "add", "name", name, "type", "bridge"])
-        self.execute_as_super(["addr", "add", "dev", name, ip_address])
-        self.execute_as_super(["link", "set", name, "up"])
+        return os.path.exists(f"/sys/class/net/{name}")
 
-    def create_tap_interface(self, name: str, bridge_name: str) -> None:
-        if self.interface_exists(name):
-            return
-        self.execute_as_super(["tuntap", "add", "dev", name, "mode", "tap"])
-        self.execute_as_super(["link", "set", name, "master", bridge_name])
-        self.execute_as_super(["link", "set", name, "up"])
+    def run_batch(self, commands: List[str], force: bool = False) -> Tuple[int, str]:
+        parameters = ["sudo", self.TOOL_NAME] + (["-force"] if force else []) + ["-batch", "-"]
+        start = time.perf_counter()
+        exit_status = None
+        try:
+            result = subprocess.run(parameters, input="\n".join(commands) + "\n", stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, universal_newlines=True)
+            exit_status = result.returncode
+            return result.returncode, result.stderr
+        except OSError as e:
+            return 1, str(e)
+        finally:
+            PROFILER.record_command(parameters, start, exit_status)
 
     def remove_tap_interface(self, name: str) -> None:
         if not self.interface_exists(name):
@@ -229,32 +254,95 @@ class EmulatorTool(ToolBase):
     TOOL_NAME = "qemu-system-x86_64"
     DO_NOTHING_PARAMETER = "-version"
 
+    VERSION_RE = re.compile(r"version ([0-9]+)\.([0-9]+)(?:\.([0-9]+))?")
+    DEVICE_NAME_RE = re.compile(r'name "([^"]+)"')
+    PROPERTY_NAME_RE = re.compile(r"^\s*([a-zA-Z0-9_.-]+)=")
+
     def __init__(self) -> None:
         self.TOOL_NAME = Settings().qemu_binary_path()
 
+    def probe_commands(self) -> ProbeCommands:
+        return {
+            "version": ["-version"],
+            "devices": ["-device", "help"],
+            "accelerators": ["-accel", "help"],
+        }
+
+    def probe_output(self, name: str, commands: Optional[ProbeCommands] = None) -> str:
+        outputs = self.probe(commands)
+        if outputs is None:
+            raise CommandError(f"The tool {self.TOOL_NAME} is not present in your system")
+        return outputs[name]
+
+    def version(self) -> Tuple[int, int, int]:
+        match = self.VERSION_RE.search(self.probe_output("version"))
+        if match:
+            return (int(match.group(1)), int(match.group(2)), int(match.group(3) or 0))
+        raise CommandError(f"Could not read the version of {self.TOOL_NAME}")
+
+    def supported_devices(self) -> List[str]:
+        return self.DEVICE_NAME_RE.findall(self.probe_output("devices"))
+
+    def accelerators(self) -> List[str]:
+        lines = self.probe_output("accelerators").splitlines()
+        if not lines or not lines[0].startswith("Accelerators supported"):
+            # qemu older than 4.0 has no -accel help
+            return []
+        return [line.strip() for line in lines[1:] if line.strip()]
+
+    def device_properties(self, device: str) -> List[str]:
+        name = f"device:{device}"
+        output = self.probe_output(name, {name: ["-device", f"{device},help"]})
+        properties = []
+        for line in output.splitlines():
+            match = self.PROPERTY_NAME_RE.match(line)
+            if match:
+                properties.append(match.group(1))
+        return properties
+
+    def spawn_with_devices(self, parameters: CommandArgs, devices: Dict[int, str]) -> subprocess.Popen:
+        if not devices:
+            return self.spawn_as_super(parameters)
+        # the devices are root only, the shell opens them as root and execs the emulator with the descriptors
+        redirections = " ".join(f"{fd}<>{shlex.quote(path)}" for fd, path in sorted(devices.items()))
+        return self.spawn_application(["sudo", "sh", "-c", f'exec "$0" "$@" {redirections}', self.TOOL_NAME] + parameters)
+
     def install(self, show_message: bool = True) -> None:
         if self.exists(show_message):
             return
-        PackageTool().install_qemu_kvm()
+        package_tool().install_qemu_kvm()
+
+
+class TeeTool(ToolBase):
+    TOOL_NAME = "tee"
+
+    def write(self, filepath: Union[str, Path], value: str) -> None:
+        try:
+            with open(filepath, "w") as fp:
+                fp.write(value)
+            return
+        except PermissionError:
+            pass
+        except OSError as e:
+            raise CommandError(f"Could not write '{value.strip()}' to {filepath}: {e.strerror}")
+        try:
+            subprocess.run(["sudo", self.TOOL_NAME, str(filepath)], input=value, stdout=subprocess.DEVNULL,
+                           universal_newlines=True, check=True)
+        except subprocess.CalledProcessError:
+            raise CommandError(f"Could not write '{value.strip()}' to {filepath}")
+
+
+class TasksetTool(ToolBase):
+    TOOL_NAME = "taskset"
+
+    def set_affinity(self, pid: int, cpus: List[int], all_threads: bool = False) -> None:
+        parameters = ["-a"] if all_threads else []
+        self.execute_as_super(parameters + ["-p", "-c", format_cpu_list(cpus), str(pid)], quiet=True)
 
 
 class IpTablesTool(ToolBase):
     TOOL_NAME = "iptables"
 
-    def create_nat_routing(self, bridge_interface: str, target_interface: str) -> None:
-        for command in [
-            ["-t", "nat", "-D", "POSTROUTING", "-o", target_interface, "-j", "MASQUERADE"],
-            ["-D", "FORWARD", "-m", "conntrack", "--ctstate", "RELATED,ESTABLISHED", "-j", "ACCEPT"],
-            ["-D", "FORWARD", "-i", bridge_interface, "-o", target_interface, "-j", "ACCEPT"]
-        ]:
-            try:
-                self.execute_as_super(command)
-            except:
-                pass
-        self.execute_as_super(["-t", "nat", "-A", "POSTROUTING", "-o", target_interface, "-j", "MASQUERADE"])
-        self.execute_as_super(["-A", "FORWARD", "-m", "conntrack", "--ctstate", "RELATED,ESTABLISHED", "-j", "ACCEPT"])
-        self.execute_as_super(["-A", "FORWARD", "-i", bridge_interface, "-o", target_interface, "-j", "ACCEPT"])
-
 
 class GitTool(ToolBase):
     TOOL_NAME = "git"
@@ -262,13 +350,13 @@ class GitTool(ToolBase):
     def install(self, show_message: bool = True) -> None:
         if self.exists(False):
             return
-        PackageTool().install_git()
+        package_tool().install_git()
         if not self.exists(False):
             raise CommandError("Could not install git tool")
 
     def clone(self, url: str, dir_name: str, tag: Optional[str]) -> str:
         if not self.exists(False):
-            PackageTool().install_git()
+            package_tool().install_git()
         if not self.exists(False):
             raise CommandError("The git tool is required to install scream.")
         settings = Settings()
@@ -282,4 +370,8 @@ class GitTool(ToolBase):
         return clone_path
 
 
-PackageTool = PacmanTool if PacmanTool().exists() else AptGetTool
+def package_tool() -> PackageManagementTool:
+    # detected on demand, only the install commands need the package manager
+    if shutil.which(PacmanTool.TOOL_NAME):
+        return PacmanTool()
+    return AptGetTool()
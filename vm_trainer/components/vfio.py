@@ -0,0 +1,144 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import click
+
+from vm_trainer.components.pci import PciScanner
+from vm_trainer.components.tools import TeeTool, ToolBase
+from vm_trainer.exceptions import CommandError
+from vm_trainer.settings import Settings
+
+VFIO_DRIVER = "vfio-pci"
+BRIDGE_CLASS_CODE = 0x0604
+
+BindState = Dict[str, Dict[str, str]]
+
+
+class VfioBinder:
+    SYSFS_ROOT = "/sys"
+
+    def __init__(self, sysfs_root: Union[str, Path, None] = None, state_path: Union[str, Path, None] = None,
+                 writer: Optional[TeeTool] = None) -> None:
+        self._root = Path(sysfs_root or self.SYSFS_ROOT)
+        self._state_path = Path(state_path) if state_path else None
+        self._scanner = PciScanner(self._root)
+        # the sysfs attributes are only writable by root, the tool falls back on sudo tee
+        self._writer = writer or TeeTool()
+
+    def state_path(self) -> Path:
+        if self._state_path is None:
+            self._state_path = Settings().run_dir().joinpath("vfio-bindings.json")
+        return self._state_path
+
+    def load_state(self) -> BindState:
+        try:
+            with open(self.state_path(), "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, state: BindState) -> None:
+        temp_path = f"{self.state_path()}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(state, fp)
+        os.replace(temp_path, self.state_path())
+
+    def pci_dir(self) -> Path:
+        return self._root.joinpath("bus", "pci")
+
+    def device_dir(self, address: str) -> Path:
+        return self.pci_dir().joinpath("devices", address)
+
+    def driver(self, address: str) -> Optional[str]:
+        driver_link = self.device_dir(address).joinpath("driver")
+        if not driver_link.is_symlink():
+            return None
+        return os.path.basename(os.readlink(driver_link))
+
+    def group_addresses(self, address: str) -> List[str]:
+        devices_dir = self.device_dir(address).joinpath("iommu_group", "devices")
+        if not devices_dir.is_dir():
+            raise CommandError(f"The device {address} is not in an IOMMU group, is the IOMMU enabled?")
+        return sorted(os.listdir(devices_dir))
+
+    def check_groups(self, addresses: List[str]) -> None:
+        # vfio only hands a group to the guest when every endpoint in it is owned by vfio
+        for address in addresses:
+            if not self.device_dir(address).exists():
+                raise CommandError(f"The pci device {address} does not exist")
+            for member in self.group_addresses(address):
+                if member in addresses or self.driver(member) == VFIO_DRIVER:
+                    continue
+                if self._scanner.device(member).class_code >> 8 == BRIDGE_CLASS_CODE:
+                    continue
+                raise CommandError(
+                    f"The IOMMU group of {address} also contains {member} (driver {self.driver(member) or 'none'}),"
+                    f" pass it through as well or move the card to a slot with its own group"
+                )
+
+    def ensure_driver(self) -> None:
+        if self.pci_dir().joinpath("drivers", VFIO_DRIVER).exists():
+            return
+        ToolBase.execute_application(["sudo", "modprobe", VFIO_DRIVER])
+        if not self.pci_dir().joinpath("drivers", VFIO_DRIVER).exists():
+            raise CommandError(f"The {VFIO_DRIVER} driver is not available")
+
+    def bind_device(self, address: str) -> None:
+        tee = self._writer
+        tee.write(self.device_dir(address).joinpath("driver_override"), f"{VFIO_DRIVER}\n")
+        if self.driver(address):
+            tee.write(self.device_dir(address).joinpath("driver", "unbind"), address)
+        tee.write(self.pci_dir().joinpath("drivers_probe"), address)
+        if self.driver(address) != VFIO_DRIVER:
+            raise CommandError(f"The device {address} did not bind to {VFIO_DRIVER}")
+
+    def release_device(self, address: str, original: Optional[str]) -> None:
+        tee = self._writer
+        tee.write(self.device_dir(address).joinpath("driver_override"), "\n")
+        if self.driver(address) == VFIO_DRIVER:
+            tee.write(self.device_dir(address).joinpath("driver", "unbind"), address)
+        try:
+            tee.write(self.pci_dir().joinpath("drivers_probe"), address)
+        except CommandError:
+            pass
+        if not original or self.driver(address) == original:
+            return
+        # some host drivers refuse to rebind to a device that was reset by vfio, a rescan recreates it
+        tee.write(self.device_dir(address).joinpath("remove"), "1")
+        tee.write(self.pci_dir().joinpath("rescan"), "1")
+        if self.driver(address) != original:
+            click.echo(f"The device {address} did not return to the {original} driver")
+
+    def bind(self, addresses: List[str], owner: str) -> List[str]:
+        pending = [address for address in addresses if self.driver(address) != VFIO_DRIVER]
+        if not pending:
+            return []
+        self.check_groups(addresses)
+        self.ensure_driver()
+        state = self.load_state()
+        bound: List[str] = []
+        try:
+            for address in pending:
+                state[address] = {"driver": self.driver(address) or "", "owner": owner}
+                bound.append(address)
+                self.bind_device(address)
+        except CommandError:
+            # leave the host as it was, a half bound card is unusable for the guest and the host
+            for address in reversed(bound):
+                self.release_device(address, state.pop(address)["driver"] or None)
+            self.save_state(state)
+            raise
+        self.save_state(state)
+        return bound
+
+    def release(self, addresses: List[str]) -> None:
+        state = self.load_state()
+        for address in reversed(addresses):
+            entry = state.pop(address, {})
+            self.release_device(address, entry.get("driver") or None)
+        self.save_state(state)
+
+    def bound_by(self, owner: str) -> List[str]:
+        return sorted(address for address, entry in self.load_state().items() if entry.get("owner") == owner)
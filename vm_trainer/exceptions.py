@@ -1,2 +1,6 @@
 class CommandError(Exception):
     pass
+
+
+class QMPError(CommandError):
+    pass
@@ -1,2 +0,0 @@
-from vm_trainer.management import (dependencies, device_info, machines,  # noqa
-                                   network, settings, tpm_service)  # noqa
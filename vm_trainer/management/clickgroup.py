@@ -1,8 +1,75 @@
-from typing import NoReturn
+import cProfile
+import importlib
+import os
+from typing import List, Optional
 
 import click
 
+from vm_trainer.profiling import (PROFILE_OUTPUT_ENV, PROFILER,
+                                  profiling_requested)
+from vm_trainer.settings import Settings
 
-@click.group()
-def cli() -> NoReturn:
-    pass
+# the command modules register themselves on import, only the module of the invoked command is loaded
+COMMAND_MODULES = (
+    ("depman-", "vm_trainer.management.dependencies"),
+    ("gpu-", "vm_trainer.management.gpus"),
+    ("job-", "vm_trainer.management.jobs"),
+    ("show-", "vm_trainer.management.device_info"),
+    ("user-input-", "vm_trainer.management.device_info"),
+    ("machine-", "vm_trainer.management.machines"),
+    ("network-", "vm_trainer.management.network"),
+    ("profile-", "vm_trainer.management.profiling"),
+    ("settings-", "vm_trainer.management.settings"),
+    ("tpm-", "vm_trainer.management.tpm_service"),
+)
+
+
+class LazyGroup(click.Group):
+    def load_module(self, cmd_name: str) -> None:
+        for prefix, module_name in COMMAND_MODULES:
+            if cmd_name.startswith(prefix):
+                importlib.import_module(module_name)
+        if cmd_name not in self.commands:
+            # unknown names load everything so click can suggest the closest command
+            self.load_all()
+
+    def load_all(self) -> None:
+        for _, module_name in COMMAND_MODULES:
+            importlib.import_module(module_name)
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        self.load_all()
+        return super().list_commands(ctx)
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name not in self.commands:
+            self.load_module(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+
+def finish_profiling(command: str, output: Optional[str], profile: Optional[cProfile.Profile]) -> None:
+    if profile:
+        profile.disable()
+        if output:
+            profile.dump_stats(output)
+    elif output:
+        PROFILER.dump_trace(output)
+    for line in PROFILER.report():
+        click.echo(line, err=True)
+    PROFILER.append_history(Settings().profile_history_path(), command)
+
+
+@click.group(cls=LazyGroup)
+@click.option("--profile", is_flag=True, default=False, help="Print a phase and subprocess timing breakdown (or set VMTRAINER_PROFILE=1)")
+@click.option("--profile-output", default=None, help="Dump a cProfile file, or a trace-event file when the name ends with .json")
+@click.pass_context
+def cli(ctx: click.Context, profile: bool, profile_output: Optional[str]) -> None:
+    output = profile_output or os.environ.get(PROFILE_OUTPUT_ENV)
+    if not (profile or output or profiling_requested()):
+        return
+    PROFILER.enable()
+    python_profile = None
+    if output and not output.endswith(".json"):
+        python_profile = cProfile.Profile()
+        python_profile.enable()
+    ctx.call_on_close(lambda: finish_profiling(ctx.invoked_subcommand or "", output, python_profile))
@@ -1,5 +1,5 @@
 from vm_trainer.components.dependencies import DependencyManager
-from vm_trainer.components.tools import PackageTool
+from vm_trainer.components.tools import package_tool
 from vm_trainer.management.clickgroup import cli
 
 
@@ -10,19 +10,19 @@ def depman_check() -> None:
 
 @cli.command(help="Install qemu kvm tools")
 def depman_install_qemu() -> None:
-    PackageTool().install_qemu_kvm()
+    package_tool().install_qemu_kvm()
 
 
 @cli.command(help="Install git")
 def depman_install_git() -> None:
-    PackageTool().install_git()
+    package_tool().install_git()
 
 
 @cli.command(help="Install build essentials")
 def depman_install_build_tools() -> None:
-    PackageTool().install_build_essential()
+    package_tool().install_build_essential()
 
 
 @cli.command(help="Install scream")
 def depman_install_scream() -> None:
-    PackageTool().install_scream()
+    package_tool().install_scream()
@@ -1,9 +1,10 @@
 import click
 
+from vm_trainer.components.gpu import discover_gpus, function_role
+from vm_trainer.components.pci import PciScanner
 from vm_trainer.components.user_input import UserInput
 from vm_trainer.management.clickgroup import cli
-from vm_trainer.utils import (get_iommu_devices, get_IOMMU_information,
-                              gpus_from_iommu_devices)
+from vm_trainer.utils import get_iommu_devices, get_IOMMU_information
 
 
 @cli.command(help="Show IOMMU information")
@@ -19,10 +20,15 @@ def show_iommu_devices() -> None:
 
 
 @cli.command(help="List GPUs in IOMMU groups")
-def show_gpus() -> None:
-    for gpu in gpus_from_iommu_devices():
-        click.echo(f"GPU: {gpu.video_vendor}")
-        click.echo(f"Addresses, video: [0000:{gpu.video_address}] audio: [0000:{gpu.audio_address}]")
+@click.option("--links", is_flag=True, default=False, help="Show the pcie link of each gpu and flag degraded links")
+def show_gpus(links: bool) -> None:
+    scanner = PciScanner()
+    for gpu in discover_gpus(scanner=scanner):
+        click.echo(f"GPU: {gpu.description}")
+        click.echo(f"Functions: {', '.join(f'[{device.address}] {function_role(device)}' for device in gpu.functions())}")
+        if links:
+            link = scanner.link(gpu.video_address)
+            click.echo(f"Link: {link.describe() if link else 'not reported by the kernel'}")
 
 
 @cli.command(help="List avaliable evdev user inputs")
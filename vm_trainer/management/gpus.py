@@ -0,0 +1,33 @@
+import click
+
+from vm_trainer.components.machine import Machine
+from vm_trainer.components.vfio import VfioBinder
+from vm_trainer.management.clickgroup import cli
+
+
+@cli.command(help="Move every function of the machine gpus to the vfio-pci driver")
+@click.option("--name", required=True)
+def gpu_bind_vfio(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    bound = machine.bind_gpus()
+    if not bound:
+        click.echo("The gpus are already bound to vfio-pci")
+    for address in bound:
+        click.echo(f"Bound {address} to vfio-pci")
+
+
+@cli.command(help="Return the machine gpus to the host drivers")
+@click.option("--name", required=True)
+@click.option("--all-functions", is_flag=True, default=False, help="Also release functions bound to vfio-pci outside vm-trainer")
+def gpu_release(name: str, all_functions: bool) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    addresses = None if all_functions else VfioBinder().bound_by(name)
+    if addresses == []:
+        click.echo("No gpu functions were bound by this machine")
+        return
+    machine.release_gpus(addresses)
+    binder = VfioBinder()
+    for address in addresses or machine.gpu_function_addresses():
+        click.echo(f"{address}: {binder.driver(address) or 'no driver'}")
@@ -0,0 +1,72 @@
+import json
+import time
+from getpass import getuser
+from typing import Optional
+
+import click
+
+from vm_trainer.components.machine import Machine
+from vm_trainer.exceptions import CommandError
+from vm_trainer.management.clickgroup import cli
+from vm_trainer.scheduler.core import BACKFILL_GRACE, Scheduler
+from vm_trainer.scheduler.jobs import ACTIVE_STATES, JobQueue
+from vm_trainer.scheduler.launcher import GpuInventory, MachineLauncher
+
+JOB_LIST_FORMATS = ("text", "json")
+
+
+@cli.command(help="Queue a job on a copy of a machine with free gpus")
+@click.option("--machine-template", "template", required=True, help="The machine the job instances are cloned from")
+@click.option("--gpus", "gpu_count", default=1, type=int, help="Number of gpus for the job")
+@click.option("--cmd", "command", required=True, help="The command the guest runs, read from the opt/vm-trainer/job-command fw_cfg")
+@click.option("--priority", default=0, type=int, help="Jobs with higher priorities start first")
+@click.option("--user", default=None, help="The user the job is accounted to (default = current user)")
+def job_submit(template: str, gpu_count: int, command: str, priority: int, user: Optional[str]) -> None:
+    Machine(template).must_exists()
+    if gpu_count < 1:
+        raise CommandError("A job needs at least one gpu")
+    with JobQueue().locked() as queue:
+        job = queue.submit(template, gpu_count, command, user or getuser(), priority)
+    click.echo(f"Submitted job {job.job_id}")
+
+
+@cli.command(help="List the queued and running jobs")
+@click.option("--all", "show_all", is_flag=True, default=False, help="Also list the finished jobs")
+@click.option("--format", "output_format", default="text", type=click.Choice(JOB_LIST_FORMATS), help="One line per job or a json list")
+def job_list(show_all: bool, output_format: str) -> None:
+    queue = JobQueue()
+    queue.load()
+    jobs = queue.jobs(None if show_all else list(ACTIVE_STATES))
+    if output_format == "json":
+        click.echo(json.dumps([job.to_dict() for job in jobs], indent=2))
+        return
+    for job in jobs:
+        click.echo(job.describe())
+
+
+@cli.command(help="Cancel a queued job or kill the machine of a running one")
+@click.option("--id", "job_id", required=True, type=int, help="The job id")
+def job_cancel(job_id: int) -> None:
+    with JobQueue().locked() as queue:
+        job = queue.job(job_id)
+        if job.state not in ACTIVE_STATES:
+            raise CommandError(f"The job {job_id} is already {job.state}")
+        job.request_cancel(time.time())
+    if job.state == "running":
+        MachineLauncher(GpuInventory()).stop(job)
+    click.echo(f"Cancelled job {job_id}")
+
+
+@cli.command(help="Start the queued jobs as gpus become free")
+@click.option("--interval", default=10.0, type=float, help="Seconds between scheduling passes")
+@click.option("--once", is_flag=True, default=False, help="Run a single scheduling pass")
+@click.option("--backfill-grace", default=BACKFILL_GRACE, type=float, help="Seconds a blocked job waits before smaller jobs stop starting ahead of it")
+def job_scheduler(interval: float, once: bool, backfill_grace: float) -> None:
+    inventory = GpuInventory()
+    scheduler = Scheduler(JobQueue(), inventory, MachineLauncher(inventory), backfill_grace)
+    while True:
+        for job in scheduler.tick():
+            click.echo(f"Started job {job.job_id} on {', '.join(job.gpus)}")
+        if once:
+            return
+        time.sleep(interval)
@@ -1,15 +1,25 @@
-import os
-from typing import Union
+import json
+from typing import List, Union
 
 import click
 
-from subprocess import check_call, CalledProcessError
-
+from vm_trainer.components.catalog import MachineCatalog
+from vm_trainer.components.cpu_topology import HostTopology
 from vm_trainer.components.dependencies import DependencyManager
+from vm_trainer.components.disks import (DEFAULT_DISK_PROFILE, DISK_AIO_MODES,
+                                         DISK_BUSES, DISK_IOTHREAD_MODES,
+                                         QCOW2_PREALLOCATION_MODES,
+                                         QCOW2_PROFILES, DiskProfile,
+                                         Qcow2Profile)
 from vm_trainer.components.machine import Machine
+from vm_trainer.components.memory import HUGE_PAGE_SIZES, MEMORY_BACKENDS
+from vm_trainer.components.network import NETWORK_MODES, NIC_MODELS
+from vm_trainer.components.runtime import RuntimeRegistry
 from vm_trainer.exceptions import CommandError
 from vm_trainer.management.clickgroup import cli
-from vm_trainer.settings import Settings
+
+STATS_FORMATS = ("json", "prometheus")
+LIST_FORMATS = ("text", "json")
 
 
 @cli.command(help="Create new machine settings")
@@ -19,7 +29,9 @@ from vm_trainer.settings import Settings
 @click.option("--existing-disk", required=False, type=str, help="Use an existing disk")
 @click.option("--memory", required=True, type=int, help="Amount of memory in MB")
 @click.option("--tpm", required=False, default=True, type=bool, help="Use TPM or Not")
-def machine_create(name: str, cpus: int, memory: int, existing_disk: Union[str, None], disk_size: Union[int, None], tpm: bool) -> None:
+@click.option("--qcow2-profile", default="default", type=click.Choice(sorted(QCOW2_PROFILES)), help="The qcow2 creation profile of the new disk")
+def machine_create(name: str, cpus: int, memory: int, existing_disk: Union[str, None], disk_size: Union[int, None], tpm: bool,
+                   qcow2_profile: str) -> None:
     DependencyManager.check_all()
     machine = Machine(name)
     if machine.exists():
@@ -39,6 +51,8 @@ def machine_create(name: str, cpus: int, memory: int, existing_disk: Union[str,
         raise CommandError("No disk settings were specified")
 
     machine.set_memory(memory)
+    if qcow2_profile != "default":
+        machine.set_qcow2_profile(Qcow2Profile(QCOW2_PROFILES[qcow2_profile]))
     machine.save()
 
     try:
@@ -57,6 +71,30 @@ def machine_set_cpus(name: str, cpus: int) -> None:
     machine.save()
 
 
+@cli.command(help="Pin the vcpus to host cores following the cpu topology")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--enabled", required=True, type=bool, help="Enable or disable the cpu pinning")
+def machine_set_cpu_pinning(name: str, enabled: bool) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.set_cpu_pinning(enabled)
+    machine.save()
+
+
+@cli.command(help="Show the vcpu to host cpu mapping of a machine")
+@click.option("--name", required=True, help="The name of the virtual machine")
+def machine_show_cpu_plan(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    placement = machine.numa_placement()
+    cpu_plan = placement.cpu_plan(machine.vcpu_count(), HostTopology())
+    click.echo(f"-smp {cpu_plan.smp_parameter()}")
+    if placement.gpu_nodes():
+        click.echo(f"gpu NUMA nodes: {', '.join(str(node) for node in placement.gpu_nodes())}")
+    for line in cpu_plan.describe():
+        click.echo(line)
+
+
 @cli.command(help="Define the machine memory")
 @click.option("--name", required=True, help="The name of the virtual machine")
 @click.option("--memory", required=True, type=int, help="Amount of memory in MB")
@@ -67,6 +105,40 @@ def machine_set_memory(name: str, memory: int) -> None:
     machine.save()
 
 
+@cli.command(help="Define how the machine memory is backed on the host")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--backend", required=True, type=click.Choice(MEMORY_BACKENDS), help="Regular pages, memfd or huge pages")
+@click.option("--page-size", default="2M", type=click.Choice(list(HUGE_PAGE_SIZES)), help="The huge page size")
+@click.option("--fallback", default=True, type=bool, help="Use regular pages when huge pages can't be reserved")
+@click.option("--share", default=False, type=bool, help="Share the memory with other processes (vhost-user, virtiofs)")
+def machine_set_memory_backend(name: str, backend: str, page_size: str, fallback: bool, share: bool) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.set_memory_backend(backend, page_size, fallback, share)
+    machine.save()
+
+
+@cli.command(help="Define the network card model (virtio with vhost-net or the emulated e1000e)")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--model", required=True, type=click.Choice(NIC_MODELS), help="Use e1000e to install guests without virtio drivers")
+def machine_set_network_model(name: str, model: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.set_nic_model(model)
+    machine.save()
+
+
+@cli.command(help="Define how the machine reaches the network (nat bridge, macvtap on the host nic or a SR-IOV virtual function)")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--mode", required=True, type=click.Choice(NETWORK_MODES), help="nat is the default, the other modes bypass the bridge")
+@click.option("--vf", default="", help="The pci address of the virtual function used by the sriov mode")
+def machine_set_network_mode(name: str, mode: str, vf: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.set_network_mode(mode, vf)
+    machine.save()
+
+
 @cli.command(help="Pass throug a USB device")
 @click.option("--name", required=True, help="The name of the virtual machine")
 @click.option("--address", required=True, type=str)
@@ -78,12 +150,24 @@ def machine_set_usb_device(name: str, address: str) -> None:
 
 
 @cli.command(help="List existing machine names")
-def machine_list() -> None:
-    settings = Settings()
-    for name in os.listdir(settings.machines_dir()):
-        if not name.endswith('.yaml'):
-            continue
-        click.echo(name[0:-5])
+@click.option("--filter", "filters", multiple=True, help="Only list the machines matching key=value (also key>=value and key<=value), e.g. gpus=0000:01:00.0")
+@click.option("--format", "output_format", default="text", type=click.Choice(LIST_FORMATS), help="Machine names or a json list of the machine summaries")
+def machine_list(filters: List[str], output_format: str) -> None:
+    machines = MachineCatalog().machines(filters)
+    if output_format == "json":
+        click.echo(json.dumps(machines, indent=2))
+        return
+    for machine in machines:
+        click.echo(machine["name"])
+
+
+@cli.command(help="Show the gpus and disks assigned to more than one machine")
+def machine_conflicts() -> None:
+    conflicts = MachineCatalog().conflicts()
+    for kind, resource, names in conflicts:
+        click.echo(f"{kind[:-1]} {resource}: {', '.join(names)}")
+    if conflicts:
+        raise CommandError(f"Found {len(conflicts)} conflicting assignments")
 
 
 @cli.command(help="Assign gpu's to an existing machine")
@@ -131,6 +215,85 @@ def machine_set_disk_device(name: str, device: str) -> None:
     machine.save()
 
 
+@cli.command(help="Define the io profile of a machine disk")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--disk", default="main", help="The disk to configure (main, raw-disk1)")
+@click.option("--bus", default=DEFAULT_DISK_PROFILE["bus"], type=click.Choice(DISK_BUSES), help="The disk controller")
+@click.option("--aio", default=DEFAULT_DISK_PROFILE["aio"], type=click.Choice(DISK_AIO_MODES), help="The host asynchronous io engine")
+@click.option("--cache-direct", default=DEFAULT_DISK_PROFILE["cache-direct"], type=bool, help="Bypass the host page cache")
+@click.option("--queues", default=DEFAULT_DISK_PROFILE["queues"], help="Number of virtqueues (auto = one per vcpu)")
+@click.option("--iothread", default=DEFAULT_DISK_PROFILE["iothread"], type=click.Choice(DISK_IOTHREAD_MODES), help="Dedicated, shared or one iothread per queue group")
+def machine_set_disk_profile(name: str, disk: str, bus: str, aio: str, cache_direct: bool, queues: str, iothread: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.set_disk_profile(disk, DiskProfile({
+        "bus": bus,
+        "aio": aio,
+        "cache-direct": cache_direct,
+        "queues": int(queues) if queues.isdigit() else queues,
+        "iothread": iothread,
+    }))
+    machine.save()
+
+
+@cli.command(help="Define how the qcow2 disk is created and the metadata cache given to it at launch")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--profile", default="default", type=click.Choice(sorted(QCOW2_PROFILES)), help="The preset the other options override")
+@click.option("--preallocation", type=click.Choice(QCOW2_PREALLOCATION_MODES), help="Allocate the metadata or the whole disk at creation")
+@click.option("--cluster-size", help="The qcow2 cluster size (512 to 2M)")
+@click.option("--lazy-refcounts", type=bool, help="Delay the refcount updates of cache=writeback writes")
+@click.option("--extended-l2", type=bool, help="Split the clusters in 32 subclusters (qemu 5.2+)")
+@click.option("--cache-clean-interval", type=int, help="Seconds after which unused metadata cache entries are freed")
+def machine_set_qcow2_profile(name: str, profile: str, preallocation: Union[str, None], cluster_size: Union[str, None],
+                              lazy_refcounts: Union[bool, None], extended_l2: Union[bool, None],
+                              cache_clean_interval: Union[int, None]) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    config = dict(QCOW2_PROFILES[profile])
+    overrides = {
+        "preallocation": preallocation,
+        "cluster-size": cluster_size,
+        "lazy-refcounts": lazy_refcounts,
+        "extended-l2": extended_l2,
+        "cache-clean-interval": cache_clean_interval,
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    machine.set_qcow2_profile(Qcow2Profile(config))
+    machine.save()
+    click.echo("The creation options apply to disks created from now on, the cache options to the next launch")
+
+
+@cli.command(help="Show the effective qcow2 and io settings of the machine disks")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--format", "output_format", default="text", type=click.Choice(LIST_FORMATS), help="Output format")
+def machine_disk_info(name: str, output_format: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    disks = machine.disk_info()
+    if output_format == "json":
+        click.echo(json.dumps(disks, indent=2))
+        return
+    for disk in disks:
+        click.echo(f"{disk['disk']}:")
+        for key, value in disk.items():
+            if key == "disk":
+                continue
+            if isinstance(value, dict):
+                value = ", ".join(f"{item}={option}" for item, option in value.items())
+            click.echo(f"  {key}: {value}")
+
+
+@cli.command(help="Check the host qemu supports the disk io profiles of a machine")
+@click.option("--name", required=True, help="The name of the virtual machine")
+def machine_check_disk_profiles(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.validate_disk_profiles()
+    for disk in machine.disk_names():
+        profile = machine.disk_profile(disk).to_dict()
+        click.echo(f"{disk}: " + ", ".join(f"{key}={value}" for key, value in profile.items()))
+
+
 @cli.command(help="Run the machine with an iso attached on it")
 @click.option("--name", required=True, help="The name of the virtual machine")
 @click.option("--iso", required=True, help="The path to the iso file to attach")
@@ -149,9 +312,87 @@ def machine_run(name: str, shared_dir: Union[str, None]) -> None:
     machine.execute(None, shared_dir)
 
 
-@cli.command(help="Kills the qemu process")
-def machine_kill() -> None:
-    try:
-        check_call(["sudo", "pkill", "-f", "qemu-system-x86_64"])
-    except CalledProcessError:
-        raise CommandError("Failed to kill the qemu process")
+@cli.command(help="Show the state of a running machine")
+@click.option("--name", required=True, help="The name of the virtual machine")
+def machine_status(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    click.echo(machine.monitor().status())
+
+
+@cli.command(help="Power down the machine, quit the emulator when the guest does not respond")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--timeout", default=60, type=int, help="Seconds to wait for the guest to power off")
+def machine_stop(name: str, timeout: int) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    monitor = machine.monitor()
+    if monitor.status() == "stopped":
+        raise CommandError(f"The machine {name} is not running")
+    monitor.stop(timeout)
+
+
+@cli.command(help="Pause the machine vcpus")
+@click.option("--name", required=True, help="The name of the virtual machine")
+def machine_pause(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.monitor().pause()
+
+
+@cli.command(help="Resume a paused machine")
+@click.option("--name", required=True, help="The name of the virtual machine")
+def machine_resume(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.monitor().resume()
+
+
+@cli.command(help="Sample the host side cost of a running machine (vcpu/iothread cpu time, disk and network counters)")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--interval", default=1.0, type=float, help="Seconds between samples")
+@click.option("--count", default=0, type=int, help="Number of samples (0 = until interrupted)")
+@click.option("--format", "output_format", default="json", type=click.Choice(STATS_FORMATS), help="JSON lines or prometheus text")
+def machine_stats(name: str, interval: float, count: int, output_format: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    import asyncio
+
+    from vm_trainer.components.telemetry import stream_samples
+    asyncio.run(stream_samples(machine.sampler(), interval, count, output_format))
+
+
+@cli.command(help="Serve the machine statistics in the prometheus format")
+@click.option("--name", required=True, help="The name of the virtual machine")
+@click.option("--interval", default=5.0, type=float, help="Seconds between samples")
+@click.option("--address", default="127.0.0.1", help="The address to listen on")
+@click.option("--port", default=9477, type=int, help="The port to listen on")
+def machine_stats_exporter(name: str, interval: float, address: str, port: int) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    click.echo(f"Serving http://{address}:{port}/metrics")
+    import asyncio
+
+    from vm_trainer.components.telemetry import MetricsExporter
+    asyncio.run(MetricsExporter(machine.sampler(), interval).serve(address, port))
+
+
+@cli.command(help="Kills the qemu process of a running machine")
+@click.option("--name", required=True, help="The name of the virtual machine")
+def machine_kill(name: str) -> None:
+    machine = Machine(name)
+    machine.must_exists()
+    machine.kill()
+
+
+@cli.command(help="List the running machines")
+@click.option("--format", "output_format", default="text", type=click.Choice(LIST_FORMATS), help="One line per machine or a json list")
+def machine_ps(output_format: str) -> None:
+    entries = RuntimeRegistry().running()
+    if output_format == "json":
+        click.echo(json.dumps([dict(entry.to_dict(), uptime=int(entry.uptime())) for entry in entries], indent=2))
+        return
+    for entry in entries:
+        uptime = int(entry.uptime())
+        resources = " ".join(f"{kind}={','.join(values)}" for kind, values in sorted(entry.resources.items()) if values)
+        click.echo(f"{entry.name} pid={entry.emulator_pid or '-'} up={uptime // 3600}:{uptime // 60 % 60:02d}:{uptime % 60:02d} tap={entry.tap_interface} {resources}")
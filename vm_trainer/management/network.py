@@ -1,6 +1,11 @@
+import os
+import sys
+from typing import Tuple
+
 import click
 
 from vm_trainer.components.network import TapNetwork
+from vm_trainer.components.tools import ToolBase
 from vm_trainer.management.clickgroup import cli
 from vm_trainer.settings import Settings
 
@@ -33,3 +38,32 @@ def network_add_tap(target: str) -> None:
 @cli.command(help="Remove vmtrainer network interfaces")
 def network_del_tap() -> None:
     TapNetwork.remove_tap_network()
+
+
+@cli.command(help="Run the dhcp server and the caching dns forwarder on the bridge network")
+@click.option("--upstream", multiple=True, help="Upstream dns server, by default the ones of /etc/resolv.conf")
+@click.option("--domain", default="vm", help="Domain name given to the machines")
+def network_services(upstream: Tuple[str, ...], domain: str) -> None:
+    from vm_trainer.components.catalog import MachineCatalog
+    from vm_trainer.components.netservices import build_config, save_json
+    settings = Settings()
+    config = build_config(MachineCatalog().machines(), settings.network_ip(), TapNetwork.BRIDGE_INTERFACE_NAME,
+                          settings.dhcp_leases_path(), list(upstream), domain)
+    for mac, address in sorted(config["leases"].items(), key=lambda item: config["hostnames"][item[0]]):
+        click.echo(f"{config['hostnames'][mac]}: {address} ({mac})")
+    for mac in sorted(set(config["hostnames"]) - set(config["leases"])):
+        click.echo(f"{config['hostnames'][mac]}: no address left in {config['network']} ({mac})")
+    config_path = settings.run_dir().joinpath("netservices.json")
+    save_json(config_path, config)
+    # the dhcp and dns ports need root, the services run in their own process under sudo
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    ToolBase.execute_application([
+        "sudo", "env", f"PYTHONPATH={package_dir}", sys.executable, "-m", "vm_trainer.components.netservices", str(config_path),
+    ])
+
+
+@cli.command(help="Show the addresses given to the machines by the dhcp server")
+def network_show_leases() -> None:
+    from vm_trainer.components.netservices import load_leases
+    for mac, address in sorted(load_leases(Settings().dhcp_leases_path()).items(), key=lambda item: item[1]):
+        click.echo(f"{address} {mac}")
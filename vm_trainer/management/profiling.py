@@ -0,0 +1,28 @@
+import statistics
+
+import click
+
+from vm_trainer.management.clickgroup import cli
+from vm_trainer.profiling import read_history
+from vm_trainer.settings import Settings
+
+
+@cli.command(help="Show the timing history recorded by --profile and flag slow runs")
+@click.option("--command", "command_name", default=None, help="Only show the runs of this command")
+@click.option("--last", default=20, type=int, help="Number of runs to show")
+@click.option("--threshold", default=1.5, type=float, help="Flag runs slower than this factor of the median")
+def profile_history(command_name: str, last: int, threshold: float) -> None:
+    entries = read_history(Settings().profile_history_path())
+    if command_name:
+        entries = [entry for entry in entries if entry.get("command") == command_name]
+    medians = {}
+    for name in set(entry.get("command") for entry in entries):
+        medians[name] = statistics.median(entry["total_ms"] for entry in entries if entry.get("command") == name)
+    for entry in entries[-last:]:
+        median = medians[entry.get("command")]
+        flag = " SLOW" if median and entry["total_ms"] > median * threshold else ""
+        slowest = max(entry.get("phases", {}).items(), key=lambda item: item[1], default=("-", 0))
+        click.echo(
+            f"{entry.get('command', ''):<28} {entry['total_ms']:>10.1f} ms (median {median:.1f}) "
+            f"procs {entry.get('subprocesses', 0):>3} slowest phase: {slowest[0]} {slowest[1]:.1f} ms{flag}"
+        )
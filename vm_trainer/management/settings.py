@@ -1,5 +1,6 @@
 import click
 
+from vm_trainer.components.firewall import FIREWALL_BACKENDS
 from vm_trainer.management.clickgroup import cli
 from vm_trainer.settings import Settings
 
@@ -47,6 +48,14 @@ def settings_show_ip_address() -> None:
     settings = Settings()
     click.echo(settings.network_ip())
 
+@cli.command(help="Set the backend used for the nat rules of the bridge")
+@click.option("--backend", required=True, type=click.Choice(FIREWALL_BACKENDS), help="iptables-restore or nft")
+def settings_set_firewall_backend(backend: str) -> None:
+    settings = Settings()
+    settings.set_firewall_backend(backend)
+    settings.save()
+
+
 @cli.command(help="Set the qemu binary location")
 @click.option("--path", required=True, type=str, help="Path to qemu-system-x86_64 binary")
 def settings_set_qemu_path(path: str) -> None:
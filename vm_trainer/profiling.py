@@ -0,0 +1,164 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+PROFILE_ENV = "VMTRAINER_PROFILE"
+PROFILE_OUTPUT_ENV = "VMTRAINER_PROFILE_OUTPUT"
+
+
+class PhaseRecord:
+    def __init__(self, name: str, start: float, depth: int) -> None:
+        self.name = name
+        self.start = start
+        self.depth = depth
+        self.wall = 0.0
+        self.subprocesses = 0
+        self.failed = False
+
+
+class CommandRecord:
+    def __init__(self, parameters: Sequence[str], start: float, wall: float, exit_status: Optional[int]) -> None:
+        self.parameters = [str(parameter) for parameter in parameters]
+        self.start = start
+        self.wall = wall
+        self.exit_status = exit_status
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self._enabled = False
+        self._started = time.perf_counter()
+        self._phases: List[PhaseRecord] = []
+        self._commands: List[CommandRecord] = []
+        self._depth = 0
+        self._subprocesses = 0
+        self._hook_installed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @property
+    def subprocesses(self) -> int:
+        return self._subprocesses
+
+    def enable(self) -> None:
+        self._enabled = True
+        self._started = time.perf_counter()
+        self.install_hook()
+
+    def install_hook(self) -> None:
+        if self._hook_installed:
+            return
+        self._hook_installed = True
+        # audit hooks can't be removed, the counter is cheap enough to stay installed
+        sys.addaudithook(self._audit)
+
+    def _audit(self, event: str, args: Any) -> None:
+        if event in ("subprocess.Popen", "os.system", "os.fork"):
+            self._subprocesses += 1
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if not self._enabled:
+            yield
+            return
+        record = PhaseRecord(name, time.perf_counter(), self._depth)
+        subprocesses = self._subprocesses
+        self._phases.append(record)
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            record.failed = True
+            raise
+        finally:
+            self._depth -= 1
+            record.wall = time.perf_counter() - record.start
+            record.subprocesses = self._subprocesses - subprocesses
+
+    def record_command(self, parameters: Sequence[str], start: float, exit_status: Optional[int]) -> None:
+        if self._enabled:
+            self._commands.append(CommandRecord(parameters, start, time.perf_counter() - start, exit_status))
+
+    def total(self) -> float:
+        return time.perf_counter() - self._started
+
+    def report(self) -> List[str]:
+        lines = [f"{'phase':<40} {'wall (ms)':>10} {'procs':>6}"]
+        for record in self._phases:
+            name = ("  " * record.depth + record.name + (" (failed)" if record.failed else ""))[:40]
+            lines.append(f"{name:<40} {record.wall * 1000:>10.1f} {record.subprocesses:>6}")
+        if self._commands:
+            lines.append("")
+            lines.append(f"{'command':<60} {'wall (ms)':>10} {'exit':>5}")
+            for command in self._commands:
+                status = "-" if command.exit_status is None else str(command.exit_status)
+                lines.append(f"{' '.join(command.parameters)[:60]:<60} {command.wall * 1000:>10.1f} {status:>5}")
+        lines.append("")
+        lines.append(f"total {self.total() * 1000:.1f} ms, {self._subprocesses} subprocesses")
+        return lines
+
+    def trace_events(self) -> Dict[str, Any]:
+        pid = os.getpid()
+        tid = threading.get_ident()
+        events: List[Dict[str, Any]] = []
+        for record in self._phases:
+            events.append({
+                "name": record.name, "cat": "phase", "ph": "X", "pid": pid, "tid": tid,
+                "ts": (record.start - self._started) * 1e6, "dur": record.wall * 1e6,
+                "args": {"subprocesses": record.subprocesses, "failed": record.failed},
+            })
+        for command in self._commands:
+            events.append({
+                "name": command.parameters[0] if command.parameters else "", "cat": "subprocess", "ph": "X",
+                "pid": pid, "tid": tid, "ts": (command.start - self._started) * 1e6, "dur": command.wall * 1e6,
+                "args": {"argv": command.parameters, "exit_status": command.exit_status},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump_trace(self, filepath: str) -> None:
+        with open(filepath, "w") as fp:
+            json.dump(self.trace_events(), fp)
+
+    def history_entry(self, command: str) -> Dict[str, Any]:
+        return {
+            "timestamp": time.time(),
+            "command": command,
+            "total_ms": round(self.total() * 1000, 1),
+            "subprocesses": self._subprocesses,
+            "phases": {record.name: round(record.wall * 1000, 1) for record in self._phases},
+        }
+
+    def append_history(self, history_path: Path, command: str) -> None:
+        with open(history_path, "a") as fp:
+            fp.write(json.dumps(self.history_entry(command)) + "\n")
+
+
+PROFILER = Profiler()
+
+
+def profile_phase(name: str) -> Any:
+    return PROFILER.phase(name)
+
+
+def profiling_requested() -> bool:
+    return os.environ.get(PROFILE_ENV, "").lower() in ("1", "true", "yes", "on")
+
+
+def read_history(history_path: Path) -> List[Dict[str, Any]]:
+    if not history_path.exists():
+        return []
+    entries = []
+    with open(history_path, "r") as fp:
+        for line in fp:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
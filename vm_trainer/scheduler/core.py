@@ -0,0 +1,113 @@
+import time
+from typing import Dict, List, Optional, Set
+
+from vm_trainer.exceptions import CommandError
+from vm_trainer.scheduler.jobs import Job, JobQueue
+
+# a blocked job stops the smaller ones from jumping ahead of it once it waited this long
+BACKFILL_GRACE = 1800
+
+
+class Inventory:
+    def free_gpus(self, busy: Set[str]) -> Dict[str, int]:
+        raise NotImplementedError()
+
+    def total(self) -> int:
+        raise NotImplementedError()
+
+
+class Launcher:
+    def start(self, job: Job, gpus: List[str]) -> None:
+        raise NotImplementedError()
+
+    def poll(self, job: Job) -> Optional[int]:
+        raise NotImplementedError()
+
+    def stop(self, job: Job) -> None:
+        raise NotImplementedError()
+
+    def cleanup(self, job: Job) -> None:
+        raise NotImplementedError()
+
+
+def pick_gpus(free: Dict[str, int], count: int) -> Optional[List[str]]:
+    if count > len(free):
+        return None
+    nodes: Dict[int, List[str]] = {}
+    for address, node in free.items():
+        nodes.setdefault(node, []).append(address)
+    # best fit on a single NUMA node keeps the larger nodes for the larger jobs
+    fitting = [addresses for addresses in nodes.values() if len(addresses) >= count]
+    if fitting:
+        best = min(fitting, key=len)
+        return sorted(best)[:count]
+    return sorted(free, key=lambda address: (free[address], address))[:count]
+
+
+class Scheduler:
+    def __init__(self, queue: JobQueue, inventory: Inventory, launcher: Launcher, backfill_grace: float = BACKFILL_GRACE) -> None:
+        self._queue = queue
+        self._inventory = inventory
+        self._launcher = launcher
+        self._backfill_grace = backfill_grace
+
+    def poll(self, now: float) -> List[Job]:
+        finished = []
+        for job in self._queue.jobs(["running"]):
+            exit_code = self._launcher.poll(job)
+            if exit_code is None:
+                continue
+            job.finish(exit_code, now, "" if exit_code == 0 else f"exit code {exit_code}")
+            self._launcher.cleanup(job)
+            finished.append(job)
+        return finished
+
+    def usage(self) -> Dict[str, int]:
+        usage: Dict[str, int] = {}
+        for job in self._queue.jobs(["running"]):
+            usage[job.user] = usage.get(job.user, 0) + len(job.gpus)
+        return usage
+
+    def schedule(self, now: float) -> List[Job]:
+        busy = {address for job in self._queue.jobs(["running"]) for address in job.gpus}
+        free = self._inventory.free_gpus(busy)
+        usage = self.usage()
+        queued = []
+        for job in self._queue.jobs(["queued"]):
+            if job.gpu_count > self._inventory.total():
+                job.finish(None, now, f"needs {job.gpu_count} gpus, the host has {self._inventory.total()}")
+            else:
+                queued.append(job)
+        started = []
+        while queued:
+            # higher priority first, then the users holding the fewest gpus, then the oldest job
+            queued.sort(key=lambda job: (-job.priority, usage.get(job.user, 0), job.submitted, job.job_id))
+            selected = None
+            gpus: Optional[List[str]] = None
+            for job in queued:
+                gpus = pick_gpus(free, job.gpu_count)
+                if gpus:
+                    selected = job
+                    break
+                if job.wait_time(now) >= self._backfill_grace:
+                    break
+            if selected is None or gpus is None:
+                break
+            queued.remove(selected)
+            try:
+                self._launcher.start(selected, gpus)
+            except CommandError as e:
+                selected.finish(None, now, e.args[0])
+                continue
+            selected.start(gpus, now)
+            for address in gpus:
+                del free[address]
+            usage[selected.user] = usage.get(selected.user, 0) + len(gpus)
+            started.append(selected)
+        return started
+
+    def tick(self, now: Optional[float] = None) -> List[Job]:
+        now = time.time() if now is None else now
+        with self._queue.locked():
+            self.poll(now)
+            return self.schedule(now)
@@ -0,0 +1,165 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+from vm_trainer.exceptions import CommandError
+from vm_trainer.settings import Settings
+
+JOB_STATES = ("queued", "running", "done", "failed", "cancelled")
+ACTIVE_STATES = ("queued", "running")
+
+
+class Job:
+    def __init__(self, data: Dict) -> None:
+        self._data = data
+
+    @staticmethod
+    def new(job_id: int, template: str, gpu_count: int, command: str, user: str, priority: int, now: float) -> "Job":
+        return Job({
+            "id": job_id,
+            "template": template,
+            "gpu-count": gpu_count,
+            "command": command,
+            "user": user,
+            "priority": priority,
+            "state": "queued",
+            "submitted": now,
+            "started": None,
+            "finished": None,
+            "gpus": [],
+            "exit-code": None,
+            "message": "",
+            "cancel-requested": False,
+            "pid": None,
+        })
+
+    @property
+    def job_id(self) -> int:
+        return self._data["id"]
+
+    @property
+    def template(self) -> str:
+        return self._data["template"]
+
+    @property
+    def gpu_count(self) -> int:
+        return self._data["gpu-count"]
+
+    @property
+    def command(self) -> str:
+        return self._data["command"]
+
+    @property
+    def user(self) -> str:
+        return self._data["user"]
+
+    @property
+    def priority(self) -> int:
+        return self._data["priority"]
+
+    @property
+    def state(self) -> str:
+        return self._data["state"]
+
+    @property
+    def submitted(self) -> float:
+        return self._data["submitted"]
+
+    @property
+    def gpus(self) -> List[str]:
+        return self._data["gpus"]
+
+    @property
+    def message(self) -> str:
+        return self._data["message"]
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._data["cancel-requested"]
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._data.get("pid")
+
+    @property
+    def instance_name(self) -> str:
+        return f"{self.template}-job{self.job_id}"
+
+    def start(self, gpus: List[str], now: float) -> None:
+        self._data.update({"state": "running", "started": now, "gpus": gpus})
+
+    def set_pid(self, pid: int) -> None:
+        self._data["pid"] = pid
+
+    def finish(self, exit_code: Optional[int], now: float, message: str = "") -> None:
+        if self.cancel_requested:
+            state = "cancelled"
+        else:
+            state = "done" if exit_code == 0 else "failed"
+        self._data.update({"state": state, "finished": now, "exit-code": exit_code, "message": message})
+
+    def request_cancel(self, now: float) -> None:
+        if self.state == "queued":
+            self._data.update({"state": "cancelled", "finished": now})
+        self._data["cancel-requested"] = True
+
+    def wait_time(self, now: float) -> float:
+        return max(now - self.submitted, 0.0)
+
+    def describe(self) -> str:
+        gpus = ",".join(self.gpus) or f"{self.gpu_count} gpus"
+        line = f"{self.job_id:>5} {self.state:<10} {self.user:<12} prio={self.priority:<3} {gpus:<28} {self.template}: {self.command}"
+        return f"{line} ({self.message})" if self.message else line
+
+    def to_dict(self) -> Dict:
+        return dict(self._data)
+
+
+class JobQueue:
+    def __init__(self, queue_path: Union[str, Path, None] = None) -> None:
+        self._queue_path = Path(queue_path) if queue_path else Settings().job_queue_path()
+        self._next_id = 1
+        self._jobs: List[Job] = []
+
+    def load(self) -> None:
+        try:
+            with open(self._queue_path, "r") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = {}
+        self._next_id = data.get("next-id", 1)
+        self._jobs = [Job(item) for item in data.get("jobs", [])]
+
+    def save(self) -> None:
+        temp_path = f"{self._queue_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump({"next-id": self._next_id, "jobs": [job.to_dict() for job in self._jobs]}, fp, indent=1)
+        os.replace(temp_path, self._queue_path)
+
+    @contextmanager
+    def locked(self) -> Iterator["JobQueue"]:
+        # the scheduler and the job commands update the queue from different processes
+        with open(f"{self._queue_path}.lock", "a") as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            self.load()
+            yield self
+            self.save()
+
+    def submit(self, template: str, gpu_count: int, command: str, user: str, priority: int = 0, now: Optional[float] = None) -> Job:
+        job = Job.new(self._next_id, template, gpu_count, command, user, priority, time.time() if now is None else now)
+        self._next_id += 1
+        self._jobs.append(job)
+        return job
+
+    def jobs(self, states: Optional[List[str]] = None) -> List[Job]:
+        return [job for job in self._jobs if states is None or job.state in states]
+
+    def job(self, job_id: int) -> Job:
+        for job in self._jobs:
+            if job.job_id == job_id:
+                return job
+        raise CommandError(f"The job {job_id} does not exist")
@@ -0,0 +1,76 @@
+import subprocess
+import sys
+from typing import Dict, List, Optional, Set
+
+from vm_trainer.components.gpu import discover_gpus
+from vm_trainer.components.machine import Machine
+from vm_trainer.components.runtime import RuntimeRegistry, process_command_line
+from vm_trainer.exceptions import CommandError
+from vm_trainer.scheduler.core import Inventory, Launcher
+from vm_trainer.scheduler.jobs import Job
+from vm_trainer.settings import Settings
+
+# the exit code reported for a job whose launcher was lost, e.g. after a scheduler restart
+LOST_EXIT_CODE = -1
+
+
+class GpuInventory(Inventory):
+    def __init__(self) -> None:
+        self._gpus = {gpu.video_address: gpu for gpu in discover_gpus()}
+
+    def gpu_dicts(self, addresses: List[str]) -> List[Dict]:
+        return [self._gpus[address].to_dict() for address in addresses]
+
+    def total(self) -> int:
+        return len(self._gpus)
+
+    def free_gpus(self, busy: Set[str]) -> Dict[str, int]:
+        # machines started by hand hold their gpus too
+        for entry in RuntimeRegistry().running():
+            busy = busy | set(entry.resources.get("gpus", []))
+        return {address: gpu.numa_node for address, gpu in self._gpus.items() if address not in busy}
+
+
+class MachineLauncher(Launcher):
+    def __init__(self, inventory: GpuInventory) -> None:
+        self._inventory = inventory
+        self._processes: Dict[int, subprocess.Popen] = {}
+
+    def start(self, job: Job, gpus: List[str]) -> None:
+        template = Machine(job.template)
+        template.must_exists()
+        try:
+            template.create_instance(job.instance_name, self._inventory.gpu_dicts(gpus), job.command)
+        except subprocess.CalledProcessError as e:
+            # qemu-img may leave a partial overlay behind
+            Machine(job.instance_name).delete_instance()
+            raise CommandError(f"Could not create the instance of the job {job.job_id}: {e}")
+        with open(Settings().jobs_dir().joinpath(f"{job.job_id}.log"), "a") as log_fp:
+            try:
+                # every job runs the regular machine-run in its own session, it outlives a scheduler restart
+                self._processes[job.job_id] = subprocess.Popen(
+                    [sys.executable, "-m", "vm_trainer", "machine-run", "--name", job.instance_name],
+                    stdin=subprocess.DEVNULL, stdout=log_fp, stderr=subprocess.STDOUT, start_new_session=True,
+                )
+                job.set_pid(self._processes[job.job_id].pid)
+            except OSError as e:
+                Machine(job.instance_name).delete_instance()
+                raise CommandError(f"Could not start the job {job.job_id}: {e}")
+
+    def poll(self, job: Job) -> Optional[int]:
+        process = self._processes.get(job.job_id)
+        if process is not None:
+            return process.poll()
+        if RuntimeRegistry().entry(job.instance_name):
+            return None
+        # a machine-run started before a scheduler restart may not have registered its machine yet
+        if job.pid and job.instance_name in process_command_line(job.pid):
+            return None
+        return LOST_EXIT_CODE
+
+    def stop(self, job: Job) -> None:
+        Machine(job.instance_name).kill()
+
+    def cleanup(self, job: Job) -> None:
+        self._processes.pop(job.job_id, None)
+        Machine(job.instance_name).delete_instance()
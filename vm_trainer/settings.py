@@ -1,8 +1,62 @@
+import copy
 import os
 from pathlib import Path
+from typing import Any, Dict, Optional, Set, Tuple, Union
 
 import yaml
 
+# libyaml is several times faster, the pure python classes are used when it is not built in
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+_yaml_cache: Dict[str, Tuple[int, int, Any]] = {}
+_created_dirs: Set[Path] = set()
+
+
+def ensure_dir(dirpath: Path) -> Path:
+    if dirpath not in _created_dirs:
+        os.makedirs(dirpath, exist_ok=True)
+        _created_dirs.add(dirpath)
+    return dirpath
+
+
+def load_yaml_file(filepath: Union[str, Path]) -> Optional[Any]:
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    cached = _yaml_cache.get(str(filepath))
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return copy.deepcopy(cached[2])
+    with open(filepath, "r") as fp:
+        contents = fp.read()
+    try:
+        data = yaml.load(contents, Loader=YAML_LOADER)
+    except yaml.constructor.ConstructorError:
+        # files written by older versions may carry python specific tags
+        data = yaml.load(contents, Loader=yaml.Loader)
+    _yaml_cache[str(filepath)] = (stat.st_mtime_ns, stat.st_size, data)
+    return copy.deepcopy(data)
+
+
+def save_yaml_file(filepath: Union[str, Path], data: Any) -> None:
+    temp_path = f"{filepath}.{os.getpid()}.tmp"
+    try:
+        try:
+            contents = yaml.dump(data, Dumper=YAML_DUMPER)
+        except yaml.representer.RepresenterError:
+            contents = yaml.dump(data, Dumper=yaml.Dumper)
+        with open(temp_path, "w") as fp:
+            fp.write(contents)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    stat = os.stat(filepath)
+    _yaml_cache[str(filepath)] = (stat.st_mtime_ns, stat.st_size, copy.deepcopy(data))
+
 
 class Settings():
     def __init__(self) -> None:
@@ -12,16 +66,10 @@ class Settings():
         self.load()
 
     def settings_dir(self) -> Path:
-        dirpath = Path.expanduser(Path("~/.vmtrainer"))
-        if not dirpath.exists():
-            os.makedirs(dirpath)
-        return dirpath
+        return ensure_dir(Path.expanduser(Path("~/.vmtrainer")))
 
     def tpm_dir(self) -> Path:
-        dirpath = self.settings_dir().joinpath("tpm")
-        if not dirpath.exists():
-            os.makedirs(dirpath)
-        return dirpath
+        return ensure_dir(self.settings_dir().joinpath("tpm"))
 
     def tpm_socket_path(self) -> Path:
         return self.tpm_dir().joinpath("swtpm-sock.sock")
@@ -34,16 +82,31 @@ class Settings():
         return self._settings.get("qemu-bin-path", "qemu-system-x86_64")
 
     def temp_dir(self) -> Path:
-        dirpath = self.settings_dir().joinpath('temp')
-        if not dirpath.exists():
-            os.makedirs(dirpath)
-        return dirpath
+        return ensure_dir(self.settings_dir().joinpath("temp"))
+
+    def run_dir(self) -> Path:
+        return ensure_dir(self.settings_dir().joinpath("run"))
 
     def machines_dir(self) -> Path:
-        dirpath = self.settings_dir().joinpath("machines")
-        if not dirpath.exists():
-            os.makedirs(dirpath)
-        return dirpath
+        return ensure_dir(self.settings_dir().joinpath("machines"))
+
+    def machine_index_path(self) -> Path:
+        return self.settings_dir().joinpath("machine-index.json")
+
+    def profile_history_path(self) -> Path:
+        return self.settings_dir().joinpath("profile-history.jsonl")
+
+    def probe_cache_path(self) -> Path:
+        return self.settings_dir().joinpath("probe-cache.json")
+
+    def dhcp_leases_path(self) -> Path:
+        return self.settings_dir().joinpath("dhcp-leases.json")
+
+    def jobs_dir(self) -> Path:
+        return ensure_dir(self.settings_dir().joinpath("jobs"))
+
+    def job_queue_path(self) -> Path:
+        return self.jobs_dir().joinpath("queue.json")
 
     def settings_path(self) -> Path:
         return self.settings_dir().joinpath("settings.yaml")
@@ -56,6 +119,9 @@ class Settings():
     def network_ip(self) -> str:
         return self._settings["network-ip"]
 
+    def firewall_backend(self) -> str:
+        return self._settings.get("firewall-backend", "iptables")
+
     def set_disk_directory(self, directory_path: str) -> None:
         self._settings["disk-directory"] = directory_path
 
@@ -65,15 +131,16 @@ class Settings():
     def set_network_interface(self, name: str) -> None:
         self._settings["network-interface"] = name
 
+    def set_firewall_backend(self, backend: str) -> None:
+        self._settings["firewall-backend"] = backend
+
     def set_qemu_binary_path(self, path: str) -> None:
         self._settings["qemu-bin-path"] = path
 
     def load(self) -> None:
-        if not self.settings_path().exists():
-            return
-        with open(self.settings_path(), "r") as fp:
-            self._settings = yaml.load(fp, Loader=yaml.Loader)
+        data = load_yaml_file(self.settings_path())
+        if data is not None:
+            self._settings = data
 
     def save(self) -> None:
-        with open(self.settings_path(), "w") as fp:
-            yaml.dump(self._settings, fp, Dumper=yaml.Dumper)
+        save_yaml_file(self.settings_path(), self._settings)
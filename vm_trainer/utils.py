@@ -1,58 +1,15 @@
-from __future__ import annotations
-
 import os
-import re
 import subprocess
+import time
 from pathlib import Path
-from typing import Dict, Iterator, List
-
-AUDIO_VIDEO_VENDORS_RE = ({"audio": "(Audio device.*NVIDIA|NVIDIA Corporation)", "video": "(.*VGA.*NVIDIA|.*NVIDIA.*GeForce)"},)
-DEVICE_INFO_RE = "([0-9]{2}:[0-9]{2}\\.[0-9])[^:]*:(.*)\\[([0-9a-f]{4}):([0-9a-f]{4})\\].*"  # parse a string like: 01:00.0 VGA compatible controller [0300]: NVIDIA Corporation GP104 [GeForce GTX 1080] [10de:1b80] (rev a1)
-
-
-class GPU:
-    def __init__(self, video_vendor: str, audio_vendor: str, video_address: str, audio_address: str) -> None:
-        self._video_vendor = video_vendor
-        self._audio_vendor = audio_vendor
-        self._video_address = video_address
-        self._audio_address = audio_address
-
-    @property
-    def video_vendor(self) -> str:
-        return self._video_vendor
-
-    @property
-    def audio_vendor(self) -> str:
-        return self._audio_vendor
-
-    @property
-    def audio_address(self) -> str:
-        return self._audio_address
-
-    @property
-    def video_address(self) -> str:
-        return self._video_address
-
-    @classmethod
-    def from_vendor(cls, vendor_devices: Dict) -> GPU:
-        device_re = re.compile(DEVICE_INFO_RE)
-        video_match = device_re.match(vendor_devices["video"])
-        audio_match = device_re.match(vendor_devices["audio"])
-        if not video_match:
-            raise Exception("Invalid vendor device information GPU not found")
-        audio_vendor = ""
-        video_vendor = ""
-        audio_address = ""
-        video_address = ""
-        if audio_match:
-            audio_vendor = audio_match.group(0).strip()
-            audio_address = f"0000:{audio_match.group(1)}"
-        video_vendor = video_match.group(0).strip()
-        video_address = f"0000:{video_match.group(1)}"
-        return cls(video_vendor, audio_vendor, video_address, audio_address)
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from vm_trainer.components.pci import PciScanner
+from vm_trainer.profiling import PROFILER
 
 
 def run_read_output(parameters: List[str], shell: bool = False) -> Iterator[str]:
+    start = time.perf_counter()
     process = subprocess.Popen(list(parameters), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=shell)
     try:
         for output_line in iter(process.stdout.readline, ""):
@@ -60,10 +17,82 @@ def run_read_output(parameters: List[str], shell: bool = False) -> Iterator[str]
     finally:
         process.stdout.close()
         return_code = process.wait()
+        PROFILER.record_command(parameters, start, return_code)
         if return_code:
             raise subprocess.CalledProcessError(return_code, str(parameters))
 
 
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    cpus: List[int] = []
+    for item in cpu_list.strip().split(","):
+        if not item:
+            continue
+        if "-" in item:
+            first, last = item.split("-", 1)
+            cpus += list(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    ranges: List[str] = []
+    ordered = sorted(set(cpus))
+    start = 0
+    while start < len(ordered):
+        end = start
+        while end + 1 < len(ordered) and ordered[end + 1] == ordered[end] + 1:
+            end += 1
+        if start == end:
+            ranges.append(str(ordered[start]))
+        else:
+            ranges.append(f"{ordered[start]}-{ordered[end]}")
+        start = end + 1
+    return ",".join(ranges)
+
+
+def read_text_file(filepath: Union[str, Path], default: str = "") -> str:
+    try:
+        with open(filepath, "r") as fp:
+            return fp.read().strip()
+    except OSError:
+        return default
+
+
+def list_process_threads(pid: int) -> List[Tuple[int, str]]:
+    threads: List[Tuple[int, str]] = []
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return threads
+    for tid in tids:
+        threads.append((int(tid), read_text_file(f"/proc/{pid}/task/{tid}/comm")))
+    return threads
+
+
+def find_descendant_process(parent_pid: int, name: str) -> Optional[int]:
+    children: Dict[int, List[int]] = {}
+    names: Dict[int, str] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        stat = read_text_file(f"/proc/{entry}/stat")
+        if not stat:
+            continue
+        # the command name is enclosed in parenthesis and may contain spaces
+        comm = stat[stat.find("(") + 1:stat.rfind(")")]
+        fields = stat[stat.rfind(")") + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        names[int(entry)] = comm
+    pending = list(children.get(parent_pid, []))
+    while pending:
+        pid = pending.pop(0)
+        if name.startswith(names.get(pid, "")) and names.get(pid):
+            return pid
+        pending += children.get(pid, [])
+    return None
+
+
 def get_IOMMU_information() -> List[str]:
     return list(run_read_output([
         "sh", "-c",
@@ -72,53 +101,19 @@ def get_IOMMU_information() -> List[str]:
 
 
 def get_iommu_devices() -> Iterator[str]:
-    base_dir = "/sys/kernel/iommu_groups/"
-    for dir in os.listdir(base_dir):
-        for device in os.listdir(f"{base_dir}/{dir}/devices"):
-            for line in run_read_output(["lspci", "-nns", device]):
-                yield line
-
-
-def search_gpu_devices(devices: List[str], vendor: Dict) -> Dict:
-    audio = ""
-    video = ""
-    video_re = re.compile(vendor["video"])
-    audio_re = re.compile(vendor["audio"])
-    
-    gpus = {"video": {}, "audio": {}}
-
-    for device in devices:
-        if "vga compatible controller" in device.lower():
-            if  video_re.search(device):
-                gpus["video"][device[0:6]] = device
-        elif "audio device" in device.lower():
-            if  audio_re.search(device):
-                gpus["audio"][device[0:6]] = device
-    
-    result = []
-    for gpu in gpus["video"].keys():
-        if gpu in gpus["audio"].keys():
-            result.append({
-                "video": gpus["video"][gpu],
-                "audio": gpus["audio"][gpu],
-            })
-    
-    return result
-
-
-def gpus_from_iommu_devices() -> List[GPU]:
-    devices = list(get_iommu_devices())
-    gpus = []
-    for vendor in AUDIO_VIDEO_VENDORS_RE:
-        gpu_devices = search_gpu_devices(devices, vendor)
-        for vendor_lines in gpu_devices:
-            gpus.append(GPU.from_vendor(vendor_lines))
-            devices = [d for d in devices if d not in vendor_lines["video"] and d not in vendor_lines["audio"]]
-    return gpus
-
-
-def create_qcow_disk(disk_filepath: Path, disk_size: int) -> Iterator[str]:
+    return PciScanner().lspci_lines()
+
+
+def create_qcow_disk(disk_filepath: Path, disk_size: int, options: str = "") -> Iterator[str]:
+    parameters = ["qemu-img", "create", "-f", "qcow2"]
+    if options:
+        parameters += ["-o", options]
+    for line in run_read_output(parameters + [str(disk_filepath), f"{disk_size}M"]):
+        yield line
+
+
+def create_qcow_overlay(backing_filepath: Path, disk_filepath: Path) -> Iterator[str]:
     for line in run_read_output([
-            "qemu-img", "create", "-f", "qcow2", str(disk_filepath), f"{disk_size}M"
+            "qemu-img", "create", "-f", "qcow2", "-b", os.path.abspath(backing_filepath), "-F", "qcow2", str(disk_filepath)
     ]):
         yield line